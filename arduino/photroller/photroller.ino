@@ -10,6 +10,22 @@ uint32_t max_samples;
 unsigned long sample_hold1;
 unsigned long sample_hold2;
 
+// parameter packets from the host (photroller.util.pack_parameters):
+// sync (2), protocol version, sequence number, payload length, payload, crc16 of
+// version..payload, little-endian
+#define SYNC1 0xA5
+#define SYNC2 0x5A
+#define PROTOCOL_VERSION 1
+#define PAYLOAD_SIZE 20
+#define PACKET_SIZE (5 + PAYLOAD_SIZE + 2)
+
+// statuses confirmed back to the host
+#define STATUS_OK 0
+#define STATUS_BAD_CRC 1
+#define STATUS_BAD_VERSION 2
+#define STATUS_BAD_LENGTH 3
+#define STATUS_BAD_VALUE 4
+
 struct parameters
 {
   uint16_t freq1;
@@ -22,42 +38,27 @@ struct parameters
 
 parameters init_parameters;
 
+uint8_t packet[PACKET_SIZE];
+uint8_t packet_len = 0;
+
 unsigned long next_update1 = 0;
 unsigned long next_update2 = 0;
     
 void setup() {
 
   Serial.begin(115200);
-  
-  while(Serial.available() < 1) {
+
+  max_samples = sizeof(SINE_TABLE) / 2 - 1;
+
+  // wait for a valid parameter set
+  while (!(receive_packet() && handle_packet())) {
   }
-  
-//  Serial.println("Data received...");
-  read_init_values();
 
   // LUDICROUS SPEED!
   Wire.begin();
   Wire.setClock(1000000L);
-  
-//  Serial.println(init_parameters.freq1);
-//  Serial.println(init_parameters.freq2);
-//  Serial.println(init_parameters.amp1);
-//  Serial.println(init_parameters.amp2);
-//  Serial.println(init_parameters.offset1);
-//  Serial.println(init_parameters.offset2);
 
   // loop 1 will run sinusoid 1, loop 2 sinusoid 2, loop 3 reading in data...
-
-  max_samples = sizeof(SINE_TABLE) / 2 - 1;
-  sample_hold1 = (1e6 / ((max_samples + 1) * init_parameters.freq1));
-  sample_hold2 = (1e6 / ((max_samples + 1) * init_parameters.freq2)); 
-  
-//  Serial.println(sample_hold1);
-//  Serial.println(sample_hold2);
-
-  next_update1 = micros() + sample_hold1;
-  next_update2 = micros() + sample_hold2;
-  
 }
 
 void loop() {
@@ -71,93 +72,92 @@ void loop() {
     write_sine2();
   }
 
-  if (Serial.available() > 0) {
-    read_init_values();
-    sample_hold1 = (1e6 / ((max_samples + 1) * init_parameters.freq1));
-    sample_hold2 = (1e6 / ((max_samples + 1) * init_parameters.freq2));
-    next_update1 = micros() + sample_hold1;
-    next_update2 = micros() + sample_hold2;
+  // only takes the bytes already received, so the sinusoids keep their timing
+  if (receive_packet()) {
+    handle_packet();
   }
 }
 
-void read_init_values() {
-
-  // read in everything, pack into a struct to pass back to the main function
-  
-  // set frequencies
-
-  int i = 0;
-
-  union {
-    byte b[2];
-    uint16_t val;
-  } freq1;
+uint16_t crc16(const uint8_t *data, uint8_t len) {
+  // CRC-16/CCITT-FALSE, python's binascii.crc_hqx(data, 0xFFFF)
+  uint16_t crc = 0xFFFF;
+  for (uint8_t i = 0; i < len; i++) {
+    crc ^= (uint16_t) data[i] << 8;
+    for (uint8_t b = 0; b < 8; b++) {
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+  }
+  return crc;
+}
 
-  Serial.readBytes(freq1.b, 2);
-//  Serial.println(freq1.val);
-  
-  union {
-    byte b[2];
-    uint16_t val;
-  } freq2;
-  
-  Serial.readBytes(freq2.b, 2);
-//  Serial.println(freq2.val);
-  
-  union {
-    byte b[4];
-    float val;
-  } amp1;
-  
-  Serial.readBytes(amp1.b, 4);
-//  Serial.println(amp1.val);
-  
-  // amplitude is passed as a float 0-5, convert to uint16_t
-  
-//  uint16_t amp1_dig  = (amp1.val / 5) * 65535;
-  
-  union {
-    byte b[4];
-    float val;
-  } amp2;
-  
-  Serial.readBytes(amp2.b, 4);
-//  Serial.println(amp2.val);
-  
-//  uint16_t amp2_dig = (amp2.val / 5) * 65535;
-  
-  union {
-    byte b[4];
-    float val;
-  } offset1;
-  
-  Serial.readBytes(offset1.b, 4);
-//  Serial.println(offset1.val);
-  
-//  uint16_t offset1_dig = (offset1.val / 5) * 65535;
-  
-  
-  union {
-    byte b[4];
-    float val;
-  } offset2;
+bool receive_packet() {
+  // collect the bytes available without blocking; true once `packet` holds a whole packet
+  while (Serial.available() > 0) {
+    uint8_t b = Serial.read();
+    if ((packet_len == 0 && b != SYNC1) || (packet_len == 1 && b != SYNC2)) {
+      // out of sync: look for the start of the next packet
+      packet_len = 0;
+      if (b == SYNC1) {
+        packet[packet_len++] = b;
+      }
+      continue;
+    }
+    packet[packet_len++] = b;
+    if (packet_len == 5 && packet[4] != PAYLOAD_SIZE) {
+      send_confirmation(packet[3], STATUS_BAD_LENGTH);
+      packet_len = 0;
+    } else if (packet_len == PACKET_SIZE) {
+      packet_len = 0;
+      return true;
+    }
+  }
+  return false;
+}
 
-  Serial.readBytes(offset2.b, 4);
-//  Serial.println(offset2.val);
-  
-//  uint16_t offset2_dig = (offset2.val / 5) * 65535;
-
-  init_parameters.freq1 = freq1.val;
-  init_parameters.freq2 = freq2.val;
-//  init_parameters.amp1 = amp1_dig;
-//  init_parameters.amp2 = amp2_dig;
-//  init_parameters.offset1 = offset1_dig;
-//  init_parameters.offset2 = offset2_dig;
-  init_parameters.amp1 = amp1.val;
-  init_parameters.amp2 = amp2.val;
-  init_parameters.offset1 = offset1.val;
-  init_parameters.offset2 = offset2.val;
+bool handle_packet() {
+  // apply the parameters in `packet` and confirm them; false if they were rejected
+  uint8_t seq = packet[3];
+  uint16_t crc = packet[PACKET_SIZE - 2] | ((uint16_t) packet[PACKET_SIZE - 1] << 8);
+  if (crc16(packet + 2, PACKET_SIZE - 4) != crc) {
+    send_confirmation(seq, STATUS_BAD_CRC);
+    return false;
+  }
+  if (packet[2] != PROTOCOL_VERSION) {
+    send_confirmation(seq, STATUS_BAD_VERSION);
+    return false;
+  }
+  parameters received;
+  memcpy(&received, packet + 5, PAYLOAD_SIZE);
+  if (received.freq1 == 0 || received.freq2 == 0) {
+    send_confirmation(seq, STATUS_BAD_VALUE);
+    return false;
+  }
+  init_parameters = received;
+  sample_hold1 = (1e6 / ((max_samples + 1) * init_parameters.freq1));
+  sample_hold2 = (1e6 / ((max_samples + 1) * init_parameters.freq2));
+  next_update1 = micros() + sample_hold1;
+  next_update2 = micros() + sample_hold2;
+  send_confirmation(seq, STATUS_OK);
+  return true;
+}
 
+void send_confirmation(uint8_t seq, uint8_t status) {
+  // sync (reversed), version, sequence number, status, sample holds and time (us) now in
+  // effect, crc16 of version..time
+  uint8_t ack[19];
+  unsigned long now = micros();
+  ack[0] = SYNC2;
+  ack[1] = SYNC1;
+  ack[2] = PROTOCOL_VERSION;
+  ack[3] = seq;
+  ack[4] = status;
+  memcpy(ack + 5, &sample_hold1, 4);
+  memcpy(ack + 9, &sample_hold2, 4);
+  memcpy(ack + 13, &now, 4);
+  uint16_t crc = crc16(ack + 2, 15);
+  ack[17] = crc & 0xFF;
+  ack[18] = crc >> 8;
+  Serial.write(ack, 19);
 }
 
 uint16_t shape_sine(uint16_t val, float offset, float amp) {
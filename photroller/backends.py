@@ -0,0 +1,364 @@
+import time
+import h5py
+import numpy as np
+from scipy import signal
+from photroller.writer import BLOCK_COLUMNS
+from photroller.session import Session
+
+try:
+    from labjack import ljm
+except ImportError:
+    # only needed for LabJackBackend
+    ljm = None
+
+# LJM Modbus addresses of the registers we stream
+ADDRESSES = dict(**{f'AIN{i}': 2 * i for i in range(14)}, FIO_STATE=2500)
+# value LJM inserts for scans the device had to skip (stream auto-recovery)
+DUMMY_SAMPLE = -9999.0
+
+
+class Backend:
+    '''
+    Acquisition device interface used by `bmi_process.Stream`. Mirrors the subset of LJM
+    that the stream loop needs so the pipeline can run against hardware or a simulator.
+    '''
+    def addresses(self, names):
+        '''Map register names to the addresses passed to `start` as the scan list'''
+        raise NotImplementedError
+
+    def start(self, scans_per_read, scan_list, scan_rate) -> float:
+        '''Start streaming, returns the actual scan rate'''
+        raise NotImplementedError
+
+    def read(self):
+        '''Returns (interleaved samples, device scan backlog, LJM scan backlog), like ljm.eStreamRead'''
+        raise NotImplementedError
+
+    def write(self, name, value):
+        '''Set an output register (e.g. FIO4 or DAC0) while streaming'''
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class LabJackBackend(Backend):
+    def __init__(self, handle) -> None:
+        self.handle = handle
+
+    @classmethod
+    def connect(cls, identifier='ANY'):
+        handle = ljm.openS('T7', 'ANY', identifier)
+        info = ljm.getHandleInfo(handle)
+        print(f'Labjack device type {info[0]}; connection type {info[1]}')
+        print(f'Serial number {info[2]}; IP address {ljm.numberToIP(info[3])}')
+        print(f'Port: {info[4]}; Max bytes per MB: {info[5]}')
+        return cls(handle)
+
+    def configure(self, n_ain=4):
+        # disable triggered stream
+        ljm.eWriteName(self.handle, 'STREAM_TRIGGER_INDEX', 0)
+        # enable internally clocked stream
+        ljm.eWriteName(self.handle, 'STREAM_CLOCK_SOURCE', 0)
+        # Configure FIO 0-3
+        init_params = {
+            'STREAM_TRIGGER_INDEX': 0,
+            'STREAM_CLOCK_SOURCE': 0,
+            'STREAM_RESOLUTION_INDEX': 4,  # increase this to increase resolution
+            'STREAM_SETTLING_US': 0,
+            'AIN_ALL_NEGATIVE_CH': ljm.constants.GND,
+            'FIO_DIRECTION': 0xF000
+        }
+        for i in range(n_ain):
+            init_params[f'AIN{i}_RANGE'] = 10.0
+
+        ljm.eWriteNames(self.handle, len(init_params), list(init_params), list(init_params.values()))
+        return init_params
+
+    def addresses(self, names):
+        return ljm.namesToAddresses(len(names), names)[0]
+
+    def start(self, scans_per_read, scan_list, scan_rate):
+        return ljm.eStreamStart(self.handle, scans_per_read, len(scan_list), scan_list, scan_rate)
+
+    def read(self):
+        return ljm.eStreamRead(self.handle)
+
+    def write(self, name, value):
+        ljm.eWriteName(self.handle, name, value)
+
+    def stop(self):
+        ljm.eStreamStop(self.handle)
+
+    def close(self):
+        ljm.close(self.handle)
+
+
+class SimulatedT7(Backend):
+    '''
+    Hardware-free stand-in for a T7 streaming the photometry scan list.
+
+    AIN0 and AIN1 carry the two LED modulation sinusoids (shaped like the Arduino's
+    `shape_sine`), every other AIN is a PMT picking up both LEDs with its own gains,
+    a calcium-like dF/F on LED1 and white noise, and FIO_STATE carries random TTL
+    toggles on FIO0-3.
+
+    Params:
+        realtime: pace reads to the scan rate like the device would. Otherwise reads return
+            as fast as they can be generated, for throughput testing.
+        transient_rate: mean dF/F transients per second on each PMT
+        transient_amp: dF/F of each transient
+        transient_tau: decay time constant of a transient in seconds
+        noise: standard deviation of the PMT noise in volts
+        event_rate: mean TTL toggles per second on each of FIO0-3
+        drop_rate: probability per read of the device skipping scans, which are then
+            returned as DUMMY_SAMPLE like LJM stream auto-recovery does
+    '''
+    def __init__(self, freq1=101, freq2=237, amp1=3, amp2=1, offset1=0.1, offset2=0.1,
+                 realtime=True, transient_rate=0.2, transient_amp=0.1, transient_tau=0.5,
+                 noise=0.01, event_rate=0.5, drop_rate=0, seed=None) -> None:
+        self.freqs = (freq1, freq2)
+        self.amps = (amp1, amp2)
+        self.offsets = (offset1, offset2)
+        self.realtime = realtime
+        self.transient_rate = transient_rate
+        self.transient_amp = transient_amp
+        self.transient_tau = transient_tau
+        self.noise = noise
+        self.event_rate = event_rate
+        self.drop_rate = drop_rate
+        self.rng = np.random.default_rng(seed)
+        self.names = {v: k for k, v in ADDRESSES.items()}
+        self.injected_backlog = 0
+        self.pending_drops = 0
+        # last value written to each output register
+        self.outputs = {}
+
+    @classmethod
+    def from_parameters(cls, photometry_parameters, **kwargs):
+        keys = ('freq1', 'freq2', 'amp1', 'amp2', 'offset1', 'offset2')
+        params = {k: photometry_parameters[k] for k in keys}
+        return cls(**params, **kwargs)
+
+    def addresses(self, names):
+        return [ADDRESSES[n] for n in names]
+
+    def start(self, scans_per_read, scan_list, scan_rate):
+        self.scans_per_read = scans_per_read
+        self.scan_list = [self.names[a] for a in scan_list]
+        self.scan_rate = float(scan_rate)
+        self.n_pmts = sum(n.startswith('AIN') and n not in ('AIN0', 'AIN1') for n in self.scan_list)
+        # per-PMT pickup of each LED
+        self.gains = self.rng.uniform(0.2, 1, size=(self.n_pmts, 2))
+        decay = np.exp(-1 / (self.transient_tau * self.scan_rate))
+        self.transient_filter = ([1.0], [1.0, -decay])
+        self.transient_zi = np.zeros((self.n_pmts, 1))
+        self.fio_state = 0
+        self.scan_index = 0  # scans generated so far
+        self.injected_backlog = 0
+        self.pending_drops = 0
+        self.start_time = time.perf_counter()
+        return self.scan_rate
+
+    def inject_backlog(self, n_scans):
+        '''
+        Pretend the host stalled for `n_scans` scans while streaming. They wait in the device
+        buffer and the backlog drains as the following reads catch up on them.
+        '''
+        if self.realtime:
+            # acquired while the host was away, so reads return at once until they catch up
+            self.start_time -= n_scans / self.scan_rate
+        else:
+            self.injected_backlog += n_scans
+
+    def inject_drop(self, n_scans):
+        '''Make the next reads report `n_scans` skipped scans'''
+        self.pending_drops += n_scans
+
+    def _backlog(self):
+        if not self.realtime:
+            return self.injected_backlog
+        available = (time.perf_counter() - self.start_time) * self.scan_rate
+        return max(0, int(available) - self.scan_index)
+
+    def read(self):
+        spr = self.scans_per_read
+        if self.realtime:
+            # wait until the device would have acquired this block
+            due = self.start_time + (self.scan_index + spr) / self.scan_rate
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        if self.drop_rate > 0 and self.rng.random() < self.drop_rate:
+            self.pending_drops += int(self.rng.integers(1, spr))
+
+        block = self._generate(self.scan_index, spr)
+        if self.pending_drops > 0:
+            # LJM auto-recovery reports skipped scans as dummy samples
+            dropped = min(self.pending_drops, spr)
+            block[:dropped] = DUMMY_SAMPLE
+            self.pending_drops -= dropped
+        self.scan_index += spr
+        self.injected_backlog = max(0, self.injected_backlog - spr)
+        return list(block.ravel()), self._backlog(), 0
+
+    def _generate(self, start, n):
+        t = (start + np.arange(n)) / self.scan_rate
+        refs = [offset + (amp - offset) * (1 + np.sin(2 * np.pi * f * t)) / 2
+                for f, amp, offset in zip(self.freqs, self.amps, self.offsets)]
+
+        # calcium-like transients modulate the LED1 (signal) component only
+        impulses = self.rng.random((self.n_pmts, n)) < self.transient_rate / self.scan_rate
+        dff, self.transient_zi = signal.lfilter(*self.transient_filter, impulses * self.transient_amp,
+                                                axis=1, zi=self.transient_zi)
+        pmts = (self.gains[:, :1] * refs[0] * (1 + dff) + self.gains[:, 1:] * refs[1]
+                + self.rng.normal(0, self.noise, size=(self.n_pmts, n)))
+
+        # toggle FIO0-3 at random
+        toggles = self.rng.random((4, n)) < self.event_rate / self.scan_rate
+        bits = (np.cumsum(toggles, axis=1) + ((self.fio_state >> np.arange(4)) & 1)[:, None]) % 2
+        fio = (bits << np.arange(4)[:, None]).sum(axis=0)
+        self.fio_state = int(fio[-1])
+
+        channels = []
+        pmt = iter(pmts)
+        for name in self.scan_list:
+            if name == 'AIN0':
+                channels.append(refs[0])
+            elif name == 'AIN1':
+                channels.append(refs[1])
+            elif name == 'FIO_STATE':
+                channels.append(fio)
+            else:
+                channels.append(next(pmt))
+        # interleave scan by scan like LJM
+        return np.stack(channels, axis=1).astype(np.float64)
+
+    def write(self, name, value):
+        self.outputs[name] = value
+
+    def stop(self):
+        pass
+
+
+class ReplayT7(Backend):
+    '''
+    Plays back a recorded session as if a T7 were streaming it: the scan list is served from
+    the session's raw_photometry and digital_io, so `Stream`, the lock-in, the writer and the
+    GUI get exactly the workload of that session, and the same data every time.
+
+    Params:
+        path: session file, as saved by PhotometryWorker; `scan_rate`, `photometry_parameters`,
+            `reference_mode` and `scans_per_read` describe how it was recorded, to set up the
+            session replaying it
+        speed: scans are delivered at `speed` times the recorded scan rate, and each read reports
+            the backlog a device would have buffered by then, so a pipeline that cannot keep up
+            falls behind exactly as on a rig. None reads as fast as the pipeline asks.
+        end_event: set once the whole recording has been played, e.g. the session's shutdown
+            event to end with the recording. Reads then carry on from its start.
+    '''
+    def __init__(self, path, speed=1., end_event=None) -> None:
+        self.path = path
+        self.speed = speed or None
+        self.end_event = end_event
+        with Session(path) as s:
+            self.scan_rate = s.scan_rate
+            self.n_scans = len(s)
+            # columns of raw_photometry, and FIO_STATE from digital_io
+            self.columns = {channel: column for channel, (name, column) in s.channels.items()
+                            if name in ('raw_photometry', 'digital_io')}
+            metadata = s.h5.get('metadata/photometry', {})
+            self.photometry_parameters = {k: float(v[()]) for k, v in metadata.items()
+                                          if isinstance(v, h5py.Dataset)}
+            # reads of a backlogged stream are batched, so the most common block size
+            self.scans_per_read = None
+            if 'blocks' in s.h5 and len(s.h5['blocks']):
+                sizes = s.h5['blocks'][:, BLOCK_COLUMNS.index('n_scans')].astype(np.int64)
+                self.scans_per_read = int(np.bincount(sizes).argmax())
+        if self.n_scans == 0:
+            raise ValueError(f'{path} holds no scans to replay')
+        self.reference_mode = 'measured' if {'AIN0', 'AIN1'} <= set(self.columns) else 'synthesized'
+        self.names = {v: k for k, v in ADDRESSES.items()}
+        self.h5 = None
+        self.outputs = {}
+
+    @property
+    def duration(self):
+        '''Seconds of recording'''
+        return self.n_scans / self.scan_rate
+
+    def addresses(self, names):
+        return [ADDRESSES[n] for n in names]
+
+    def start(self, scans_per_read, scan_list, scan_rate):
+        self.scans_per_read = scans_per_read
+        self.scan_list = [self.names[a] for a in scan_list]
+        missing = [n for n in self.scan_list if n not in self.columns]
+        if missing:
+            raise ValueError(f'{self.path} did not record {missing}; it has {list(self.columns)}')
+        if scan_rate != self.scan_rate:
+            print(f'Replaying at the recorded scan rate, {self.scan_rate} Hz, instead of {scan_rate} Hz')
+        # opened here rather than in __init__, as the backend is sent to the acquisition process
+        self.h5 = h5py.File(self.path, 'r')
+        self.raw = self.h5['raw_photometry']
+        self.digital = self.h5['digital_io']
+        # whole chunks are read at once, as each read would otherwise decompress them again
+        self.cache_rows = max(self.raw.chunks[0] if self.raw.chunks else 0, scans_per_read)
+        self.cache_start = self.cache_end = 0
+        self.position = 0  # next row to play
+        self.scan_index = 0  # scans played so far
+        self.start_time = time.perf_counter()
+        return self.scan_rate
+
+    def _rows(self, start, n):
+        '''Rows start to start + n of the scan list, from the chunks cached last'''
+        if start < self.cache_start or start + n > self.cache_end:
+            self.cache_start = start
+            self.cache_end = min(start + max(self.cache_rows, n), self.n_scans)
+            raw = self.raw[self.cache_start:self.cache_end]
+            digital = self.digital[self.cache_start:self.cache_end]
+            self.cache = np.stack([digital if name == 'FIO_STATE' else raw[:, self.columns[name]]
+                                   for name in self.scan_list], axis=1).astype(np.float64)
+        return self.cache[start - self.cache_start:start - self.cache_start + n]
+
+    def _backlog(self):
+        if self.speed is None:
+            return 0
+        available = (time.perf_counter() - self.start_time) * self.scan_rate * self.speed
+        return max(0, int(available) - self.scan_index)
+
+    def read(self):
+        spr = self.scans_per_read
+        parts = []
+        while spr > 0:
+            n = min(spr, self.n_scans - self.position)
+            parts.append(self._rows(self.position, n))
+            self.position += n
+            spr -= n
+            if self.position == self.n_scans:
+                self.position = 0
+                if self.end_event is not None:
+                    self.end_event.set()
+        block = np.concatenate(parts) if len(parts) > 1 else parts[0]
+        if self.speed is not None:
+            # wait until the device would have acquired this block
+            due = self.start_time + (self.scan_index + self.scans_per_read) / (self.scan_rate * self.speed)
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        self.scan_index += self.scans_per_read
+        return list(block.ravel()), self._backlog(), 0
+
+    def write(self, name, value):
+        self.outputs[name] = value
+
+    def stop(self):
+        if self.h5 is not None:
+            self.h5.close()
+            self.h5 = None
+
+    def close(self):
+        self.stop()
@@ -0,0 +1,190 @@
+import io
+import json
+import time
+import types
+import platform
+import itertools
+import tempfile
+import threading
+import numpy as np
+from os.path import join
+from queue import Queue
+from contextlib import redirect_stdout
+from photroller import kernels
+from photroller.backends import SimulatedT7
+from photroller.transport import SharedRing
+from photroller.bmi_process import (phase_shift, demodulate, LockIn, RingBuffer, Stream, Decimator,
+                                    decimation_factor)
+
+FREQ1 = 101
+FREQ2 = 237
+
+
+def _time(fn, repeat):
+    # one warm-up call, then `repeat` timed calls
+    fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return np.array(times)
+
+
+def _test_data(n_channels, n_samples, fs, dtype, seed=0):
+    backend = SimulatedT7(FREQ1, FREQ2, realtime=False, seed=seed)
+    names = ['AIN0', 'AIN1'] + [f'AIN{i}' for i in range(2, n_channels - 1)] + ['FIO_STATE']
+    backend.start(n_samples, backend.addresses(names), fs)
+    data = np.asarray(backend.read()[0]).reshape(-1, n_channels).T
+    return data.astype(dtype)
+
+
+def bench_phase_shift(scan_rate, cache_size, dtype, **_):
+    data = _test_data(5, int(scan_rate * cache_size), scan_rate, dtype)[0]
+    return lambda: phase_shift(data)
+
+
+def bench_demodulate(scan_rate, cache_size, dtype, **_):
+    data = _test_data(5, int(scan_rate * cache_size), scan_rate, dtype)
+    lockin = LockIn((FREQ1, FREQ2), fs=scan_rate)
+    return lambda: demodulate(data[2], data[0], lockin.bandpass_sos[0], lockin.lowpass_sos, lowpass=True)
+
+
+def bench_lockin_offline(scan_rate, cache_size, dtype, **_):
+    data = _test_data(5, int(scan_rate * cache_size), scan_rate, dtype)
+    lockin = LockIn((FREQ1, FREQ2), fs=scan_rate, mode='offline')
+    return lambda: lockin(data)
+
+
+def bench_lockin_stream(scan_rate, scans_per_read, dtype, kernel='numpy', **_):
+    data = _test_data(5, scans_per_read, scan_rate, dtype)
+    lockin = LockIn((FREQ1, FREQ2), fs=scan_rate, mode='stream', kernel=kernel)
+    return lambda: lockin(data)
+
+
+def bench_lockin_fused(scan_rate, scans_per_read, dtype, **_):
+    return bench_lockin_stream(scan_rate, scans_per_read, dtype, kernel='numba')
+
+
+def bench_decimate(scan_rate, scans_per_read, dtype, output_rate=200, **_):
+    lockin = LockIn((FREQ1, FREQ2), fs=scan_rate, mode='stream')
+    data = lockin(_test_data(5, scans_per_read, scan_rate, dtype))
+    decimator = Decimator(decimation_factor(scan_rate, output_rate))
+    return lambda: decimator(data)
+
+
+def bench_ring_buffer(scan_rate, scans_per_read, cache_size, n_channels, dtype, **_):
+    flat = _test_data(n_channels, scans_per_read, scan_rate, dtype).T.ravel()
+    buff = RingBuffer(n_channels, int(scan_rate * cache_size), dtype=dtype)
+
+    def fn():
+        buff.append_interleaved(flat)
+        return buff.view()
+    return fn
+
+
+def bench_pipeline(scan_rate, scans_per_read, cache_size, duration=2, lockin_mode='stream', **_):
+    '''
+    Runs the real Stream loop (read -> demodulate -> shared ring -> HDF5 writer) against an
+    unpaced simulator for `duration` seconds and returns the mean wall time per block.
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        backend = SimulatedT7(FREQ1, FREQ2, realtime=False, seed=0)
+        names = [f'AIN{i}' for i in range(4)] + ['FIO_STATE']
+        gui_info = types.SimpleNamespace(
+            backend=backend, scan_list=backend.addresses(names), scan_names=names, scan_rate=scan_rate,
+            scans_per_read=scans_per_read, lockin_mode=lockin_mode,
+            lockin_signals=(2, 3), lockin_references=(0, 1),
+            photometry_parameters=dict(freq1=FREQ1, freq2=FREQ2),
+            saving_parameters=dict(save_path=join(tmp, 'benchmark.h5'), duration=0))
+        shutdown_event = threading.Event()
+        ring = SharedRing(len(names) + 4, scans_per_read)
+        stream = Stream(Queue(), ring, shutdown_event, gui_info, cache_size=cache_size)
+        timer = threading.Timer(duration, shutdown_event.set)
+        timer.start()
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            stream.run()
+        elapsed = time.perf_counter() - start
+        n_blocks = ring.next_seq
+        ring.close()
+    return np.array([elapsed / max(n_blocks, 1)])
+
+
+CASES = {
+    'phase_shift': (bench_phase_shift, ('scan_rate', 'cache_size', 'dtype')),
+    'demodulate': (bench_demodulate, ('scan_rate', 'cache_size', 'dtype')),
+    'lockin_offline': (bench_lockin_offline, ('scan_rate', 'cache_size', 'dtype')),
+    'lockin_stream': (bench_lockin_stream, ('scan_rate', 'scans_per_read', 'dtype')),
+    'lockin_fused': (bench_lockin_fused, ('scan_rate', 'scans_per_read', 'dtype')),
+    'decimate': (bench_decimate, ('scan_rate', 'scans_per_read', 'dtype')),
+    'ring_buffer': (bench_ring_buffer, ('scan_rate', 'scans_per_read', 'cache_size', 'n_channels', 'dtype')),
+    'pipeline': (bench_pipeline, ('scan_rate', 'scans_per_read', 'cache_size')),
+}
+
+
+def run_benchmarks(cases=None, scan_rates=(3000,), scans_per_read=(1500,), cache_sizes=(3,),
+                   n_channels=(5,), dtypes=('float32',), repeat=20, duration=2):
+    '''
+    Sweep every case over the parameters it depends on. Each record holds timing statistics
+    and the fraction of the real-time budget (the duration of one block) that the case uses.
+    '''
+    sweep = dict(scan_rate=scan_rates, scans_per_read=scans_per_read, cache_size=cache_sizes,
+                 n_channels=n_channels, dtype=dtypes)
+    records = []
+    for case in (cases or CASES):
+        fn, keys = CASES[case]
+        if case == 'lockin_fused' and kernels.numba is None:
+            print('Skipping lockin_fused: numba is not installed')
+            continue
+        seen = set()
+        for values in itertools.product(*(sweep[k] for k in keys)):
+            params = dict(zip(keys, values))
+            key = json.dumps(params, sort_keys=True)
+            if key in seen:
+                continue
+            seen.add(key)
+            if params.get('scans_per_read', 0) > params['scan_rate'] * params.get('cache_size', np.inf):
+                continue
+            if case == 'pipeline':
+                times = fn(duration=duration, **params)
+            else:
+                times = _time(fn(**params), repeat)
+            # a block (or the newest part of the cached window) has to be processed in this long
+            budget = params.get('scans_per_read', max(scans_per_read)) / params['scan_rate']
+            records.append(dict(
+                case=case, params=params,
+                mean_s=float(times.mean()), median_s=float(np.median(times)),
+                min_s=float(times.min()), max_s=float(times.max()),
+                budget_s=budget, budget_fraction=float(np.median(times) / budget),
+            ))
+    return dict(platform=platform.platform(), python=platform.python_version(),
+                numpy=np.__version__, time=time.time(), results=records)
+
+
+def _record_key(record):
+    return record['case'], json.dumps(record['params'], sort_keys=True)
+
+
+def compare(results, baseline, tolerance=0.2):
+    '''Return the records whose median time regressed by more than `tolerance` relative to the baseline'''
+    reference = {_record_key(r): r for r in baseline['results']}
+    regressions = []
+    for r in results['results']:
+        base = reference.get(_record_key(r))
+        if base is None:
+            continue
+        ratio = r['median_s'] / base['median_s']
+        r['baseline_ratio'] = ratio
+        if ratio > 1 + tolerance:
+            regressions.append(r)
+    return regressions
+
+
+def format_record(r):
+    params = ', '.join(f'{k}={v}' for k, v in r['params'].items())
+    line = (f"{r['case']:<16} {params:<75} {r['median_s'] * 1e3:9.3f} ms  "
+            f"{r['budget_fraction']:7.2%} of budget")
+    if 'baseline_ratio' in r:
+        line += f"  x{r['baseline_ratio']:.2f} vs baseline"
+    return line
@@ -1,23 +1,38 @@
+import os
+import copy
 import time
-import h5py
+import queue
+import shutil
+import functools
+import traceback
 import numpy as np
 import multiprocess as mp
 from cmath import rect
-from labjack import ljm
-from queue import Queue
-from threading import Thread
 from scipy import signal
 from hyphyber.util.sig import is_filter_stable
-from functools import reduce
-# eventually, add another process to send over raw photometry data
-# for saving
+from photroller import kernels
+from photroller.util import dict_to_h5, firmware_frequency
+from photroller.writer import Spiller, Writer, open_finished
+from photroller.publish import Publisher
+from photroller.backends import DUMMY_SAMPLE
+from photroller.latency import LatencyStats, Laps, CpuLoad
+from photroller.transport import BoundedQueue, SharedRing
 
 
 def phase_shift(data, shift=np.pi / 2):
+    # works along the last axis, so a stack of references is shifted in one call
     shift = rect(1, shift)
     d2 = np.fft.rfft(data)
-    new_data = np.fft.irfft(d2 * shift)
-    return new_data + (d2[0].real / len(data))
+    new_data = np.fft.irfft(d2 * shift, n=data.shape[-1])
+    return new_data + (d2[..., :1].real / data.shape[-1])
+
+
+def magnitude(x, y):
+    '''
+    Amplitude from the squared quadrature products. Lowpassed, they ring below zero when the
+    amplitude drops, which would make the square root NaN, so they are clamped at zero first.
+    '''
+    return np.hypot(np.sqrt(np.maximum(x, 0)), np.sqrt(np.maximum(y, 0)))
 
 
 def demodulate(data, ref_x, bp_filter, lp_filter, lowpass=False):
@@ -31,154 +46,900 @@ def demodulate(data, ref_x, bp_filter, lp_filter, lowpass=False):
         out_x = signal.sosfiltfilt(lp_filter, out_x)
         out_y = signal.sosfiltfilt(lp_filter, out_y)
 
-    return np.hypot(np.sqrt(out_x), np.sqrt(out_y))
+    return magnitude(out_x, out_y)
 
 
-def _concat(agg, segment):
-    for a, s in zip(agg, segment):
-        a.extend(s)
-    return agg
+def demodulate_causal(data, ref_x, ref_y, bp_filter, lp_filter, zi=None):
+    '''
+    Causal counterpart to `demodulate` that only processes a newly arrived block.
+    `zi` holds the (bandpass, lowpass x, lowpass y) filter states returned by the
+    previous call; pass None on the first block to start from steady state.
+    Returns the demodulated block and the updated filter states.
+    '''
+    if zi is None:
+        bp_zi = signal.sosfilt_zi(bp_filter) * data[0]
+    else:
+        bp_zi = zi[0]
+    out, bp_zi = signal.sosfilt(bp_filter, data, zi=bp_zi)
 
+    out_x = np.square(ref_x * out)
+    out_y = np.square(ref_y * out)
 
-def concatenate(cache):
-    # concat each datastream within the cache
-    _in = [list() for _ in range(len(cache[0]))]
-    out = reduce(_concat, cache, _in)
-    return out
+    if zi is None:
+        lp_zi = signal.sosfilt_zi(lp_filter)
+        zi = (bp_zi, lp_zi * out_x[0], lp_zi * out_y[0])
+    out_x, lpx_zi = signal.sosfilt(lp_filter, out_x, zi=zi[1])
+    out_y, lpy_zi = signal.sosfilt(lp_filter, out_y, zi=zi[2])
 
+    return magnitude(out_x, out_y), (bp_zi, lpx_zi, lpy_zi)
 
-class IO(Thread):
-    def __init__(self, gui_info, queue, shutdown_event):
-        super().__init__()
-        self.queue = queue
-        self.gui_info = gui_info
-        self.shutdown_event = shutdown_event
 
-    def run(self):
-        spr = self.gui_info.scans_per_read
-        n_ports = len(self.gui_info.scan_list)
-        with h5py.File(self.gui_info.saving_parameters['save_path'], 'a') as h5f:
-            # deciding to save demodulated signal to h5 too
-            # OPTION: if computer too slow, change compression from gzip to lzf or nothing
-            dset = h5f.create_dataset('raw_photometry', shape=(spr, n_ports + 1),
-                                      maxshape=(None, n_ports + 1), dtype=np.float32,
-                                      chunks=(spr, n_ports + 1), compression='gzip',
-                                      compression_opts=3)
-            dio = h5f.create_dataset('digital_io', shape=(spr, ),
-                                     maxshape=(None, ), dtype=np.uint16,
-                                     chunks=(spr, ), compression='gzip', compression_opts=3)
-            offset = 0
-            while not self.shutdown_event.is_set() or not self.queue.empty():
-                data = self.queue.get(block=True, timeout=None)
-                data = data.T
-                dset.resize(offset + len(data), axis=0)
-                dset[offset:offset + len(data)] = data[:, :-1]
-                dio.resize(offset + len(data), axis=0)
-                dio[offset:offset + len(data)] = data[:, -1]
-                offset += len(data)
-        print()
-        print('Stream over, closing h5 file')
+def demodulate_batch(data, ref_x, bp_filters, lp_filter, ref_y=None):
+    '''
+    Batched, zero-phase `demodulate` of every row of `data` (n_signals, n) against every row
+    of `ref_x` (n_refs, n), where `bp_filters[r]` is the bandpass for reference r. Each bandpass
+    runs once over all signals and one lowpass call covers every product. Without `ref_y`,
+    the quadrature references are made by FFT phase shifting `ref_x`.
+    Returns an (n_signals, n_refs, n) array.
+    '''
+    if ref_y is None:
+        ref_y = phase_shift(ref_x)
+    out = np.empty((data.shape[0], len(bp_filters), data.shape[1]))
+    for r, sos in enumerate(bp_filters):
+        out[:, r] = signal.sosfiltfilt(sos, data, axis=-1)
+    # (quadrature, signal, reference, sample)
+    mixed = np.square(np.stack([ref_x, ref_y])[:, None] * out[None])
+    mixed = signal.sosfiltfilt(lp_filter, mixed, axis=-1)
+    return magnitude(mixed[0], mixed[1])
+
+
+def demodulate_causal_batch(data, ref_x, ref_y, bp_filters, lp_filter, zi=None):
+    '''
+    Batched `demodulate_causal`, the streaming counterpart to `demodulate_batch`. `zi` holds
+    the (bandpass states per reference, lowpass state) returned by the previous call; pass
+    None on the first block to start from steady state.
+    Returns the (n_signals, n_refs, n) demodulated block and the updated filter states.
+    '''
+    if zi is None:
+        # sosfilt_zi is (n_sections, 2); states along the last axis of x are (n_sections, *x.shape[:-1], 2)
+        bp_zi = [signal.sosfilt_zi(sos)[:, None] * data[None, :, :1] for sos in bp_filters]
+    else:
+        bp_zi = list(zi[0])
+    out = np.empty((data.shape[0], len(bp_filters), data.shape[1]))
+    for r, sos in enumerate(bp_filters):
+        out[:, r], bp_zi[r] = signal.sosfilt(sos, data, axis=-1, zi=bp_zi[r])
+
+    mixed = np.square(np.stack([ref_x, ref_y])[:, None] * out[None])
+
+    if zi is None:
+        lp_zi = signal.sosfilt_zi(lp_filter)[:, None, None, None] * mixed[None, ..., :1]
+    else:
+        lp_zi = zi[1]
+    mixed, lp_zi = signal.sosfilt(lp_filter, mixed, axis=-1, zi=lp_zi)
+
+    return magnitude(mixed[0], mixed[1]), (bp_zi, lp_zi)
+
+
+def deinterleave(data, n_channels):
+    '''Reshape a flat LJM read (scan-major) into a (n_channels, n_scans) view'''
+    return np.asarray(data).reshape(-1, n_channels).T
+
+
+def make_lockin(gui_info, scan_rate):
+    '''
+    LockIn for the channel roles in `gui_info`; reference i is modulated at photometry freq{i + 1}.
+    Without reference channels, the references are synthesised at the frequency the
+    controller firmware actually produces.
+    '''
+    params = gui_info.photometry_parameters
+    references = gui_info.lockin_references
+    if references is None:
+        n_leds = sum(k.startswith('freq') for k in params)
+        freqs = [firmware_frequency(params[f'freq{i + 1}']) for i in range(n_leds)]
+        levels = [(params[f'amp{i + 1}'], params[f'offset{i + 1}']) for i in range(n_leds)]
+    else:
+        freqs = [params[f'freq{i + 1}'] for i in range(len(references))]
+        levels = None
+    return LockIn(freqs, fs=scan_rate, lowpass_cutoff=15, mode=gui_info.lockin_mode,
+                  signals=gui_info.lockin_signals, references=references, levels=levels,
+                  kernel=getattr(gui_info, 'demod_kernel', 'auto'))
+
+
+def configure_scan(gui_info, backend):
+    '''
+    Set up `gui_info` to stream the photometry channels from `backend`: the two LED
+    references on AIN0/AIN1 (unless `gui_info.reference_mode` synthesises them), two PMT
+    signals on AIN2/AIN3 and the digital inputs.
+    '''
+    gui_info.backend = backend
+    references = [] if gui_info.reference_mode == 'synthesized' else ['AIN0', 'AIN1']
+    pmts = ['AIN2', 'AIN3']
+    analog_in_names = references + pmts + ['FIO_STATE']
+    gui_info.scan_list = backend.addresses(analog_in_names)
+    gui_info.scan_names = analog_in_names
+    gui_info.lockin_references = tuple(range(len(references))) or None
+    gui_info.lockin_signals = tuple(range(len(references), len(references) + len(pmts)))
+
+
+def make_rings(gui_info):
+    '''The SharedRing of a session and, when decimating, its decimated ring (else None)'''
+    # raw channels minus FIO_STATE, a demodulated channel per signal and reference, then FIO_STATE
+    n_demod = make_lockin(gui_info, gui_info.scan_rate).n_outputs
+    n_channels = len(gui_info.scan_list) + n_demod
+    # room for several reads per slot, so a backlogged stream can batch them
+    block_size = gui_info.scans_per_read * Backlog.max_batch
+    ring = SharedRing(n_channels, block_size)
+    decimated_ring = None
+    if gui_info.output_rate:
+        factor = decimation_factor(gui_info.scan_rate, gui_info.output_rate)
+        decimated_ring = SharedRing(n_demod, block_size // factor + 1)
+    return ring, decimated_ring
+
+
+def set_affinity(cpus):
+    '''
+    Restrict the calling process to the cores in `cpus`; returns the cores it could use
+    before, or None where affinity is not supported (macOS).
+    '''
+    if not hasattr(os, 'sched_setaffinity'):
+        return None
+    previous = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, cpus)
+    return previous
+
+
+def decimation_factor(scan_rate, output_rate):
+    '''Integer decimation factor that brings `scan_rate` closest to `output_rate`'''
+    return max(1, int(round(scan_rate / output_rate)))
+
+
+def channel_names(scan_names, lockin):
+    '''Names of the raw_photometry and demodulated columns, e.g. AIN2 and AIN2_ref1'''
+    if scan_names is None:
+        return None
+    return dict(
+        raw_photometry=[n for n in scan_names if n != 'FIO_STATE'],
+        demodulated=[f'{scan_names[s]}_ref{r + 1}' for s in lockin.signals
+                     for r in range(len(lockin.freqs))],
+    )
 
 
 class Stream(mp.Process):
-    def __init__(self, queue, shutdown_event, gui_info, cache_size: int = 3) -> None:
+    def __init__(self, queue, ring, shutdown_event, gui_info, cache_size: int = 3,
+                 report_interval=10, decimated_ring=None, requested_at=None, close_backend=True,
+                 cpu=None, load=None) -> None:
         '''
         Params:
+            queue: control queue receiving (sequence number, timestamp, laps) for blocks written to
+                `ring`. laps maps the stages up to demodulation to their duration in seconds, plus
+                'read_end', the monotonic time the block was read, to measure end-to-end latency.
+                While the stream is backlogged only every other or fourth block is announced.
+                Usually a BoundedQueue dropping the oldest blocks, so a stalled display costs
+                neither memory nor acquisition time.
+            ring: SharedRing that output blocks (raw, demodulated, digital channels) are written into.
+                Slots that hold several reads let a backlogged stream process them as one block.
             cache_size: how much data to store in memory in seconds. Used for filtering and visualisation.
-                Also used to determine the frequency of dumping data to a file.
+            report_interval: seconds between latency summaries printed to stdout
+            decimated_ring: optional SharedRing receiving the demodulated channels decimated to
+                about `gui_info.output_rate`, under the same sequence numbers as `ring`. They feed
+                the feedback stage and are saved as the demodulated dataset instead of the
+                full-rate channels.
+            requested_at: time.time() the session was asked for (e.g. the click on "Start
+                streaming"); the delays to the stream start and first sample are saved under
+                metadata/startup
+            close_backend: close the backend when the session ends; a `StreamHost` keeps it open
+            cpu: core to pin the acquisition loop to once the writer (which keeps the cores it
+                was started with) is running. The load on it, see `latency.CpuLoad`, is saved
+                under metadata/cpu
+            load: optional mp.Value('d') updated about every second with that load
+
+        The writer queue follows `gui_info.queues['writer']`, (policy, capacity): 'block' makes
+        acquisition wait for a writer more than `capacity` blocks behind (the device buffer and
+        the backlog degradation absorb it), 'spill' moves those blocks to files next to the
+        session until the writer catches up, saved by a `writer.Spiller` thread so the loop
+        does not wait on the disk either. Either way nothing is lost to ring overruns. Memory is
+        bounded by the rings and queue capacities whatever the session length, plus, when
+        spilling, the copies waiting for a disk that is slower still.
         '''
         super().__init__()
         self.cache_size = cache_size
+        self.report_interval = report_interval
         self.queue = queue
+        self.ring = ring
+        self.decimated_ring = decimated_ring
         self.gui_info = gui_info
-        self.handle = gui_info.labjack
+        self.backend = gui_info.backend
         self.shutdown_event = shutdown_event
+        self.requested_at = requested_at
+        self.close_backend = close_backend
+        self.cpu = cpu
+        self.load = load
 
     def run(self):
-        # TODO: keep a rolling memory of data (mostly for filtering)
         scan_list = self.gui_info.scan_list
         scans_per_read = self.gui_info.scans_per_read
         scan_rate = self.gui_info.scan_rate
         n_ports = len(scan_list)
-        io_queue = Queue()
-        io_thread = IO(self.gui_info, io_queue, self.shutdown_event)
-        io_thread.start()
 
-        new_scan_rate = ljm.eStreamStart(self.handle, scans_per_read, n_ports,
-                                         scan_list, scan_rate)
+        if isinstance(self.queue, BoundedQueue):
+            self.queue.reset()
+        cache_hits = bandpass_sos.cache_info().hits
+        # compiling on the first block would put the stream behind from the start
+        kernels.warm_up(getattr(self.gui_info, 'demod_kernel', 'auto'))
+        new_scan_rate = self.backend.start(scans_per_read, scan_list, scan_rate)
+        startup = dict(stream_start=time.time())
         print('New scanning rate is:', new_scan_rate)
-        lockin = LockIn(self.gui_info.photometry_parameters['freq1'],
-                        self.gui_info.photometry_parameters['freq2'],
-                        fs=new_scan_rate, lowpass_cutoff=15)
 
-        n_entries = int(new_scan_rate * self.cache_size / scans_per_read)
-        buff = CircularBuffer(n_entries)
+        # HDF5 writing happens in its own process so it never competes with acquisition for the GIL
+        saving_parameters = self.gui_info.saving_parameters
+        lockin = make_lockin(self.gui_info, new_scan_rate)
+        decimator = None
+        if self.decimated_ring is not None:
+            # from the requested rate, as the owner of decimated_ring sized its slots with it
+            decimator = Decimator(decimation_factor(self.gui_info.scan_rate, self.gui_info.output_rate))
+            print(f'Demodulated output rate is {new_scan_rate / decimator.factor:.2f} Hz')
+        names = channel_names(getattr(self.gui_info, 'scan_names', None), lockin)
+        factor = decimator.factor if decimator is not None else 1
+        publisher = None
+        if getattr(self.gui_info, 'publish_address', None):
+            # the demodulated channels, decimated when a decimator runs, for other local programs
+            publisher = Publisher(self.gui_info.publish_address,
+                                  channels=names['demodulated'] if names else list(range(lockin.n_outputs)),
+                                  scan_rate=new_scan_rate, decimation=factor, rate=new_scan_rate / factor,
+                                  freqs=list(lockin.freqs)).start()
+            print('Publishing demodulated data on', self.gui_info.publish_address)
+        # a block must leave the ring before the stream comes round to its slot again
+        policy, capacity = getattr(self.gui_info, 'queues', {}).get('writer', ('block', None))
+        capacity = min(capacity or self.ring.n_blocks, self.ring.n_blocks - 2)
+        self.spill_dir = saving_parameters['save_path'] + '.spill'
+        self.spiller = Spiller(self.spill_dir) if policy == 'spill' else None
+        io_queue = BoundedQueue(capacity, policy, spill=self._spill if policy == 'spill' else None)
+        # last block the writer copied out of the ring
+        acked = mp.Value('q', -1)
+        writer = Writer(io_queue, self.ring, saving_parameters['save_path'], n_raw=n_ports - 1,
+                        scan_rate=new_scan_rate, duration=saving_parameters.get('duration', 0) * 60,
+                        codec=saving_parameters.get('codec', 'gzip'),
+                        codec_level=saving_parameters.get('codec_level'),
+                        channel_names=names, decimated_ring=self.decimated_ring, decimation=factor,
+                        swmr=bool(saving_parameters.get('flush_interval')),
+                        flush_interval=saving_parameters.get('flush_interval'),
+                        acked=acked, spill_dir=self.spill_dir if self.spiller is not None else None)
+        writer.start()
+        if self.spiller is not None:
+            # after forking the writer, which has no use for the thread
+            self.spiller.start()
+        affinity = set_affinity({self.cpu}) if self.cpu is not None else None
+
+        buff = RingBuffer(n_ports, int(new_scan_rate * self.cache_size))
+        latency = LatencyStats()
+        feedback = getattr(self.gui_info, 'feedback', None)
+        if feedback is not None:
+            feedback.reset()
+        backlog = Backlog(scans_per_read)
+        # synthesised references are re-calibrated against the PMT signal to follow drift
+        recalibrate_scans = int(getattr(self.gui_info, 'recalibrate_interval', 60) * new_scan_rate)
+        next_calibration = recalibrate_scans
+        max_batch = max(1, min(backlog.max_batch, self.ring.block_size // scans_per_read))
+        first_scan = 0
+        last_report = time.perf_counter()
+        cpu_load = CpuLoad(self.load)
 
         while not self.shutdown_event.is_set():
-            data = ljm.eStreamRead(self.handle)[0]
-            data = [data[i::n_ports] for i in range(n_ports)]
-            buff.append(data)
-            # benchmark processing
-            start = time.time()
-            concat_data = concatenate(buff)
-            if buff.current_index == 0:
-                io_queue.put(concat_data)
-
-            rs = lockin(concat_data)
+            laps = Laps()
+            raw, device_backlog, ljm_backlog = self.backend.read()
+            if backlog.level >= 3:
+                # drain reads that are already waiting and process them as one larger block
+                reads = [raw]
+                while len(reads) < max_batch and device_backlog + ljm_backlog >= scans_per_read:
+                    raw, device_backlog, ljm_backlog = self.backend.read()
+                    reads.append(raw)
+                raw = np.concatenate(reads)
+            level = backlog.update(device_backlog, ljm_backlog)
+            read_end = laps.lap('read')
+            if 'first_sample' not in startup:
+                startup['first_sample'] = time.time()
+                self._report_startup(startup, bandpass_sos.cache_info().hits - cache_hits)
+            block = deinterleave(raw, n_ports)
+            n_dropped = fill_dropped(block, buff.view(1)[:, 0])
+            laps.lap('deinterleave')
+            buff.append(block)
+            block = buff.view(block.shape[1])
+            laps.lap('buffer')
+            n_scans = block.shape[1]
+            if lockin.mode == 'stream':
+                rs = lockin(block)
+            elif level >= 2:
+                # only refilter a short window instead of the whole cache
+                rs = lockin(buff.view(backlog.short_window * n_scans))[:, -n_scans:]
+            else:
+                rs = lockin(buff.view())[:, -n_scans:]
+            if lockin.synthesized and lockin.mode == 'stream' and buff.n_written >= next_calibration:
+                lockin.calibrate(buff.view(int(min(self.cache_size, 2) * new_scan_rate)))
+                next_calibration = buff.n_written + recalibrate_scans
             # re-arrange the data so that digital stream is last
-            data = data[:-1] + rs + data[-1:]
+            data = np.concatenate([block[:-1], rs, block[-1:]])
+            if decimator is not None:
+                decimated = decimator(rs)
+                # scan of the first decimated sample
+                decimated_scan = first_scan + (int(decimator.positions[0]) if decimated.shape[1] else 0)
+            laps.lap('demodulate')
+            if feedback is not None:
+                if decimator is None:
+                    feedback(self.backend, rs, first_scan, read_end)
+                elif decimated.shape[1]:
+                    feedback(self.backend, decimated, decimated_scan, read_end, step=decimator.factor)
+                laps.lap('feedback')
             end = time.time()
-            print('Time to demodulate', round(end - start, 6), 's')
-            data = np.array(data, dtype=np.float32)
-            io_queue.put(data)
-            self.queue.put(data)
-        ljm.eStreamStop(self.handle)
-        ljm.close(self.handle)
+            self._free_slot(acked, policy, writer)
+            if decimator is not None:
+                self.decimated_ring.write(decimated, end)
+            seq = self.ring.write(data, end)
+            io_queue.put((seq, end, (first_scan, n_scans, end, device_backlog, ljm_backlog,
+                                     n_dropped, level)))
+            if publisher is not None:
+                if decimator is None:
+                    publisher.publish(seq, first_scan, end, rs)
+                else:
+                    publisher.publish(seq, decimated_scan, end, decimated)
+            # thin out the display while backlogged
+            if seq % (2 ** min(level, 2)) == 0:
+                self.queue.put((seq, end, dict(laps.durations, read_end=read_end)))
+            now = laps.lap('enqueue')
+            latency.update(laps.durations)
 
+            if n_dropped:
+                print(f'Device skipped {n_dropped} scans in the block starting at scan {first_scan}')
+            first_scan += n_scans
+            if now - cpu_load.wall > 1:
+                cpu_load.update()
+            if now - last_report > self.report_interval:
+                last_report = now
+                print(latency.format())
+                print(f'Backlog: device {device_backlog}, LJM {ljm_backlog} scans; degradation level {level}')
+                print('Writer queue:', _format_queue(io_queue))
+                print(cpu_load.format())
+        cpu_load.update()
+        self.backend.stop()
+        if self.close_backend:
+            self.backend.close()
+        if publisher is not None:
+            publisher.close()
+        if self.spiller is not None:
+            self.spiller.close()
+        io_queue.finish(None)
+        writer.join()
+        # a block saved while the writer was copying it out of the ring can be left behind
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+        if affinity is not None:
+            # a StreamHost forks the next session's writer from this process
+            set_affinity(affinity)
+        with open_finished(saving_parameters['save_path']) as h5f:
+            dict_to_h5(h5f, latency.summary(), 'metadata/latency')
+            if feedback is not None:
+                dict_to_h5(h5f, feedback.summary(), 'feedback')
+            if publisher is not None:
+                dict_to_h5(h5f, publisher.summary(), 'metadata/publisher')
+            queues = {'writer': io_queue.summary()}
+            if hasattr(self.queue, 'summary'):
+                queues['display'] = self.queue.summary()
+            dict_to_h5(h5f, queues, 'metadata/queues')
+            dict_to_h5(h5f, startup, 'metadata/startup')
+            core = -1 if self.cpu is None else self.cpu
+            dict_to_h5(h5f, dict(cpu_load.summary(), core=core), 'metadata/cpu')
+        print(latency.format())
+
+    def _report_startup(self, startup, cache_hits):
+        startup['filter_cache_hits'] = cache_hits
+        if self.requested_at is not None:
+            startup['requested'] = self.requested_at
+            startup['start_delay_s'] = startup['stream_start'] - self.requested_at
+            startup['first_sample_delay_s'] = startup['first_sample'] - self.requested_at
+            print(f"Stream started {startup['start_delay_s'] * 1e3:.0f} ms and first sample arrived "
+                  f"{startup['first_sample_delay_s'] * 1e3:.0f} ms after the request")
+
+    def _save_block(self, seq):
+        '''
+        Hand a copy of block `seq` (and its decimated block) to the spiller, which saves it
+        off this loop; the writer loads and deletes the file
+        '''
+        arrays = dict(block=self.ring.read(seq, copy=True))
+        if self.decimated_ring is not None:
+            arrays['decimated'] = self.decimated_ring.read(seq, copy=True)
+        return self.spiller.save(seq, **arrays)
+
+    def _spill(self, item):
+        return item + (self._save_block(item[0]), )
+
+    def _free_slot(self, acked, policy, writer):
+        '''Keep the next ring write from overwriting a block the writer has not copied yet'''
+        seq = self.ring.next_seq - self.ring.n_blocks
+        if seq <= acked.value:
+            return
+        if policy == 'spill':
+            if not self.spiller.saved(seq):
+                self._save_block(seq)
+            return
+        while acked.value < seq and writer.is_alive():
+            time.sleep(0.001)
+
+
+class StreamHost(mp.Process):
+    '''
+    Persistent acquisition process running one `Stream` session after another, so that
+    back-to-back sessions do not pay again for starting a process, importing scipy and h5py
+    and designing the lock-in filters (cached per process, see `bandpass_sos`).
+
+    Start it once the backend is connected: it inherits the device handle, keeps it open
+    between sessions and designs the filters for `gui_info` while it waits. Sessions are
+    handed over with `submit`, announce their blocks on `queue` like a `Stream`, and are
+    stopped with `shutdown_event`. `cpu` and `load` are passed on to every session's `Stream`.
+    '''
+    def __init__(self, gui_info, shutdown_event, queue, cpu=None, load=None) -> None:
+        # not a daemon, as sessions start writer processes
+        super().__init__()
+        self.backend = gui_info.backend
+        self.shutdown_event = shutdown_event
+        self.queue = queue
+        self.cpu = cpu
+        self.load = load
+        self.commands = mp.Queue()
+        # number of the last session that ended
+        self.finished = mp.Value('q', 0)
+        self.submitted = 0
+        self.warm_info = _session_info(gui_info)
+
+    def submit(self, gui_info, ring, decimated_ring=None, requested_at=None) -> int:
+        '''Run a session with the current `gui_info` and rings; returns its number for `wait`'''
+        self.submitted += 1
+        self.commands.put((self.submitted, _session_info(gui_info), ring, decimated_ring, requested_at))
+        return self.submitted
+
+    def wait(self, session, poll_interval=0.05):
+        while self.finished.value < session and self.is_alive():
+            time.sleep(poll_interval)
+
+    def stop(self, timeout=5):
+        self.commands.put(None)
+        self.join(timeout)
+
+    def run(self):
+        info = self.warm_info
+        lockin = make_lockin(info, info.scan_rate)
+        # first call into the filtering code; not the whole lock-in, which would fit its
+        # oscillators to a flat reference
+        signal.sosfilt(lockin.lowpass_sos, np.zeros(64))
+        kernels.warm_up(getattr(info, 'demod_kernel', 'auto'))
+        parent = mp.parent_process()
+        while True:
+            try:
+                command = self.commands.get(timeout=1)
+            except queue.Empty:
+                # do not outlive the GUI should it exit without stopping the host
+                if parent is not None and not parent.is_alive():
+                    break
+                continue
+            if command is None:
+                break
+            session, gui_info, ring, decimated_ring, requested_at = command
+            try:
+                Stream(self.queue, ring, self.shutdown_event, gui_info, decimated_ring=decimated_ring,
+                       requested_at=requested_at, close_backend=False, cpu=self.cpu, load=self.load).run()
+            except Exception:
+                # keep serving sessions; this one is reported as finished
+                traceback.print_exc()
+            finally:
+                ring.close()
+                if decimated_ring is not None:
+                    decimated_ring.close()
+                self.finished.value = session
+        self.backend.close()
 
-class CircularBuffer():
-    def __init__(self, cache_size=6):
-        self.cache = [None] * cache_size
-        self.cache_size = cache_size
-        self.current_index = 0
 
-    def append(self, __object) -> None:
-        self.cache[self.current_index % self.cache_size] = __object
-        self.current_index = (self.current_index + 1) % self.cache_size
+def _session_info(gui_info):
+    '''Copy of `gui_info` that can be sent to another process; the serial controller stays behind'''
+    info = copy.copy(gui_info)
+    info.photometry_controller = None
+    return info
 
-    def __getitem__(self, index):
-        index = self.current_index - self.cache_size + index
-        return self.cache[index % self.cache_size]
 
-    def __iter__(self):
-        return (
-            self[i] for i in range(self.cache_size)
-        )
+def _format_queue(q):
+    s = q.summary()
+    return (f"{s['policy']}, depth {s['depth']}/{s['capacity']} (high water {s['high_water']}), "
+            f"{s['drops']} dropped, {s['spills']} spilled, {s['blocked_seconds']:.2f} s blocked")
+
+
+def fill_dropped(block, last_scan):
+    '''
+    Replace scans the device skipped (LJM auto-recovery fills them with DUMMY_SAMPLE) with the
+    previous valid scan, `last_scan` for skips at the start of the block, so they do not
+    upset the lock-in filters. Works in place and returns the number of skipped scans.
+    '''
+    valid = block[0] != DUMMY_SAMPLE
+    n_dropped = len(valid) - np.count_nonzero(valid)
+    if n_dropped:
+        # index of the latest valid scan at or before each scan, -1 before the first one
+        held = np.maximum.accumulate(np.where(valid, np.arange(len(valid)), -1))
+        block[:] = np.concatenate([last_scan[:, None], block], axis=1)[:, held + 1]
+    return n_dropped
+
+
+class Backlog:
+    '''
+    Tracks the device and LJM scan backlogs returned with each read and picks how much
+    non-essential work `Stream` sheds so acquisition can catch up:
+        1: only every other block is sent to the GUI (every fourth from level 2)
+        2: the offline lock-in refilters the last `short_window` blocks instead of the cache
+        3: waiting reads are processed together as one larger block, up to `max_batch`
+            reads and as far as the SharedRing slots allow
+    The level rises as soon as the backlog, in blocks, reaches `thresholds[level]` and falls
+    one level per read once it is back below.
+    '''
+    thresholds = (1, 2, 4)
+    short_window = 4
+    max_batch = 4
+
+    def __init__(self, scans_per_read) -> None:
+        self.scans_per_read = scans_per_read
+        self.level = 0
+
+    def update(self, device_backlog, ljm_backlog) -> int:
+        blocks = (device_backlog + ljm_backlog) / self.scans_per_read
+        target = sum(blocks >= t for t in self.thresholds)
+        level = target if target > self.level else max(target, self.level - 1)
+        if level != self.level:
+            print(f'Backlog of {blocks:.1f} blocks, degradation level {self.level} -> {level}')
+        self.level = level
+        return level
+
+
+class Decimator:
+    '''
+    Stateful, anti-aliased decimation by an integer `factor` along the last axis of
+    (n_channels, n) blocks. A linear-phase FIR lowpass (cutoff at `cutoff` of the output
+    Nyquist frequency) is evaluated only at the samples that are kept, the polyphase
+    shortcut, and the input tail is carried between calls, so the outputs of consecutive
+    blocks join into the decimation of the whole stream regardless of block size.
+    '''
+    def __init__(self, factor, taps_per_phase=8, cutoff=0.8) -> None:
+        self.factor = int(factor)
+        if self.factor > 1:
+            taps = signal.firwin(self.factor * taps_per_phase + 1, cutoff / self.factor)
+        else:
+            taps = np.ones(1)
+        # reversed, so a window of samples (oldest first) dotted with them is the convolution
+        self.taps = taps[::-1].copy()
+        self.history = None
+        self.next = 0  # position of the next output sample relative to the start of the next block
+        self.positions = np.arange(0)
+
+    @property
+    def delay(self):
+        '''Group delay in input samples'''
+        return (len(self.taps) - 1) / 2
+
+    def __call__(self, block) -> np.ndarray:
+        n_taps = len(self.taps)
+        if self.history is None:
+            # start as if the first sample had been held forever
+            self.history = np.repeat(block[:, :1], n_taps - 1, axis=1)
+        x = np.concatenate([self.history, block], axis=1)
+        # window j ends with sample j of the block
+        windows = np.lib.stride_tricks.sliding_window_view(x, n_taps, axis=1)
+        self.positions = np.arange(self.next, block.shape[1], self.factor)
+        out = windows[:, self.positions] @ self.taps
+        self.next += len(self.positions) * self.factor - block.shape[1]
+        self.history = x[:, x.shape[1] - (n_taps - 1):]
+        return out
+
+
+class RingBuffer:
+    '''
+    Preallocated (n_channels, n_samples) buffer holding the most recent samples of each
+    channel. Storage is doubled along the sample axis and every block is written twice,
+    so the last N samples are always available as a contiguous view without copying.
+    '''
+    def __init__(self, n_channels, n_samples, dtype=np.float32):
+        self.n_channels = n_channels
+        self.n_samples = n_samples
+        self.data = np.zeros((n_channels, 2 * n_samples), dtype=dtype)
+        self.index = 0  # next write position within the first half of the storage
+        self.n_written = 0
+
+    def append(self, block) -> None:
+        # block has shape (n_channels, n)
+        n = block.shape[1]
+        self.n_written += n
+        if n > self.n_samples:
+            block = block[:, -self.n_samples:]
+            n = self.n_samples
+        size = self.n_samples
+        start = self.index
+        stop = start + n
+        if stop <= size:
+            self.data[:, start:stop] = block
+            self.data[:, start + size:stop + size] = block
+        else:
+            split = size - start
+            self.data[:, start:size] = block[:, :split]
+            self.data[:, start + size:] = block[:, :split]
+            self.data[:, :stop - size] = block[:, split:]
+            self.data[:, size:stop] = block[:, split:]
+        self.index = stop % size
+
+    def append_interleaved(self, data):
+        '''De-interleave a flat LJM read (scan-major) into the buffer and return the new block'''
+        block = deinterleave(data, self.n_channels)
+        self.append(block)
+        return self.view(block.shape[1])
+
+    def view(self, n=None):
+        '''Zero-copy view of the last n samples (default: the whole buffer), oldest first'''
+        if n is None or n > self.n_samples:
+            n = self.n_samples
+        end = self.index + self.n_samples
+        return self.data[:, end - n:end]
+
+
+class ReferenceOscillator:
+    '''
+    Synthesises in-phase and quadrature copies of a modulation reference, replacing the
+    per-read FFT in `phase_shift`. Frequency, phase, amplitude and offset are estimated
+    once from the first measured block; after that the measured reference is only used to
+    nudge the phase accumulator (a small PI loop) so slow drift of the Arduino clock is tracked.
+    '''
+    def __init__(self, freq, fs, phase_gain=0.5, freq_gain=0.1, level_gain=0.05) -> None:
+        self.freq = freq
+        self.fs = fs
+        self.omega = 2 * np.pi * freq / fs  # radians per sample
+        self.phase = 0.0  # phase of the next sample
+        self.amp = 1.0
+        self.offset = 0.0
+        self.phase_gain = phase_gain
+        self.freq_gain = freq_gain
+        self.level_gain = level_gain
+        self.fitted = False
+        self._ramp = np.arange(0)
+
+    def fit(self, ref) -> None:
+        '''Estimate frequency, phase, amplitude and offset of `ref`, aligned to its first sample'''
+        ref = np.asarray(ref, dtype=np.float64)
+        n = len(ref)
+        spectrum = np.abs(np.fft.rfft((ref - ref.mean()) * np.hanning(n)))
+        # only look for the peak near the requested frequency
+        freqs = np.fft.rfftfreq(n, 1 / self.fs)
+        band = np.abs(freqs - self.freq) <= max(0.1 * self.freq, 2 * self.fs / n)
+        k = np.flatnonzero(band)[np.argmax(spectrum[band])]
+        if 0 < k < len(spectrum) - 1:
+            # parabolic interpolation of the log-magnitude peak
+            a, b, c = np.log(spectrum[k - 1:k + 2] + 1e-12)
+            k = k + 0.5 * (a - c) / (a - 2 * b + c)
+        self.omega = 2 * np.pi * k / n
+        # refine the frequency from the phase advance between the two halves of the block
+        half = n // 2
+        for _ in range(2):
+            _, p1, _ = self._lstsq(ref[:half])
+            _, p2, _ = self._lstsq(ref[half:2 * half])
+            self.omega += np.angle(np.exp(1j * (p2 - p1 - self.omega * half))) / half
+        self.amp, self.phase, self.offset = self._lstsq(ref)
+        self.fitted = True
+
+    def _lstsq(self, ref):
+        # least squares fit of offset + amp * cos(omega * t + phase)
+        t = np.arange(len(ref)) * self.omega
+        design = np.stack([np.cos(t), np.sin(t), np.ones(len(ref))], axis=1)
+        (c, s, offset), *_ = np.linalg.lstsq(design, ref, rcond=None)
+        return np.hypot(c, s), np.arctan2(-s, c), offset
+
+    @property
+    def frequency(self):
+        return self.omega * self.fs / (2 * np.pi)
+
+    def calibrate(self, data, at_end=True) -> None:
+        '''
+        Fit frequency and phase to the modulation at this frequency in `data`, e.g. a PMT
+        signal, keeping the amplitude and offset. The phase is for the sample following `data`
+        (or its first sample without `at_end`).
+        '''
+        amp, offset = self.amp, self.offset
+        self.fit(data)
+        self.amp, self.offset = amp, offset
+        if at_end:
+            self.phase = (self.phase + self.omega * len(data)) % (2 * np.pi)
+
+    def generate(self, n):
+        '''Free-running (in-phase, quadrature) references for the next `n` samples'''
+        if len(self._ramp) != n:
+            self._ramp = np.arange(n)
+        phase = self.phase + self.omega * self._ramp
+        self.phase = (phase[-1] + self.omega) % (2 * np.pi)
+        return self.amp * np.cos(phase) + self.offset, self.amp * np.sin(phase) + self.offset
+
+    def __call__(self, ref):
+        '''Return (in-phase, quadrature) references for the block `ref` was measured over'''
+        n = len(ref)
+        if not self.fitted:
+            self.fit(ref)
+        if len(self._ramp) != n:
+            self._ramp = np.arange(n)
+        phase = self.phase + self.omega * self._ramp
+        cos = np.cos(phase)
+        sin = np.sin(phase)
+
+        # phase error of the synthesised reference relative to the measured one
+        ref = ref - self.offset
+        i = np.dot(ref, cos)
+        q = np.dot(ref, sin)
+        error = np.arctan2(-q, i)
+        self.omega += self.freq_gain * error / n
+        self.amp += self.level_gain * (2 * np.hypot(i, q) / n - self.amp)
+        self.offset += self.level_gain * np.mean(ref)
+
+        ref_x = self.amp * cos + self.offset
+        ref_y = self.amp * sin + self.offset
+        self.phase = (phase[-1] + self.omega + self.phase_gain * error) % (2 * np.pi)
+        return ref_x, ref_y
+
+
+@functools.lru_cache(maxsize=None)
+def bandpass_sos(freq, fs, bw):
+    '''
+    Elliptic bandpass `bw` Hz wide around `freq`. Designs are cached per process, so
+    back-to-back sessions (and reprocessing workers) with the same settings do not redo them;
+    the returned array is shared, hence read-only.
+    '''
+    half = bw // 2
+    sos = signal.ellip(3, 0.1, 40, [freq - half, freq + half], btype='bandpass', fs=fs, output='sos')
+    assert is_filter_stable(sos)
+    sos.flags.writeable = False
+    return sos
+
+
+@functools.lru_cache(maxsize=None)
+def lowpass_sos(cutoff, fs):
+    '''Butterworth lowpass applied after mixing; cached like `bandpass_sos`'''
+    sos = signal.butter(2, cutoff, fs=fs, output='sos')
+    assert is_filter_stable(sos)
+    sos.flags.writeable = False
+    return sos
 
 
 class LockIn:
-    def __init__(self, freq1, freq2, fs=3000, bw=60, lowpass_cutoff=15) -> None:
-        # set up filters
-        bw = bw // 2
-        self.lowpass_sos = signal.butter(2, lowpass_cutoff, fs=fs, output='sos')
-        assert is_filter_stable(self.lowpass_sos)
-        self.sos1 = signal.ellip(3, 0.1, 40, [freq1 - bw, freq1 + bw],
-                                 btype='bandpass', fs=fs, output='sos')
-        assert is_filter_stable(self.sos1)
-        self.sos2 = signal.ellip(3, 0.1, 40, [freq2 - bw, freq2 + bw],
-                                 btype='bandpass', fs=fs, output='sos')
-        assert is_filter_stable(self.sos2)
+    '''
+    Lock-in amplifier demodulating every signal channel against every reference channel.
+
+    `signals` and `references` are rows of the blocks passed in (the scan list order), and
+    `freqs` the modulation frequency of each reference. Calls return an array of shape
+    (n_signals * n_references, n_scans), signal-major: row s * n_references + r is signal s
+    demodulated against reference r.
+
+    With `references=None` the references are not acquired but synthesised at `freqs`, shaped
+    by `levels` (the LED (amp, offset) of each, as in `PhotometryController`). Their frequency
+    and phase are calibrated from the modulation on the first signal: on the first block in
+    stream mode, then whenever `calibrate` is called, and on every call in offline mode. All
+    signals are filtered together, so the cost grows with the number of channels and samples
+    rather than with Python-level calls.
+
+    Modes:
+        stream: call with each newly read block only. Filter states are carried between
+            calls with `sosfilt`, so the cost per read is O(block) and the output is causal.
+            The price is group delay: the bandpass and lowpass stages delay the demodulated
+            signal by roughly `group_delay()` seconds (tens of ms with the default filters).
+        offline: call with the whole cached window. The bandpass and lowpass stages run
+            forwards and backwards (`sosfiltfilt`), so the output has zero phase lag but
+            needs future samples, has edge effects at the end of the window, and costs
+            O(window) on every call.
+
+    `kernel` picks how stream mode filters (see photroller.kernels): 'numba' fuses every
+    stage into one compiled pass per sample, 'numpy' runs `demodulate_causal_batch`, and
+    'auto' uses numba when it is installed. Both give the same float64 blocks. The first
+    block always goes through NumPy, which sets up the filter states. After that the fused
+    kernel reads and writes buffers kept from call to call, so a read allocates nothing
+    for it; the returned block is overwritten by the next call, so copy it to keep it.
+    '''
+    modes = ('stream', 'offline')
+
+    def __init__(self, freqs, fs=3000, bw=60, lowpass_cutoff=15, mode='offline', signals=(2, 3),
+                 references=(0, 1), levels=None, kernel='auto') -> None:
+        if mode not in self.modes:
+            raise ValueError(f'Unknown lock-in mode {mode}; choose one of {self.modes}')
+        if references is not None and len(freqs) != len(references):
+            raise ValueError(f'Got {len(freqs)} frequencies for {len(references)} reference channels')
+        self.mode = mode
+        self.fs = fs
+        self.freqs = tuple(freqs)
+        self.signals = list(signals)
+        self.references = None if references is None else list(references)
+        # a unit sinusoid around zero by default
+        self.levels = levels or [(1, -1)] * len(self.freqs)
+        # set up filters, one bandpass per reference
+        # copies: scipy's sosfilt wants writable coefficients
+        self.lowpass_sos = lowpass_sos(lowpass_cutoff, fs).copy()
+        self.bandpass_sos = [bandpass_sos(f, fs, bw).copy() for f in self.freqs]
+        self.kernel = kernels.select_kernel(kernel)
+        # the bandpasses as one (n_references, n_sections, 6) array for the fused kernel
+        self.bandpass_stack = np.stack(self.bandpass_sos)
+        self.reset()
+
+    @property
+    def n_outputs(self):
+        return len(self.signals) * len(self.freqs)
+
+    @property
+    def synthesized(self):
+        return self.references is None
+
+    def reset(self):
+        # filter states and synthesised references for the streaming mode
+        self.zi = None
+        # (signals, ref_x, ref_y, out) of the fused kernel, sized for the last block
+        self.buffers = None
+        self.oscillators = [ReferenceOscillator(f, self.fs) for f in self.freqs]
+        if self.synthesized:
+            for osc, (amp, offset) in zip(self.oscillators, self.levels):
+                # Arduino shape_sine: offset + (amp - offset) * (1 + sin) / 2
+                osc.amp = (amp - offset) / 2
+                osc.offset = (amp + offset) / 2
+
+    def calibrate(self, data, at_end=True):
+        '''Calibrate synthesised references from `data`, a (n_channels, n_scans) window'''
+        for osc in self.oscillators:
+            osc.calibrate(data[self.signals[0]], at_end)
+
+    def group_delay(self):
+        '''Approximate delay (s) added by the causal filters for each reference'''
+        lp_delay = _sos_group_delay(self.lowpass_sos, 0, self.fs)
+        return [_sos_group_delay(sos, f, self.fs) + lp_delay
+                for sos, f in zip(self.bandpass_sos, self.freqs)]
+
+    def _fused_buffers(self, n):
+        if self.buffers is None or self.buffers[-1].shape[1] != n:
+            n_refs = len(self.freqs)
+            self.buffers = (np.empty((len(self.signals), n)), np.empty((n_refs, n)),
+                            np.empty((n_refs, n)), np.empty((self.n_outputs, n)))
+        return self.buffers
 
     def __call__(self, data) -> np.array:
-        # assume data contains all signals from labjack
-        # assume ref1 = blue modulation
-        # ref2 = UV modulation
-        # signal1 = green channel
-        # signal2 = blue channel
-        # disregard signal2, both refs onto green shannel
-        ref1_x, ref2_x, signal1, _, _ = data
-
-        out1 = demodulate(signal1, ref1_x, self.sos1, self.lowpass_sos, lowpass=True)
-        out2 = demodulate(signal1, ref2_x, self.sos2, self.lowpass_sos, lowpass=True)
-
-        return [out1, out2]
+        n = data.shape[1]
+        fused = self.mode == 'stream' and self.kernel == 'numba' and self.zi is not None
+        if fused:
+            signals, ref_x, ref_y, out = self._fused_buffers(n)
+            for i, s in enumerate(self.signals):
+                signals[i] = data[s]
+        else:
+            signals = data[self.signals]
+
+        if self.synthesized:
+            if self.mode == 'offline' or not self.oscillators[0].fitted:
+                self.calibrate(data, at_end=False)
+            refs = [osc.generate(n) for osc in self.oscillators]
+        elif self.mode == 'offline':
+            refs = None
+        else:
+            refs = [osc(data[r]) for osc, r in zip(self.oscillators, self.references)]
+
+        if fused:
+            for r, (x, y) in enumerate(refs):
+                ref_x[r], ref_y[r] = x, y
+            return kernels.demodulate_fused(signals, ref_x, ref_y, self.bandpass_stack, self.lowpass_sos,
+                                            *self.zi, out=out)
+        if refs is None:
+            ref_x, ref_y = data[self.references], None
+        else:
+            ref_x, ref_y = np.stack(refs, axis=1)
+
+        if self.mode == 'offline':
+            out = demodulate_batch(signals, ref_x, self.bandpass_sos, self.lowpass_sos, ref_y)
+        else:
+            out, self.zi = demodulate_causal_batch(signals, ref_x, ref_y, self.bandpass_sos,
+                                                   self.lowpass_sos, self.zi)
+            if self.kernel == 'numba':
+                # the states in the fused kernel's layout, which it updates in place
+                self.zi = (np.stack(self.zi[0]), np.ascontiguousarray(self.zi[1]))
+        return out.reshape(self.n_outputs, -1)
+
+
+def _sos_group_delay(sos, freq, fs):
+    b, a = signal.sos2tf(sos)
+    # evaluate just off DC for the lowpass, where the group delay is flat
+    freq = max(freq, fs / 1e4)
+    return float(signal.group_delay((b, a), w=[freq], fs=fs)[1][0] / fs)
@@ -1,6 +1,9 @@
+import json
+import time
 import click
-import numpy as np
-from photroller.util import PhotometryController
+
+# commands import what they need when they run, so that e.g. start-controller does not wait
+# for numpy, scipy or h5py
 
 orig_init = click.core.Option.__init__
 
@@ -19,18 +22,20 @@ def cli():
 
 
 @cli.command(name="start-controller")
-@click.option("--freq1", "-f1", default=150, type=np.uint16, help="Frequency for LED1")
-@click.option("--freq2", "-f2", default=350, type=np.uint16, help="Frequency for LED2")
-@click.option("--amp1", "-a1", default=3, type=np.single, help="Amplitude for LED1")
-@click.option("--amp2", "-a2", default=1, type=np.single, help="Amplitude for LED2")
-@click.option("--offset1", "-o1", default=.1, type=np.single, help="Offset for LED1")
-@click.option("--offset2", "-o2", default=.1, type=np.single, help="Offset for LED2")
+@click.option("--freq1", "-f1", default=150, type=click.IntRange(1, 65535), help="Frequency for LED1")
+@click.option("--freq2", "-f2", default=350, type=click.IntRange(1, 65535), help="Frequency for LED2")
+@click.option("--amp1", "-a1", default=3., type=float, help="Amplitude for LED1")
+@click.option("--amp2", "-a2", default=1., type=float, help="Amplitude for LED2")
+@click.option("--offset1", "-o1", default=.1, type=float, help="Offset for LED1")
+@click.option("--offset2", "-o2", default=.1, type=float, help="Offset for LED2")
 @click.option("--serial-port", "-s", default=None, help="Serial port of Arduino")
 def generate_config(serial_port, **photometry_parameters):
+    from photroller.util import PhotometryController
 
     controller = PhotometryController(photometry_parameters, serial_port)
 
-    converter = {'freq': np.uint16, 'amp': np.single, 'offset': np.single}
+    # sent as uint16 and float32
+    converter = {'freq': int, 'amp': float, 'offset': float}
 
     while True:
         new_params = input('Update parameters (format= key: value): ')
@@ -41,5 +46,191 @@ def generate_config(serial_port, **photometry_parameters):
         photometry_parameters[key] = val
         print(photometry_parameters)
         print()
-        controller.write_parameters(photometry_parameters)
+        try:
+            confirmation = controller.write_parameters(photometry_parameters, wait=True)
+            print('Now modulating at {:.2f} and {:.2f} Hz'.format(*confirmation.frequencies))
+        except (TimeoutError, ValueError) as e:
+            print(f'Not applied: {e}')
         print('-'*30)
+
+
+@cli.command(name="demodulate")
+@click.argument("sessions", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option("--dest", "-d", default="reprocessed/demodulated", help="Dataset to write the result to")
+@click.option("--overwrite", is_flag=True, help="Replace the destination dataset if it exists")
+@click.option("--mode", type=click.Choice(["offline", "stream"]), default="offline",
+              help="Zero-phase (offline) or causal (stream) lock-in")
+@click.option("--bw", default=60., help="Width of the bandpass around each reference (Hz)")
+@click.option("--lowpass-cutoff", default=15., help="Lowpass cutoff after mixing (Hz)")
+@click.option("--signal", "signals", multiple=True, type=int,
+              help="Column of raw_photometry holding a PMT signal (default: all but the references)")
+@click.option("--reference", "references", multiple=True, type=int,
+              help="Column of raw_photometry holding a modulation reference (default: detected from the "
+                   "session's channel names, else columns 0 and 1)")
+@click.option("--synthesize", is_flag=True,
+              help="Synthesise the references, for sessions recorded without AIN0/AIN1")
+@click.option("--freq", "freqs", multiple=True, type=float,
+              help="Frequency of each reference (default: the session's photometry parameters)")
+@click.option("--scan-rate", default=None, type=float, help="Scan rate (default: read from the session)")
+@click.option("--chunk", default=60., help="Seconds of data per work item")
+@click.option("--workers", "-j", default=None, type=int, help="Worker processes (default: one per core)")
+@click.option("--codec", default="gzip", help="Compression of the result")
+@click.option("--codec-level", default=None, type=int)
+def demodulate(sessions, dest, overwrite, mode, bw, lowpass_cutoff, signals, references, synthesize,
+               freqs, scan_rate, chunk, workers, codec, codec_level):
+    from photroller.reprocess import reprocess, saved_references
+
+    signals = signals or None
+    for session in sessions:
+        start = time.time()
+        try:
+            refs = None if synthesize else references or saved_references(session)
+            n = reprocess(session, dest, freqs, signals, refs, bw, lowpass_cutoff, mode, scan_rate,
+                          chunk, workers, codec, codec_level, overwrite)
+        except (ValueError, KeyError) as e:
+            raise click.ClickException(f'{session}: {e}')
+        print(f'{session}: demodulated {n} scans into {dest} in {time.time() - start:.1f} s')
+
+
+@cli.command(name="subscribe")
+@click.argument("address")
+@click.option("--report-interval", default=5., help="Seconds between reports")
+def subscribe(address, report_interval):
+    """Follow a live stream published on ADDRESS (host:port or socket path) and report drops and latency"""
+    from photroller.publish import Subscriber
+
+    try:
+        sub = Subscriber(address)
+    except OSError as e:
+        raise click.ClickException(f'Cannot connect to {address}: {e}')
+    with sub:
+        print(f"Channels {sub.metadata['channels']} at {sub.metadata['rate']:.2f} Hz")
+        last_report = time.time()
+        for _ in sub:
+            if time.time() - last_report > report_interval:
+                last_report = time.time()
+                print(f'{sub.received} blocks, {sub.dropped} dropped, latency '
+                      f'p50 {sub.latency.percentile(50) * 1e3:.2f} ms, '
+                      f'p99 {sub.latency.percentile(99) * 1e3:.2f} ms')
+    print(f'Stream ended after {sub.received} blocks, {sub.dropped} dropped')
+
+
+@cli.command(name="discover")
+def discover():
+    """List the attached T7s and Arduinos, to pair them into rigs"""
+    from photroller.rigs import discover_labjacks, discover_arduinos
+
+    try:
+        labjacks = discover_labjacks()
+    except Exception as e:
+        raise click.ClickException(f'Cannot list LabJacks: {e}')
+    print('T7 serial numbers:', ', '.join(map(str, labjacks)) or 'none')
+    print('Arduinos (serial port: USB serial number):')
+    for port, serial_number in discover_arduinos().items():
+        print(f'  {port}: {serial_number}')
+
+
+@cli.command(name="run-rigs")
+@click.argument("config", type=click.Path(exists=True, dir_okay=False))
+@click.option("--duration", "-d", default=None, type=float,
+              help="Minutes to record (default: the rigs' session duration)")
+@click.option("--report-interval", default=10., help="Seconds between CPU load and headroom reports")
+def run_rigs(config, duration, report_interval):
+    """Record from every rig in CONFIG (YAML, see photroller.rigs), one pinned process per T7"""
+    from photroller.rigs import Supervisor, load_rigs
+
+    try:
+        rigs = load_rigs(config)
+        supervisor = Supervisor(rigs, report_interval)
+    except (ValueError, KeyError) as e:
+        raise click.ClickException(f'{config}: {e}')
+    try:
+        supervisor.connect()
+        paths = supervisor.record(duration)
+    finally:
+        supervisor.close()
+    for path in paths:
+        print('Saved', path)
+
+
+@cli.command(name="replay")
+@click.argument("session", type=click.Path(exists=True, dir_okay=False))
+@click.option("--speed", "-s", "speeds", multiple=True, default=("1", ),
+              help="Times the recorded scan rate to play at, or 'max' for as fast as the pipeline goes")
+@click.option("--duration", "-d", default=None, type=float,
+              help="Seconds to replay at each speed (default: the whole recording)")
+@click.option("--scans-per-read", "-n", default=None, type=int, help="Scans per read (default: as recorded)")
+@click.option("--lockin-mode", type=click.Choice(["stream", "offline"]), default="stream")
+@click.option("--kernel", type=click.Choice(["auto", "numba", "numpy"]), default="auto",
+              help="Stream-mode demodulation kernel")
+@click.option("--output-rate", default=200.,
+              help="Rate of the decimated demodulated channels (Hz); 0 for the full rate")
+@click.option("--output", "-o", default=None, type=click.Path(file_okay=False),
+              help="Directory to keep the replayed sessions in (default: discarded)")
+@click.option("--report-interval", default=10., help="Seconds between the stream's latency reports")
+def replay(session, speeds, duration, scans_per_read, lockin_mode, kernel, output_rate, output,
+           report_interval):
+    """Play SESSION through the live pipeline at each speed and report whether it keeps up"""
+    import os
+    from photroller.replay import replay, format_result
+
+    settings = dict(lockin_mode=lockin_mode, demod_kernel=kernel, output_rate=output_rate or None)
+    if scans_per_read is not None:
+        settings['scans_per_read'] = scans_per_read
+    results = []
+    for speed in speeds:
+        try:
+            speed = None if speed == 'max' else float(speed)
+        except ValueError:
+            raise click.BadParameter(f"{speed} is neither a number nor 'max'", param_hint='--speed')
+        save_path = None
+        if output is not None:
+            os.makedirs(output, exist_ok=True)
+            label = 'max' if speed is None else f'{speed:g}x'
+            save_path = os.path.join(output, f'replay_{label}_{os.path.basename(session)}')
+        try:
+            results.append(replay(session, speed, save_path, duration, report_interval, **settings))
+        except (ValueError, KeyError) as e:
+            raise click.ClickException(f'{session}: {e}')
+        print(format_result(results[-1]))
+    if len(results) > 1:
+        print('-' * 30)
+        for r in results:
+            print(format_result(r))
+
+
+@cli.command(name="benchmark")
+@click.option("--output", "-o", default="benchmark.json", help="Where to save results as JSON")
+@click.option("--baseline", "-b", default=None, type=click.Path(exists=True),
+              help="Previous results to compare against; exits with an error on regressions")
+@click.option("--tolerance", default=0.2, help="Allowed fractional slowdown relative to the baseline")
+@click.option("--case", "-c", "cases", multiple=True, help="Only run these cases (default: all)")
+@click.option("--scan-rate", "-r", multiple=True, type=int, default=(3000, 10000, 30000, 100000))
+@click.option("--scans-per-read", "-n", multiple=True, type=int, default=(150, 1500))
+@click.option("--cache-size", multiple=True, type=float, default=(3, ), help="Cached window in seconds")
+@click.option("--n-channels", multiple=True, type=int, default=(5, ))
+@click.option("--dtype", multiple=True, default=("float32", "float64"))
+@click.option("--repeat", default=20, help="Timed calls per micro-benchmark")
+@click.option("--duration", default=2., help="Seconds to run each full pipeline benchmark")
+def benchmark(output, baseline, tolerance, cases, scan_rate, scans_per_read, cache_size,
+              n_channels, dtype, repeat, duration):
+    from photroller.benchmark import run_benchmarks, compare, format_record
+
+    results = run_benchmarks(cases, scan_rate, scans_per_read, cache_size, n_channels, dtype,
+                             repeat=repeat, duration=duration)
+    regressions = []
+    if baseline is not None:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), tolerance)
+    for r in results['results']:
+        print(format_record(r))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    over_budget = [r for r in results['results'] if r['budget_fraction'] > 1]
+    if over_budget:
+        print(f'{len(over_budget)} configurations cannot keep up with real time')
+    if regressions:
+        for r in regressions:
+            print('REGRESSION:', format_record(r))
+        raise click.ClickException(f'{len(regressions)} benchmarks regressed by more than {tolerance:.0%}')
@@ -0,0 +1,102 @@
+import time
+import numpy as np
+
+
+class Decoder:
+    '''
+    Maps demodulated data to a decision. Called with a (n_demodulated, n_scans) sub-block,
+    oldest sample first, and returns a number that `Feedback` writes to its output whenever
+    it changes. Subclass this, or pass any callable with the same signature, to plug in a
+    custom decoder; it runs in the acquisition process, so it must be picklable.
+    '''
+    def reset(self):
+        pass
+
+    def __call__(self, data):
+        raise NotImplementedError
+
+
+class ThresholdDecoder(Decoder):
+    '''
+    1 while the mean of `channel` over a sub-block is above `threshold`, else 0. With a
+    `hysteresis`, the decision only flips once the signal moves hysteresis / 2 past the threshold.
+    '''
+    def __init__(self, threshold, channel=0, hysteresis=0) -> None:
+        self.threshold = threshold
+        self.channel = channel
+        self.hysteresis = hysteresis
+        self.reset()
+
+    def reset(self):
+        self.state = 0
+
+    def __call__(self, data):
+        value = data[self.channel].mean()
+        if value > self.threshold + self.hysteresis / 2:
+            self.state = 1
+        elif value < self.threshold - self.hysteresis / 2:
+            self.state = 0
+        return self.state
+
+
+class Feedback:
+    '''
+    Closed-loop stage run by `Stream` on every demodulated block, before the block is handed
+    to the GUI and writer.
+
+    The block (the decimated demodulated channels when `Stream` decimates) is split into
+    sub-blocks of `interval` columns (default: the whole block) and the decoder is called on
+    each. When the decision changes, `levels[decision]` (or the decision itself) is written
+    to the backend output `output`, e.g. 'FIO4' or 'DAC0'. Every change is logged with the
+    index of the last scan it saw, the host time (time.time(), like the blocks table's
+    host_time) of the output write and the latency from the end of the device read.
+
+    The stage gets at most `budget` seconds per block; sub-blocks left when it runs out are
+    skipped and counted in `overruns`. Feedback latency is bounded below by the block
+    duration, so lower `scans_per_read` to react faster; a smaller `interval` only makes the
+    decisions within a block finer grained.
+    '''
+    def __init__(self, decoder, output='FIO4', levels=None, interval=None, budget=0.002) -> None:
+        self.decoder = decoder
+        self.output = output
+        self.levels = levels
+        self.interval = interval
+        self.budget = budget
+        self.reset()
+
+    def reset(self):
+        if hasattr(self.decoder, 'reset'):
+            self.decoder.reset()
+        self.decision = None
+        self.overruns = 0
+        self.log = []
+
+    def __call__(self, backend, data, first_scan, read_end, step=1) -> None:
+        '''
+        Run the decoder over `data`, whose first column is scan `first_scan` and whose columns
+        are `step` scans apart (e.g. the decimated output)
+        '''
+        start = time.perf_counter()
+        n_scans = data.shape[1]
+        interval = self.interval or n_scans
+        for lo in range(0, n_scans, interval):
+            hi = min(lo + interval, n_scans)
+            decision = self.decoder(data[:, lo:hi])
+            if decision != self.decision:
+                self.decision = decision
+                backend.write(self.output, decision if self.levels is None else self.levels[decision])
+                latency = time.perf_counter() - read_end
+                self.log.append((first_scan + (hi - 1) * step, decision, time.time(), latency))
+            if hi < n_scans and time.perf_counter() - start > self.budget:
+                self.overruns += 1
+                break
+
+    def summary(self):
+        '''Decision log and stats for the session file'''
+        log = np.array(self.log, dtype=np.float64).reshape(-1, 4)
+        return dict(
+            output=self.output, budget_s=self.budget, interval=self.interval or 0,
+            overruns=self.overruns,
+            sample_index=log[:, 0].astype(np.int64), decision=log[:, 1],
+            time=log[:, 2], latency_s=log[:, 3],
+        )
@@ -1,4 +1,5 @@
 import os
+import time
 import PySide6
 import datetime
 import numpy as np
@@ -8,8 +9,11 @@ from os.path import basename, dirname, join
 from dataclasses import dataclass, field
 from photroller.util import PhotometryController
 from PySide6.QtWidgets import QApplication, QFileDialog, QPlainTextEdit, QWidget, QLabel, QGridLayout, QPushButton, QLineEdit
-from PySide6.QtCore import QThreadPool, QSettings
+from PySide6.QtCore import QThreadPool, QSettings, QTimer
 from photroller.gui.workers import PhotometryWorker
+from photroller.gui.plots import ScrollingPlot
+from photroller.bmi_process import decimation_factor, StreamHost
+from photroller.transport import BoundedQueue
 from photroller.gui.connections import ConnectArduino, ConnectLabJack
 
 # TODO:
@@ -30,13 +34,47 @@ class GUIInfo:
                                           offset1=0.1, offset2=0.1))
     photometry_controller: PhotometryController = None
     labjack = None
+    backend = None  # acquisition backend, see photroller.backends
+    feedback = None  # optional closed-loop stage, see photroller.feedback.Feedback
     scan_rate: int = 3000  # samples per second
     labjack_init_params = None
     scans_per_read: int = 1500  # samples
     scan_list = None
+    scan_names = None  # register names of scan_list, e.g. AIN0 or FIO_STATE
+    lockin_mode: str = 'stream'  # 'stream' (causal, per block) or 'offline' (zero-phase, cached window)
+    # rows of the scan list that carry PMT signals and LED modulation references (freq1, freq2, ...)
+    lockin_signals: tuple = (2, 3)
+    lockin_references: tuple = (0, 1)
+    # 'measured' streams the references on AIN0/AIN1; 'synthesized' drops them from the scan list
+    # and rebuilds them from freq1, freq2, ...
+    reference_mode: str = 'measured'
+    recalibrate_interval: float = 60  # seconds between re-calibrations of synthesised references
+    # stream-mode demodulation: 'numba' (fused and compiled), 'numpy', or 'auto' for numba when
+    # installed; see photroller.kernels
+    demod_kernel: str = 'auto'
+    # rate (Hz) the demodulated channels are decimated to for saving, plotting and feedback;
+    # the actual rate is scan_rate / round(scan_rate / output_rate). None keeps the full rate
+    output_rate: float = 200
+    # (policy, capacity) of the queues between pipeline stages, see photroller.transport.BoundedQueue:
+    # stream -> writer ('block' or 'spill'; capacity None fits the shared ring), stream -> display
+    # worker, and blocks handed to the GUI thread that it has not plotted yet
+    queues: dict = field(default_factory=lambda: dict(
+        writer=('block', None),
+        display=('drop_oldest', 4),
+        gui=('drop_newest', 2),
+    ))
+    # 'host:port' or a socket path to broadcast the demodulated data on, see photroller.publish
+    publish_address: str = None
+    plot_window: float = 10  # seconds of data shown in the scrolling plots
+    plot_fps: float = 10  # maximum redraws per second, independent of the block rate
     saving_parameters: dict = field(default_factory=lambda: dict(
         save_path=_savepath_generator(),
-        duration=30  # minutes
+        duration=30,  # minutes
+        codec='gzip',  # one of photroller.writer.CODECS; lzf or none for slow computers
+        codec_level=3,
+        # seconds between flushes that make the file readable while recording (Session(path, live=True));
+        # 0 writes whole chunks only and the file is readable once the session ends
+        flush_interval=1,
     ))
 
 
@@ -133,6 +171,7 @@ class MainWindow(QWidget):
         self.initUI()
         self.recording = False
         self.shutdown_event = mp.Event()
+        self.host = None
 
     def initUI(self):
         layout = QGridLayout()
@@ -154,6 +193,23 @@ class MainWindow(QWidget):
         layout.addWidget(button, 2, 2)
         self.stream_button = button
 
+        # live per-stage latency of the running stream
+        self.latency_label = QLabel()
+        self.latency_label.setStyleSheet('font-family: monospace')
+        layout.addWidget(self.latency_label, 2, 0, 1, 2)
+        self.latency = None
+        self.worker = None
+        self.latency_timer = QTimer()
+        self.latency_timer.timeout.connect(self._update_latency)
+        self.latency_timer.start(1000)
+
+        # blocks are only buffered as they arrive; the plots are redrawn on this timer
+        self.plots = []
+        self.read_end = None
+        self.redraw_timer = QTimer()
+        self.redraw_timer.timeout.connect(self._redraw)
+        self.redraw_timer.start(int(1000 / self.gui_info.plot_fps))
+
         self.setLayout(layout)
         self.show()
 
@@ -161,27 +217,83 @@ class MainWindow(QWidget):
             # open new window and show
             self.connector = ConnectArduino(self.gui_info)
         if self.gui_info.labjack is None:
-            self.labjack_connector = ConnectLabJack(self.gui_info)
+            self.labjack_connector = ConnectLabJack(self.gui_info, on_connected=self._stream_host)
 
         self.threadpool = QThreadPool()
 
-    def update_plots(self, data):
-        self.sine_.clear()
-        self.sine_.plot(y=data[0], pen={'color': 'r'})
-        self.sine_.plot(y=data[1], pen={'color': 'c'})
-
-        # plot demodulated data
-        self.signal_.clear()
-        self.signal_.plot(y=data[4], pen={'color': 'r'})
-        self.signal_.plot(y=data[5], pen={'color': 'c'})
+    def _create_plots(self):
+        for w in (self.sine_, self.signal_):
+            w.clear()
+        scan_rate, window = self.gui_info.scan_rate, self.gui_info.plot_window
+        pens = ({'color': 'r'}, {'color': 'c'})
+        # show the first signal against both references
+        if self.gui_info.output_rate:
+            factor = decimation_factor(scan_rate, self.gui_info.output_rate)
+            signal_plot = ScrollingPlot(self.signal_, (0, 1), pens, scan_rate / factor, window)
+        else:
+            # demodulated channels follow the raw ones
+            n_raw = len(self.gui_info.scan_list) - 1
+            signal_plot = ScrollingPlot(self.signal_, (n_raw, n_raw + 1), pens, scan_rate, window)
+        self.plots = [
+            # the PMTs when the references are not acquired
+            ScrollingPlot(self.sine_, (self.gui_info.lockin_references or self.gui_info.lockin_signals)[:2],
+                          pens, scan_rate, window),
+            signal_plot,
+        ]
+
+    def update_plots(self, data, decimated=None, read_end=None):
+        raw_plot, signal_plot = self.plots
+        raw_plot.append(data)
+        signal_plot.append(data if decimated is None else decimated)
+        self.read_end = read_end
+        if self.worker is not None:
+            self.worker.delivered()
+
+    def _redraw(self):
+        if not any(plot.dirty for plot in self.plots):
+            return
+        start = time.perf_counter()
+        for plot in self.plots:
+            plot.redraw()
+
+        if self.latency is not None:
+            end = time.perf_counter()
+            self.latency.record('paint', end - start)
+            if self.read_end is not None:
+                # from reading the newest block on screen to drawing it
+                self.latency.record('end_to_end', end - self.read_end)
+
+    def _update_latency(self):
+        if self.latency is not None:
+            text = self.latency.format()
+            if self.worker is not None and self.worker.gui_drops:
+                text += f'\n{self.worker.gui_drops} blocks not plotted while the display was busy'
+            self.latency_label.setText(text)
+
+    def _stream_host(self):
+        '''
+        The persistent acquisition process of the connected backend, started as soon as the
+        backend is connected so sessions start without spawning or warming up a process
+        '''
+        if self.host is not None and self.host.is_alive() and self.host.backend is self.gui_info.backend:
+            return self.host
+        if self.host is not None:
+            self.host.stop()
+        policy, capacity = self.gui_info.queues['display']
+        self.host = StreamHost(self.gui_info, self.shutdown_event, BoundedQueue(capacity, policy))
+        self.host.start()
+        return self.host
 
     def _record_data(self):
         if not self.recording:
+            worker = PhotometryWorker(self.gui_info, self.shutdown_event, self._stream_host())
             self.shutdown_event.clear()
             self.phot_params._update_save_parameters()
-            worker = PhotometryWorker(self.gui_info, self.shutdown_event)
+            self._create_plots()
             worker.signals.new_data.connect(self.update_plots)
             worker.signals.stop_stream.connect(self.stop_stream)
+            self.latency = worker.latency
+            self.worker = worker
             self.threadpool.start(worker)
             self.recording = True
             self.stream_button.setText('Stop streaming')
@@ -190,6 +302,8 @@ class MainWindow(QWidget):
 
     def closeEvent(self, event: PySide6.QtGui.QCloseEvent) -> None:
         self.shutdown_event.set()
+        if self.host is not None:
+            self.host.stop()
         return super().closeEvent(event)
 
     def stop_stream(self):
@@ -1,7 +1,9 @@
-from labjack import ljm
 from serial.tools import list_ports
 from photroller.util import PhotometryController
-from PySide6.QtWidgets import QWidget, QPushButton, QGridLayout, QComboBox, QLabel, QVBoxLayout
+from photroller.backends import LabJackBackend, ReplayT7, SimulatedT7
+from photroller.bmi_process import configure_scan
+from PySide6.QtWidgets import (QWidget, QPushButton, QGridLayout, QComboBox, QLabel, QVBoxLayout, QCheckBox,
+                               QFileDialog)
 
 
 class ConnectArduino(QWidget):
@@ -41,52 +43,64 @@ class ConnectArduino(QWidget):
 
 
 class ConnectLabJack(QWidget):
-    def __init__(self, gui_info, **kwargs):
+    def __init__(self, gui_info, on_connected=None, **kwargs):
         super().__init__(**kwargs)
         self.gui_info = gui_info
+        # called once the backend is set up, e.g. to pre-start the acquisition process
+        self.on_connected = on_connected
         self.initUI()
 
     def initUI(self):
         self.setWindowTitle('Connect to LabJack for data stream')
         layout = QVBoxLayout()
         layout.addWidget(QLabel('Connect a LabJack to this computer and click connect'))
+        self.synthesize = QCheckBox('Synthesize references (frees AIN0/AIN1)')
+        self.synthesize.setChecked(self.gui_info.reference_mode == 'synthesized')
+        layout.addWidget(self.synthesize)
         button = QPushButton('Connect')
         button.clicked.connect(self._connect_labjack)
         layout.addWidget(button)
+        sim_button = QPushButton('Use simulated T7')
+        sim_button.clicked.connect(self._connect_simulator)
+        layout.addWidget(sim_button)
+        # plays a recorded session through the pipeline, to reproduce its workload
+        self.replay_speed = QComboBox()
+        self.replay_speed.addItems(['1x', '2x', '4x', '10x', 'max'])
+        layout.addWidget(self.replay_speed)
+        replay_button = QPushButton('Replay a recorded session')
+        replay_button.clicked.connect(self._connect_replay)
+        layout.addWidget(replay_button)
         self.setLayout(layout)
 
         self.show()
 
     def _connect_labjack(self):
-        handle = ljm.openS('T7', 'ANY', 'ANY')
-        self.gui_info.labjack = handle
-        info = ljm.getHandleInfo(handle)
-        print(f'Labjack device type {info[0]}; connection type {info[1]}')
-        print(f'Serial number {info[2]}; IP address {ljm.numberToIP(info[3])}')
-        print(f'Port: {info[4]}; Max bytes per MB: {info[5]}')
-        # two sinusoids, two pmt signals
-        analog_in_names = [f'AIN{num}' for num in range(4)] + ['FIO_STATE']
-        scan_list = ljm.namesToAddresses(len(analog_in_names), analog_in_names)[0]
-        self.gui_info.scan_list = scan_list
-
-        # disable triggered stream
-        ljm.eWriteName(handle, 'STREAM_TRIGGER_INDEX', 0)
-        # enable internally clocked stream
-        ljm.eWriteName(handle, 'STREAM_CLOCK_SOURCE', 0)
-        # Configure FIO 0-3
-        init_params = {
-            'STREAM_TRIGGER_INDEX': 0,
-            'STREAM_CLOCK_SOURCE': 0,
-            'STREAM_RESOLUTION_INDEX': 4,  # increase this to increase resolution
-            'STREAM_SETTLING_US': 0,
-            'AIN_ALL_NEGATIVE_CH': ljm.constants.GND,
-            'FIO_DIRECTION': 0xF000
-        }
-        for i in range(4):
-            init_params[f'AIN{i}_RANGE'] = 10.0
-
-        ljm.eWriteNames(handle, len(init_params), list(init_params), list(init_params.values()))
-
-        self.gui_info.labjack_init_params = init_params
+        backend = LabJackBackend.connect()
+        self.gui_info.labjack = backend.handle
+        self.gui_info.labjack_init_params = backend.configure()
+        self._set_backend(backend)
+
+    def _connect_simulator(self):
+        self._set_backend(SimulatedT7.from_parameters(self.gui_info.photometry_parameters))
+
+    def _connect_replay(self):
+        path, _ = QFileDialog.getOpenFileName(self, 'Session to replay', filter='Sessions (*.h5)')
+        if not path:
+            return
+        speed = self.replay_speed.currentText()
+        backend = ReplayT7(path, None if speed == 'max' else float(speed.rstrip('x')))
+        # streamed as it was recorded
+        self.gui_info.scan_rate = backend.scan_rate
+        if backend.scans_per_read:
+            self.gui_info.scans_per_read = backend.scans_per_read
+        self.gui_info.photometry_parameters.update(backend.photometry_parameters)
+        self.synthesize.setChecked(backend.reference_mode == 'synthesized')
+        self._set_backend(backend)
+
+    def _set_backend(self, backend):
+        self.gui_info.reference_mode = 'synthesized' if self.synthesize.isChecked() else 'measured'
+        configure_scan(self.gui_info, backend)
+        if self.on_connected is not None:
+            self.on_connected()
 
         self.close()
@@ -0,0 +1,54 @@
+import numpy as np
+import pyqtgraph as pg
+from photroller.bmi_process import RingBuffer
+
+
+def minmax_decimate(x, y, n_bins):
+    '''
+    Peak-preserving decimation: split the last axis into `n_bins` bins and keep each bin's
+    minimum and maximum, so spikes survive at any zoom. Returns (x, y) with 2 * n_bins points
+    per trace; leftover samples that do not fill a bin at the start are dropped.
+    '''
+    n = y.shape[-1]
+    if n_bins <= 0 or n <= 2 * n_bins:
+        return x, y
+    size = n // n_bins
+    start = n - size * n_bins
+    bins = y[..., start:].reshape(y.shape[:-1] + (n_bins, size))
+    out = np.empty(y.shape[:-1] + (n_bins, 2), dtype=y.dtype)
+    np.min(bins, axis=-1, out=out[..., 0])
+    np.max(bins, axis=-1, out=out[..., 1])
+    x = np.repeat(x[start::size], 2)
+    return x, out.reshape(y.shape[:-1] + (2 * n_bins, ))
+
+
+class ScrollingPlot:
+    '''
+    Keeps the last `window` seconds of some channels and draws them into a PlotWidget.
+    Appending a block only copies it into a RingBuffer; `redraw` decimates the window to
+    the widget's pixel width and updates persistent PlotDataItems in place, so its cost does
+    not depend on the scan rate or on how many blocks arrived since the last redraw.
+    '''
+    def __init__(self, widget: pg.PlotWidget, channels, pens, scan_rate, window=10) -> None:
+        self.widget = widget
+        self.channels = list(channels)
+        self.scan_rate = scan_rate
+        self.buffer = RingBuffer(len(self.channels), int(window * scan_rate))
+        self.items = [widget.plot(pen=pen) for pen in pens]
+        widget.setLabel('bottom', 'time', units='s')
+        self.dirty = False
+
+    def append(self, data) -> None:
+        self.buffer.append(data[self.channels])
+        self.dirty = True
+
+    def redraw(self) -> None:
+        if not self.dirty:
+            return
+        n = min(self.buffer.n_written, self.buffer.n_samples)
+        y = self.buffer.view(n)
+        x = (self.buffer.n_written - n + np.arange(n)) / self.scan_rate
+        x, y = minmax_decimate(x, y, max(1, self.widget.width() // 2))
+        for item, trace in zip(self.items, y):
+            item.setData(x, trace)
+        self.dirty = False
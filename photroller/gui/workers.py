@@ -1,39 +1,106 @@
 import h5py
 import time
-import multiprocess as mp
+import queue
+import threading
 from toolz import dissoc
 from photroller.util import dict_to_h5
-from photroller.bmi_process import Stream
+from photroller.bmi_process import Stream, make_rings
+from photroller.transport import BoundedQueue
+from photroller.writer import open_finished
+from photroller.latency import LatencyStats
 from PySide6.QtCore import QRunnable, Signal, QObject, Slot
 
 
 class PhotometryUpdateSignal(QObject):
-    new_data = Signal(object)
+    # block, its decimated demodulated channels (or None), and the monotonic time it was read
+    # from the device
+    new_data = Signal(object, object, float)
     stop_stream = Signal()
 
 
 class PhotometryWorker(QRunnable):
 
-    def __init__(self, gui_info, shutdown_event) -> None:
+    def __init__(self, gui_info, shutdown_event, host=None) -> None:
+        '''
+        Runs a session in `host`, a started StreamHost, or else in a Stream process of its own.
+        Create it when the session is asked for: the delay to the first sample is measured
+        from then.
+        '''
         super().__init__()
+        self.requested_at = time.time()
         self.gui_info = gui_info
+        self.host = host
         self.signals = PhotometryUpdateSignal()
-        self.queue = mp.Queue()
+        queues = gui_info.queues
+        if host is not None:
+            self.queue = host.queue
+        else:
+            self.queue = BoundedQueue(queues['display'][1], queues['display'][0])
+        # blocks emitted to the GUI thread and not plotted yet; further blocks are skipped, as
+        # queued Qt signals would otherwise pile up while the GUI is busy
+        self.in_flight = threading.BoundedSemaphore(queues['gui'][1])
+        self.gui_drops = 0
         self.shutdown_event = shutdown_event
+        # stream stages arrive with each block; the GUI adds paint and end_to_end
+        self.latency = LatencyStats()
+
+    def delivered(self):
+        '''Called by the GUI thread once it has taken an emitted block'''
+        try:
+            self.in_flight.release()
+        except ValueError:
+            # a block emitted by the previous session's worker
+            pass
 
     @Slot()
     def run(self):
         duration = self.gui_info.saving_parameters['duration'] * 60  # seconds
         save_path = self.gui_info.saving_parameters['save_path']
-        with h5py.File(save_path, 'w') as h5f:
+        # the writer puts the file in SWMR mode, which needs the latest file format
+        with h5py.File(save_path, 'w', libver='latest') as h5f:
             dict_to_h5(h5f, dissoc(self.gui_info.saving_parameters, 'save_path'), 'metadata')
             dict_to_h5(h5f, self.gui_info.photometry_parameters, 'metadata/photometry')
-        process = Stream(self.queue, self.shutdown_event, self.gui_info)
-        process.start()
+        ring, decimated_ring = make_rings(self.gui_info)
+        if self.host is not None:
+            self.queue.clear()
+            session = self.host.submit(self.gui_info, ring, decimated_ring, self.requested_at)
+        else:
+            process = Stream(self.queue, ring, self.shutdown_event, self.gui_info,
+                             decimated_ring=decimated_ring, requested_at=self.requested_at)
+            process.start()
         timer = time.time()
         while not self.shutdown_event.is_set():
-            data = self.queue.get(block=True, timeout=None)
-            self.signals.new_data.emit(data)
+            try:
+                # wake up now and then, as the stream stops announcing blocks once shut down
+                seq, _, laps = self.queue.get(block=True, timeout=0.5)
+            except queue.Empty:
+                continue
+            read_end = laps.pop('read_end')
+            self.latency.update(laps)
+            # a copy: the signal is queued to the GUI thread, and a view could be overwritten
+            # by a later block before the slot runs
+            if self.in_flight.acquire(blocking=False):
+                decimated = None if decimated_ring is None else decimated_ring.read(seq, copy=True)
+                self.signals.new_data.emit(ring.read(seq, copy=True), decimated, read_end)
+            else:
+                self.gui_drops += 1
             # stop recording data if we've exceeded the session's duration
             if (time.time() - timer) > duration:
                 self.signals.stop_stream.emit()
+        if self.host is not None:
+            self.host.wait(session)
+        else:
+            process.join()
+        ring.close()
+        if decimated_ring is not None:
+            decimated_ring.close()
+        # the stream and writer processes save their own stages
+        with open_finished(save_path) as h5f:
+            dict_to_h5(h5f, self.latency.summary(('paint', 'end_to_end')), 'metadata/latency')
+            policy, capacity = self.gui_info.queues['gui']
+            dict_to_h5(h5f, dict(policy=policy, capacity=capacity, drops=self.gui_drops),
+                       'metadata/queues/gui')
+            controller = self.gui_info.photometry_controller
+            if controller is not None and controller.updates(self.requested_at):
+                # parameter changes made while recording, with the times the controller confirmed them
+                dict_to_h5(h5f, controller.updates(self.requested_at), 'metadata/photometry/updates')
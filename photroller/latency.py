@@ -0,0 +1,151 @@
+import math
+import time
+import numpy as np
+
+# stages of the acquisition pipeline, in the order a block passes through them
+STAGES = ('read', 'deinterleave', 'buffer', 'demodulate', 'feedback', 'enqueue', 'hdf5_write', 'paint',
+          'end_to_end')
+
+
+class LatencyHistogram:
+    '''
+    Fixed-bucket histogram of durations in seconds. Buckets are log-spaced, `per_decade`
+    of them per decade between `low` and `high`, plus an underflow and an overflow bucket,
+    so recording is a log10 and an increment and memory use does not grow with the
+    session. Percentiles are resolved to the upper edge of a bucket (~12% wide by default).
+    '''
+    def __init__(self, low=1e-6, high=10, per_decade=20) -> None:
+        self.log_low = math.log10(low)
+        self.per_decade = per_decade
+        self.n_buckets = int(round((math.log10(high) - self.log_low) * per_decade))
+        self.edges = low * 10 ** (np.arange(self.n_buckets + 1) / per_decade)
+        # a list increments faster than a numpy array from python
+        self.counts = [0] * (self.n_buckets + 2)
+        self.count = 0
+        self.total = 0.
+        self.min = math.inf
+        self.max = 0.
+        self.last = 0.
+
+    def record(self, seconds) -> None:
+        if seconds > 0:
+            i = int((math.log10(seconds) - self.log_low) * self.per_decade) + 1
+            i = min(max(i, 0), self.n_buckets + 1)
+        else:
+            i = 0
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        if self.count == 0:
+            return math.nan
+        i = int(np.searchsorted(np.cumsum(self.counts), q / 100 * self.count))
+        if i == 0:
+            return self.edges[0]
+        if i > self.n_buckets:
+            return self.max
+        return min(self.edges[i], self.max)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else math.nan
+
+    def summary(self):
+        return dict(
+            count=self.count, mean_s=self.mean, last_s=self.last,
+            min_s=self.min if self.count else math.nan, max_s=self.max,
+            p50_s=self.percentile(50), p90_s=self.percentile(90),
+            p99_s=self.percentile(99), p999_s=self.percentile(99.9),
+            bucket_edges_s=self.edges, bucket_counts=np.array(self.counts, dtype=np.int64),
+        )
+
+
+class LatencyStats:
+    '''
+    One LatencyHistogram per pipeline stage. Each process records the stages it runs and
+    saves their summaries under metadata/latency in the session file.
+    '''
+    def __init__(self, stages=STAGES, **kwargs) -> None:
+        self.histograms = {stage: LatencyHistogram(**kwargs) for stage in stages}
+
+    def __getitem__(self, stage):
+        return self.histograms[stage]
+
+    def record(self, stage, seconds) -> None:
+        self.histograms[stage].record(seconds)
+
+    def update(self, durations) -> None:
+        '''Record a {stage: seconds} mapping, e.g. the laps of one block'''
+        for stage, seconds in durations.items():
+            self.histograms[stage].record(seconds)
+
+    def summary(self, stages=None):
+        '''Summaries of the stages that recorded anything'''
+        return {stage: h.summary() for stage, h in self.histograms.items()
+                if h.count and (stages is None or stage in stages)}
+
+    def format(self):
+        lines = [f"{'stage':<13}{'last':>9}{'p50':>9}{'p99':>9}{'max':>9}  (ms)"]
+        for stage, h in self.histograms.items():
+            if h.count:
+                lines.append(f'{stage:<13}{h.last * 1e3:9.3f}{h.percentile(50) * 1e3:9.3f}'
+                             f'{h.percentile(99) * 1e3:9.3f}{h.max * 1e3:9.3f}')
+        return '\n'.join(lines)
+
+
+class Laps:
+    '''Times consecutive stages with one monotonic clock read per stage'''
+    def __init__(self) -> None:
+        self.durations = {}
+        self.last = time.perf_counter()
+
+    def lap(self, stage) -> float:
+        '''Close `stage`, returning the time it ended'''
+        now = time.perf_counter()
+        self.durations[stage] = now - self.last
+        self.last = now
+        return now
+
+
+class CpuLoad:
+    '''
+    CPU time the calling process uses per second of wall time: the fraction of a core it
+    keeps busy, from 0 to 1 for a single-threaded loop. What is left of the core is its
+    headroom; a stream pinned to a core falls behind real time as its load approaches 1.
+    `shared`, an optional mp.Value('d'), receives each load so another process can follow it.
+    '''
+    def __init__(self, shared=None) -> None:
+        self.shared = shared
+        self.start_cpu = self.cpu = time.process_time()
+        self.start_wall = self.wall = time.perf_counter()
+        self.last = 0.
+        self.max = 0.
+
+    def update(self) -> float:
+        '''Load since the previous update'''
+        cpu, wall = time.process_time(), time.perf_counter()
+        if wall > self.wall:
+            self.last = (cpu - self.cpu) / (wall - self.wall)
+            self.max = max(self.max, self.last)
+        self.cpu, self.wall = cpu, wall
+        if self.shared is not None:
+            self.shared.value = self.last
+        return self.last
+
+    @property
+    def mean(self):
+        wall = self.wall - self.start_wall
+        return (self.cpu - self.start_cpu) / wall if wall > 0 else 0.
+
+    def summary(self):
+        return dict(cpu_seconds=self.cpu - self.start_cpu, wall_seconds=self.wall - self.start_wall,
+                    mean_load=self.mean, max_load=self.max, headroom=1 - self.max)
+
+    def format(self):
+        return f'CPU load {self.last:.1%} of a core (mean {self.mean:.1%}, max {self.max:.1%})'
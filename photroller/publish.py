@@ -0,0 +1,240 @@
+import os
+import json
+import time
+import socket
+import struct
+import threading
+import numpy as np
+from collections import deque, namedtuple
+from photroller.latency import LatencyHistogram
+
+# magic, frame kind, n_channels, sequence number, first scan, host timestamp, payload bytes
+HEADER = struct.Struct('<4sBHQqdI')
+MAGIC = b'PHT1'
+HELLO, BLOCK = 0, 1
+
+Block = namedtuple('Block', 'seq first_scan timestamp data latency')
+
+
+def _family(address):
+    '''(socket family, address) for 'host:port' (TCP) or a filesystem path (Unix domain socket)'''
+    if isinstance(address, tuple):
+        return socket.AF_INET, address
+    host, sep, port = str(address).rpartition(':')
+    if sep and port.isdigit():
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+    return socket.AF_UNIX, str(address)
+
+
+def frame(kind, payload, seq=0, first_scan=0, timestamp=0., n_channels=0):
+    return HEADER.pack(MAGIC, kind, n_channels, seq, first_scan, timestamp, len(payload)) + payload
+
+
+class _Subscription:
+    '''One connected client: a bounded queue of frames drained by its own sender thread'''
+    def __init__(self, conn, max_blocks) -> None:
+        self.conn = conn
+        self.frames = deque(maxlen=max_blocks)
+        self.ready = threading.Condition()
+        self.dropped = 0
+        self.sent = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self._send, daemon=True)
+
+    def put(self, data):
+        with self.ready:
+            if len(self.frames) == self.frames.maxlen:
+                # the deque drops its oldest frame
+                self.dropped += 1
+            self.frames.append(data)
+            self.ready.notify()
+
+    def _send(self):
+        try:
+            while True:
+                with self.ready:
+                    while not self.frames and not self.closed:
+                        self.ready.wait()
+                    if not self.frames:
+                        # closed, and everything queued was sent
+                        return
+                    data = self.frames.popleft()
+                self.conn.sendall(data)
+                self.sent += 1
+        except OSError:
+            # client went away
+            self.closed = True
+        finally:
+            self.conn.close()
+
+    def close(self, timeout=1.):
+        '''Send what is queued, waiting up to `timeout` seconds, then disconnect'''
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+        self.thread.join(timeout)
+
+
+class Publisher:
+    '''
+    Broadcasts stream blocks to any number of local subscribers over TCP ('host:port') or a
+    Unix domain socket (a path).
+
+    Every frame is a fixed HEADER followed by its payload. A new subscriber first gets a HELLO
+    frame whose payload is JSON metadata (channel names, rate, decimation, ...), then a BLOCK
+    frame per block: sequence number, first scan, host timestamp (time.time) and the
+    (n_channels, n_scans) samples as little-endian float32, channel-major.
+
+    `publish` encodes a block once and only appends it to each subscriber's queue of
+    `max_blocks` frames; sending happens in one thread per subscriber. A subscriber that falls
+    behind loses its oldest frames, which it sees as gaps in the sequence numbers, and never
+    stalls the caller.
+    '''
+    def __init__(self, address, max_blocks=64, **metadata) -> None:
+        self.address = address
+        self.max_blocks = max_blocks
+        self.metadata = metadata
+        self.subscriptions = []
+        self.n_connections = 0
+        self.n_blocks = 0
+        # blocks dropped for subscribers that have disconnected
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self):
+        family, address = _family(self.address)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.unlink(address)
+        self.server = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(address)
+        self.server.listen()
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def _accept(self):
+        hello = frame(HELLO, json.dumps(self.metadata).encode())
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                # server closed
+                return
+            if conn.family == socket.AF_INET:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                # sent before the subscription exists, so it cannot be dropped
+                conn.sendall(hello)
+            except OSError:
+                conn.close()
+                continue
+            sub = _Subscription(conn, self.max_blocks)
+            sub.thread.start()
+            with self.lock:
+                self.subscriptions.append(sub)
+                self.n_connections += 1
+
+    def publish(self, seq, first_scan, timestamp, data) -> None:
+        '''Queue a (n_channels, n_scans) block for every subscriber'''
+        with self.lock:
+            if any(s.closed for s in self.subscriptions):
+                self.dropped += sum(s.dropped for s in self.subscriptions if s.closed)
+                self.subscriptions = [s for s in self.subscriptions if not s.closed]
+            subscriptions = self.subscriptions
+        self.n_blocks += 1
+        if not subscriptions:
+            return
+        payload = np.ascontiguousarray(data, dtype='<f4').tobytes()
+        block = frame(BLOCK, payload, seq, first_scan, timestamp, data.shape[0])
+        for sub in subscriptions:
+            sub.put(block)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            if self.server.family == socket.AF_UNIX:
+                os.unlink(_family(self.address)[1])
+            self.server = None
+        with self.lock:
+            for sub in self.subscriptions:
+                sub.close()
+
+    def summary(self):
+        '''Connection and drop counts for the session file'''
+        with self.lock:
+            dropped = self.dropped + sum(s.dropped for s in self.subscriptions)
+        return dict(address=str(self.address), max_blocks=self.max_blocks, n_blocks=self.n_blocks,
+                    n_connections=self.n_connections, dropped_blocks=dropped)
+
+
+class Subscriber:
+    '''
+    Client for a Publisher. Iterating yields a Block per frame with its samples as a
+    (n_channels, n_scans) array and its latency, the time from the publisher's timestamp to
+    its arrival. Blocks the publisher dropped for this client are counted in `dropped`.
+
+        with Subscriber('127.0.0.1:5556') as sub:
+            print(sub.metadata['channels'])
+            for block in sub:
+                ...
+    '''
+    def __init__(self, address, timeout=None) -> None:
+        family, address = _family(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(address)
+        self.file = self.sock.makefile('rb')
+        self.latency = LatencyHistogram()
+        self.dropped = 0
+        self.received = 0
+        self.last_seq = None
+        kind, *_, payload = self._read_frame()
+        if kind != HELLO:
+            raise ValueError('Expected a HELLO frame first')
+        self.metadata = json.loads(payload)
+
+    def _read_frame(self):
+        header = self.file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise EOFError('Publisher closed the stream')
+        magic, kind, n_channels, seq, first_scan, timestamp, nbytes = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError(f'Bad frame magic {magic!r}; not a photroller stream?')
+        payload = self.file.read(nbytes)
+        if len(payload) < nbytes:
+            raise EOFError('Publisher closed the stream')
+        return kind, n_channels, seq, first_scan, timestamp, payload
+
+    def recv(self) -> Block:
+        '''Next block; raises EOFError once the publisher is gone'''
+        kind, n_channels, seq, first_scan, timestamp, payload = self._read_frame()
+        latency = time.time() - timestamp
+        self.latency.record(latency)
+        if self.last_seq is not None and seq > self.last_seq + 1:
+            self.dropped += seq - self.last_seq - 1
+        self.last_seq = seq
+        self.received += 1
+        data = np.frombuffer(payload, dtype='<f4').reshape(n_channels, -1)
+        return Block(seq, first_scan, timestamp, data, latency)
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.recv()
+            except EOFError:
+                return
+
+    def summary(self):
+        return dict(received=self.received, dropped=self.dropped, latency=self.latency.summary())
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
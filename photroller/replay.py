@@ -0,0 +1,159 @@
+'''
+Replays a recorded session through the live pipeline, to reproduce a rig's workload at a desk.
+
+A `backends.ReplayT7` stands in for the T7 and feeds a `Stream` process, which demodulates,
+decimates and writes a new session file exactly as when recording, while this process takes
+each announced block out of the shared ring like the GUI's PhotometryWorker does. Played at
+the recorded rate or `speed` times faster, a replay shows whether the pipeline keeps up at
+that speed; unpaced (speed None), how much faster than real time it can go.
+
+    for speed in (1, 4, None):
+        print(format_result(replay('photometry_session.h5', speed)))
+'''
+import os
+import time
+import queue
+import tempfile
+import threading
+import h5py
+import numpy as np
+import multiprocess as mp
+from os.path import abspath
+from toolz import dissoc
+from photroller.util import dict_to_h5
+from photroller.backends import ReplayT7
+from photroller.bmi_process import Backlog, Stream, configure_scan, make_rings
+from photroller.latency import LatencyStats
+from photroller.rigs import Rig
+from photroller.transport import BoundedQueue
+from photroller.writer import BLOCK_COLUMNS, open_finished
+
+
+def replay_info(backend, **settings):
+    '''
+    Session settings (a `rigs.Rig`, which stands in for GUIInfo) replaying `backend`'s
+    recording as it was recorded; `settings` override any of them, e.g. lockin_mode
+    '''
+    info = Rig(name='replay', **settings)
+    info.scan_rate = backend.scan_rate
+    if 'scans_per_read' not in settings and backend.scans_per_read:
+        info.scans_per_read = backend.scans_per_read
+    info.photometry_parameters.update(backend.photometry_parameters)
+    info.reference_mode = backend.reference_mode
+    configure_scan(info, backend)
+    return info
+
+
+def replay(path, speed=1., save_path=None, duration=None, report_interval=10, **settings):
+    '''
+    Play the session at `path` through a Stream at `speed` times its scan rate (None for as
+    fast as possible) until the recording or `duration` seconds run out, and return the
+    `summarize` of the session it records to `save_path` (a temporary file by default).
+    `settings` are passed on to `replay_info`.
+    '''
+    shutdown_event = mp.Event()
+    backend = ReplayT7(path, speed, end_event=shutdown_event)
+    info = replay_info(backend, **settings)
+    keep = save_path is not None
+    if not keep:
+        fd, save_path = tempfile.mkstemp(suffix='.h5', prefix='replay_')
+        os.close(fd)
+    info.saving_parameters = dict(info.saving_parameters, save_path=save_path, duration=0)
+    with h5py.File(save_path, 'w', libver='latest') as h5f:
+        dict_to_h5(h5f, dissoc(info.saving_parameters, 'save_path'), 'metadata')
+        dict_to_h5(h5f, info.photometry_parameters, 'metadata/photometry')
+        dict_to_h5(h5f, dict(source=abspath(path), speed=speed), 'metadata/replay')
+
+    ring, decimated_ring = make_rings(info)
+    display = BoundedQueue(info.queues['display'][1], info.queues['display'][0])
+    stream = Stream(display, ring, shutdown_event, info, report_interval=report_interval,
+                    decimated_ring=decimated_ring)
+    timer = None
+    if duration is not None:
+        timer = threading.Timer(duration, shutdown_event.set)
+        timer.start()
+    stream.start()
+    # the display side of PhotometryWorker, without the GUI
+    latency = LatencyStats()
+    try:
+        while not shutdown_event.is_set():
+            try:
+                seq, _, laps = display.get(block=True, timeout=0.5)
+            except queue.Empty:
+                continue
+            read_end = laps.pop('read_end')
+            latency.update(laps)
+            ring.read(seq, copy=True)
+            if decimated_ring is not None:
+                decimated_ring.read(seq, copy=True)
+            latency.record('end_to_end', time.perf_counter() - read_end)
+    finally:
+        shutdown_event.set()
+        if timer is not None:
+            timer.cancel()
+        stream.join()
+        ring.close()
+        if decimated_ring is not None:
+            decimated_ring.close()
+    with open_finished(save_path) as h5f:
+        dict_to_h5(h5f, latency.summary(('end_to_end', )), 'metadata/latency')
+    result = summarize(save_path)
+    if not keep:
+        os.remove(save_path)
+        result['path'] = None
+    return result
+
+
+def summarize(path):
+    '''
+    How the pipeline coped with a replay recorded to `path`: the speed it actually ran at,
+    the backlog and degradation levels, and the latencies of demodulation and of blocks
+    reaching the display. It keeps up if, once past the start-up, the backlog stays under a
+    read (paced), or if it runs at least at real time (unpaced).
+    '''
+    with h5py.File(path, 'r') as h5f:
+        replayed = h5f['metadata/replay']
+        speed = replayed['speed'][()]
+        speed = None if isinstance(speed, h5py.Empty) else float(speed)
+        scan_rate = float(h5f['metadata/writer/scan_rate'][()])
+        table = h5f['blocks'][:]
+        blocks = {c: table[:, i] for i, c in enumerate(BLOCK_COLUMNS)}
+        latency = h5f['metadata/latency']
+        queues = h5f['metadata/queues']
+        result = dict(
+            path=path, source=replayed['source'][()].decode(), speed=speed, scan_rate=scan_rate,
+            n_blocks=len(table), seconds=float(blocks['n_scans'].sum() / scan_rate),
+            demodulate_p99_s=float(latency['demodulate/p99_s'][()]),
+            end_to_end_p99_s=float(latency['end_to_end/p99_s'][()]) if 'end_to_end' in latency else np.nan,
+            writer_blocked_s=float(queues['writer/blocked_seconds'][()]),
+            display_drops=int(queues['display/drops'][()]),
+            max_load=float(h5f['metadata/cpu/max_load'][()]),
+        )
+    backlog = (blocks['device_backlog'] + blocks['ljm_backlog']) / scan_rate
+    # the first block's scans were played before its host_time
+    played = blocks['n_scans'][1:].sum() / scan_rate
+    elapsed = blocks['host_time'][-1] - blocks['host_time'][0]
+    read = np.median(blocks['n_scans']) / scan_rate
+    result.update(
+        achieved_speed=float(played / elapsed) if elapsed > 0 else np.nan,
+        max_backlog_s=float(backlog.max()),
+        max_level=int(blocks['degrade_level'].max()),
+        degraded_fraction=float((blocks['degrade_level'] > 0).mean()),
+        lost_blocks=int((blocks['file_row'] < 0).sum()),
+    )
+    if speed is None:
+        result['keeps_up'] = bool(result['achieved_speed'] >= 1)
+    else:
+        result['keeps_up'] = bool(backlog[len(backlog) // 2:].max() < Backlog.thresholds[0] * read
+                                  and result['lost_blocks'] == 0)
+    return result
+
+
+def format_result(r):
+    speed = 'unpaced' if r['speed'] is None else f"{r['speed']:g}x"
+    verdict = 'keeps up' if r['keeps_up'] else 'FALLS BEHIND'
+    return (f"{speed:>8}: {verdict:<12} {r['seconds']:7.1f} s of recording at {r['achieved_speed']:6.2f}x, "
+            f"backlog max {r['max_backlog_s'] * 1e3:6.0f} ms, degraded {r['degraded_fraction']:4.0%} "
+            f"(level {r['max_level']}), demodulate p99 {r['demodulate_p99_s'] * 1e3:6.2f} ms, "
+            f"end-to-end p99 {r['end_to_end_p99_s'] * 1e3:6.2f} ms, CPU max {r['max_load']:4.0%}, "
+            f"{r['display_drops']} display drops")
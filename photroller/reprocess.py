@@ -0,0 +1,150 @@
+import time
+import h5py
+import numpy as np
+import multiprocess as mp
+from collections import deque
+from scipy import signal
+from photroller.util import firmware_frequency
+from photroller.bmi_process import LockIn
+from photroller.writer import compression_kwargs, chunk_rows
+
+
+def settling_samples(sos, n_max, tol=1e-4):
+    '''Samples until the impulse response of `sos` stays below `tol` of its peak'''
+    impulse = np.zeros(n_max)
+    impulse[0] = 1
+    h = np.abs(signal.sosfilt(sos, impulse))
+    above = np.flatnonzero(h > tol * h.max())
+    return int(above[-1]) + 1 if len(above) else 1
+
+
+def _demodulate_chunk(lockin, chunk, pad_left, pad_right):
+    # every chunk starts from fresh filter states; the padding absorbs their transients
+    lockin.reset()
+    out = lockin(chunk.T)
+    return out[:, pad_left:out.shape[1] - pad_right].T.astype(np.float32)
+
+
+def _names(dset):
+    return [c.decode() if isinstance(c, bytes) else str(c) for c in dset.attrs.get('channels', [])]
+
+
+def saved_references(path):
+    '''
+    The raw_photometry columns that held the references of the session at `path`, read from
+    the saved channel names: the demodulated columns (e.g. AIN2_ref1) name the signals, and
+    every other raw column is a reference. None when the session synthesised its references,
+    and (0, 1) for sessions recorded before channel names were saved.
+    '''
+    with h5py.File(path, 'r') as h5f:
+        raw = _names(h5f['raw_photometry'])
+        demodulated = _names(h5f['demodulated']) if 'demodulated' in h5f else []
+    signals = {name.rsplit('_ref', 1)[0] for name in demodulated if '_ref' in name}
+    if not raw or not signals:
+        return (0, 1)
+    return tuple(i for i, name in enumerate(raw) if name not in signals) or None
+
+
+def check_columns(raw, signals, references):
+    '''
+    The signal columns of `raw` (by default every column that is not a reference), after
+    checking that every signal and reference is a column of it
+    '''
+    n_columns = raw.shape[1]
+    names = _names(raw)
+    references = list(references or [])
+    if signals is None:
+        signals = [c for c in range(n_columns) if c not in references]
+    for role, columns in (('signal', signals), ('reference', references)):
+        for c in columns:
+            if not 0 <= c < n_columns:
+                described = f" ({', '.join(names)})" if names else ''
+                raise ValueError(f'No {role} column {c}: raw_photometry has {n_columns} columns{described}')
+    if not signals:
+        raise ValueError('No signal columns to demodulate')
+    return tuple(signals)
+
+
+def reprocess(path, dest='reprocessed/demodulated', freqs=None, signals=None, references=(0, 1),
+              bw=60, lowpass_cutoff=15, mode='offline', scan_rate=None, chunk_seconds=60,
+              n_workers=None, codec='gzip', codec_level=None, overwrite=False):
+    '''
+    Re-demodulate the raw_photometry of a recorded session into the dataset `dest`.
+
+    The session is read in chunks of `chunk_seconds`, each padded on both sides by the
+    settling time of the lock-in filters, and the chunks are demodulated in a process pool.
+    Trimming the padding stitches them together without seams. At most two chunks per
+    worker are in flight, so memory use does not depend on the session length.
+
+    `freqs` default to the session's photometry freq1, freq2, ... and `scan_rate` to the rate
+    the writer recorded. `signals` default to every column of raw_photometry that is not a
+    reference. With `references=None` the references are synthesised, for sessions recorded
+    without them. Returns the number of scans processed.
+    '''
+    n_workers = n_workers or mp.cpu_count()
+    with h5py.File(path, 'r+') as h5f:
+        raw = h5f['raw_photometry']
+        metadata = h5f['metadata']
+        if scan_rate is None:
+            if 'writer/scan_rate' not in metadata:
+                raise ValueError(f'{path} does not record its scan rate; pass it explicitly')
+            scan_rate = float(metadata['writer/scan_rate'][()])
+        signals = check_columns(raw, signals, references)
+        # metadata/photometry/updates holds the changes made while recording
+        params = {k: float(v[()]) for k, v in metadata['photometry'].items() if isinstance(v, h5py.Dataset)}
+        n_leds = sum(k.startswith('freq') for k in params) if references is None else len(references)
+        levels = None
+        if references is None:
+            levels = [(params[f'amp{i + 1}'], params[f'offset{i + 1}']) for i in range(n_leds)]
+        if not freqs:
+            freqs = [params[f'freq{i + 1}'] for i in range(n_leds)]
+            if references is None:
+                freqs = [firmware_frequency(f) for f in freqs]
+        lockin = LockIn(freqs, fs=scan_rate, bw=bw, lowpass_cutoff=lowpass_cutoff, mode=mode,
+                        signals=signals, references=references, levels=levels)
+
+        n = len(raw)
+        step = max(1, int(chunk_seconds * scan_rate))
+        n_max = int(10 * scan_rate)
+        overlap = (max(settling_samples(sos, n_max) for sos in lockin.bandpass_sos)
+                   + settling_samples(lockin.lowpass_sos, n_max))
+
+        if dest in h5f and not overwrite:
+            raise ValueError(f'{dest} already exists in {path}')
+        # written under a temporary name and moved to dest once complete, so a failed or
+        # interrupted run leaves no half-written dest in the way of the next one
+        partial = dest + '.partial'
+        if partial in h5f:
+            del h5f[partial]
+        rows = min(max(n, 1), chunk_rows(lockin.n_outputs))
+        out = h5f.create_dataset(partial, shape=(n, lockin.n_outputs), dtype=np.float32,
+                                 chunks=(rows, lockin.n_outputs), **compression_kwargs(codec, codec_level))
+        out.attrs.update(freqs=freqs, signals=signals, references=references or [], bw=bw,
+                         lowpass_cutoff=lowpass_cutoff, mode=mode, scan_rate=scan_rate,
+                         overlap=overlap, time=time.time())
+
+        def collect():
+            start, result = pending.popleft()
+            block = result.get()
+            out[start:start + len(block)] = block
+
+        try:
+            with mp.Pool(n_workers) as pool:
+                pending = deque()
+                for start in range(0, n, step):
+                    stop = min(n, start + step)
+                    lo = max(0, start - overlap)
+                    hi = min(n, stop + overlap)
+                    args = (lockin, raw[lo:hi], start - lo, hi - stop)
+                    pending.append((start, pool.apply_async(_demodulate_chunk, args)))
+                    if len(pending) >= 2 * n_workers:
+                        collect()
+                while pending:
+                    collect()
+        except BaseException:
+            del h5f[partial]
+            raise
+        if dest in h5f:
+            del h5f[dest]
+        h5f.move(partial, dest)
+    return n
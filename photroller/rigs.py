@@ -0,0 +1,326 @@
+'''
+Several rigs on one workstation, each a T7 and the photometry controller lighting its LEDs,
+run from a single supervisor process instead of a GUI per rig.
+
+Rigs are paired in a YAML file. `defaults` apply to every rig, and each rig overrides what it
+needs (dict settings such as photometry_parameters are merged key by key):
+
+    defaults:
+      scan_rate: 3000
+      save_dir: /data/photometry
+      saving_parameters: {duration: 30}
+    rigs:
+      - name: rig1
+        labjack: 470012345      # T7 serial number, see `photroller discover`
+        arduino: /dev/ttyACM0   # serial port, or the board's USB serial number
+        cpu: 2                  # optional, see assign_cores
+      - name: rig2
+        labjack: 470012346
+        arduino: 95735353032351A0E1C1
+        photometry_parameters: {freq1: 131, freq2: 281}
+
+`labjack: simulated` runs a rig on a SimulatedT7, and a rig without `arduino` leaves the
+controller alone.
+'''
+import os
+import time
+import queue
+import signal
+import datetime
+import threading
+import h5py
+import multiprocess as mp
+from os.path import join
+from dataclasses import dataclass, field, fields
+from toolz import dissoc, merge
+from serial.tools import list_ports
+from photroller.util import PhotometryController, dict_to_h5
+from photroller.backends import LabJackBackend, SimulatedT7, ljm
+from photroller.bmi_process import StreamHost, configure_scan, make_rings, set_affinity
+from photroller.latency import LatencyHistogram
+from photroller.transport import BoundedQueue
+
+# USB vendor ids of Arduino boards, and of the CH340 bridge on common clones
+ARDUINO_VIDS = (0x2341, 0x2A03, 0x1A86)
+# load above which a rig is reported as short of headroom on its core
+MAX_LOAD = 0.8
+
+
+def discover_labjacks():
+    '''Serial numbers of the attached T7s, over any connection type'''
+    if ljm is None:
+        raise RuntimeError('Finding LabJacks needs the labjack-ljm package')
+    n, _, _, serials, _ = ljm.listAll(ljm.constants.dtT7, ljm.constants.ctANY)
+    # a T7 on both USB and ethernet is listed twice
+    return sorted(set(serials[:n]))
+
+
+def discover_arduinos():
+    '''{serial port: USB serial number} of the attached Arduinos'''
+    return {port.device: port.serial_number for port in list_ports.comports() if port.vid in ARDUINO_VIDS}
+
+
+@dataclass
+class Rig:
+    '''
+    Configuration of one rig, which also stands in for the GUI's GUIInfo in its sessions:
+    `connect_rig` fills in the backend, controller and scan list.
+    '''
+    name: str
+    labjack: str = 'ANY'  # serial number; 'ANY' for the only T7 attached, or 'simulated'
+    arduino: str = None  # serial port or USB serial number of the photometry controller
+    cpu: int = None  # core the rig's acquisition loop is pinned to
+    save_dir: str = '.'
+    photometry_parameters: dict = field(default_factory=lambda: dict(
+                                          freq1=101, freq2=237,
+                                          amp1=3, amp2=1,
+                                          offset1=0.1, offset2=0.1))
+    scan_rate: int = 3000  # samples per second
+    scans_per_read: int = 1500  # samples
+    lockin_mode: str = 'stream'
+    reference_mode: str = 'measured'
+    recalibrate_interval: float = 60
+    demod_kernel: str = 'auto'
+    output_rate: float = 200
+    queues: dict = field(default_factory=lambda: dict(
+        writer=('block', None),
+        display=('drop_oldest', 4),
+    ))
+    publish_address: str = None
+    saving_parameters: dict = field(default_factory=lambda: dict(
+        duration=30,  # minutes
+        codec='gzip',
+        codec_level=3,
+        flush_interval=1,
+    ))
+    # set by connect_rig
+    backend = None
+    labjack_init_params = None
+    photometry_controller = None
+    feedback = None
+    scan_list = None
+    scan_names = None
+    lockin_signals = None
+    lockin_references = None
+
+
+def load_rigs(path):
+    '''Rigs configured in the YAML file at `path` (see the module docstring)'''
+    from ruamel.yaml import YAML
+
+    with open(path) as f:
+        config = YAML(typ='safe').load(f)
+    defaults = config.get('defaults') or {}
+    known = {f.name for f in fields(Rig)}
+    rigs = []
+    for entry in config['rigs']:
+        unknown = set(entry) - known
+        if unknown:
+            raise ValueError(f"Unknown settings {sorted(unknown)} for rig {entry.get('name')}")
+        settings = merge(defaults, entry)
+        # dict settings override the defaults key by key
+        for key, value in settings.items():
+            if isinstance(value, dict):
+                settings[key] = merge(getattr(Rig(name=''), key), defaults.get(key, {}), entry.get(key, {}))
+        rigs.append(Rig(**settings))
+    check_rigs(rigs)
+    return rigs
+
+
+def check_rigs(rigs):
+    '''Raise a ValueError if two rigs would share a name, device, core or output'''
+    for attr in ('name', 'labjack', 'arduino', 'cpu', 'publish_address'):
+        values = [getattr(r, attr) for r in rigs if getattr(r, attr) not in (None, 'simulated')]
+        if len(values) != len(set(map(str, values))):
+            raise ValueError(f'Rigs must not share a {attr}: {values}')
+    if len(rigs) > 1 and any(r.labjack == 'ANY' for r in rigs):
+        raise ValueError("labjack: ANY only works with a single rig; use the T7 serial numbers")
+
+
+def assign_cores(rigs, reserved=1):
+    '''
+    Give each rig without a `cpu` one of the cores no other rig is pinned to, from the last
+    one down, keeping the first `reserved` cores for the writers, the supervisor and
+    everything else. Rigs left over once those run out stay unpinned and share the other
+    cores, with a warning; so does every rig where affinity is not supported.
+    '''
+    if not hasattr(os, 'sched_getaffinity'):
+        return rigs
+    cores = sorted(os.sched_getaffinity(0))
+    taken = {r.cpu for r in rigs}
+    free = [c for c in cores[reserved:] if c not in taken]
+    for rig in rigs:
+        if rig.cpu is None:
+            if not free:
+                unpinned = [r.name for r in rigs if r.cpu is None]
+                print(f'Warning: {len(cores)} cores for {len(rigs)} rigs; '
+                      f'leaving {", ".join(unpinned)} unpinned')
+                break
+            rig.cpu = free.pop()
+    return rigs
+
+
+def connect_rig(rig, arduinos=None):
+    '''Open the rig's T7 and controller and set up its scan list'''
+    if str(rig.labjack) == 'simulated':
+        backend = SimulatedT7.from_parameters(rig.photometry_parameters)
+    else:
+        backend = LabJackBackend.connect(str(rig.labjack))
+        rig.labjack_init_params = backend.configure()
+    if rig.arduino is not None:
+        arduinos = discover_arduinos() if arduinos is None else arduinos
+        # the configuration names the port or the board's serial number
+        ports = [p for p, serial in arduinos.items() if str(rig.arduino) in (p, serial)]
+        if not ports:
+            raise ValueError(f'Rig {rig.name}: no Arduino at {rig.arduino}; found {arduinos}')
+        rig.photometry_controller = PhotometryController(rig.photometry_parameters, ports[0])
+    configure_scan(rig, backend)
+    return rig
+
+
+class Supervisor:
+    '''
+    Runs every rig from this process. Each rig gets a `StreamHost`, the acquisition process
+    that keeps its T7 open between sessions and pins its loop to the rig's core; the rest is
+    shared. Writers, the supervisor and its display thread keep to the cores no rig is pinned
+    to, and the display thread follows the blocks of all rigs, which also each publish on
+    their `publish_address` for plotting.
+
+    Every `report_interval` seconds of a recording, `format_report` gives each rig's CPU load
+    and the headroom left on its core, and how many rigs this machine can run at those
+    settings.
+
+        supervisor = Supervisor(load_rigs('rigs.yaml'))
+        supervisor.connect()
+        supervisor.record()
+        supervisor.close()
+    '''
+    def __init__(self, rigs, report_interval=10) -> None:
+        check_rigs(rigs)
+        self.rigs = assign_cores(rigs)
+        self.report_interval = report_interval
+        self.shutdown_event = mp.Event()
+        self.hosts = {}
+        # last load of each rig's acquisition process on its core, see latency.CpuLoad
+        self.loads = {}
+        self.max_loads = {}
+        self.blocks = {}
+        # time spent on each block after reading it, against the time it covers
+        self.processing = {}
+
+    def connect(self):
+        pinned = {r.cpu for r in self.rigs if r.cpu is not None}
+        if pinned and hasattr(os, 'sched_getaffinity'):
+            # whatever is forked from here before pinning itself (the hosts, and the writers
+            # they start) stays off the rigs' cores
+            set_affinity(os.sched_getaffinity(0) - pinned or os.sched_getaffinity(0))
+        arduinos = discover_arduinos() if any(r.arduino is not None for r in self.rigs) else {}
+        for rig in self.rigs:
+            connect_rig(rig, arduinos)
+            self.loads[rig.name] = mp.Value('d', 0.)
+            policy, capacity = rig.queues['display']
+            host = StreamHost(rig, self.shutdown_event, BoundedQueue(capacity, policy),
+                              cpu=rig.cpu, load=self.loads[rig.name])
+            # Ctrl-C stops a recording through the supervisor; the hosts and their writers
+            # inherit this and ignore it, so their sessions end cleanly
+            handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+            try:
+                host.start()
+            finally:
+                signal.signal(signal.SIGINT, handler)
+            self.hosts[rig.name] = host
+            print(f'Rig {rig.name}: T7 {rig.labjack}, controller {rig.arduino}, core {rig.cpu}')
+
+    def record(self, duration=None):
+        '''
+        Record a session on every rig for `duration` minutes (by default the shortest of their
+        saving_parameters durations) or until Ctrl-C; returns the session files
+        '''
+        if duration is None:
+            duration = min(r.saving_parameters['duration'] for r in self.rigs)
+        stamp = datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+        self.shutdown_event.clear()
+        requested_at = time.time()
+        sessions = {}
+        for rig in self.rigs:
+            path = join(rig.save_dir, f'{rig.name}_photometry_session_{stamp}.h5')
+            rig.saving_parameters = dict(rig.saving_parameters, save_path=path)
+            # the writer puts the file in SWMR mode, which needs the latest file format
+            with h5py.File(path, 'w', libver='latest') as h5f:
+                dict_to_h5(h5f, dissoc(rig.saving_parameters, 'save_path'), 'metadata')
+                dict_to_h5(h5f, rig.photometry_parameters, 'metadata/photometry')
+                dict_to_h5(h5f, dict(name=rig.name, labjack=str(rig.labjack), arduino=str(rig.arduino),
+                                     core=-1 if rig.cpu is None else rig.cpu), 'metadata/rig')
+            rings = make_rings(rig)
+            host = self.hosts[rig.name]
+            host.queue.clear()
+            sessions[rig.name] = (host.submit(rig, *rings, requested_at), rings, path)
+            self.max_loads[rig.name] = 0.
+            self.blocks[rig.name] = 0
+            self.processing[rig.name] = LatencyHistogram()
+        display = threading.Thread(target=self._display, daemon=True)
+        display.start()
+        end = time.time() + duration * 60
+        try:
+            while time.time() < end:
+                time.sleep(max(0, min(self.report_interval, end - time.time())))
+                print(self.format_report())
+        except KeyboardInterrupt:
+            print('Stopping the recording')
+        finally:
+            self.shutdown_event.set()
+            for name, (session, rings, _) in sessions.items():
+                self.hosts[name].wait(session)
+                for ring in rings:
+                    if ring is not None:
+                        ring.close()
+            display.join()
+        print(self.format_report())
+        return [path for _, _, path in sessions.values()]
+
+    def _display(self):
+        '''Drain the display queues of all rigs, keeping their block counts and processing times'''
+        while not self.shutdown_event.is_set():
+            idle = True
+            for rig in self.rigs:
+                try:
+                    _, _, laps = self.hosts[rig.name].queue.get(block=False)
+                except queue.Empty:
+                    continue
+                idle = False
+                laps.pop('read_end')
+                self.blocks[rig.name] += 1
+                self.processing[rig.name].record(sum(v for k, v in laps.items() if k != 'read'))
+            for name, load in self.loads.items():
+                self.max_loads[name] = max(self.max_loads.get(name, 0.), load.value)
+            if idle:
+                time.sleep(0.01)
+
+    def format_report(self):
+        lines = []
+        for rig in self.rigs:
+            name = rig.name
+            load, max_load = self.loads[name].value, self.max_loads.get(name, 0.)
+            block = rig.scans_per_read / rig.scan_rate
+            processing = self.processing.get(name)
+            p99 = processing.percentile(99) if processing is not None and processing.count else 0.
+            line = (f'{name} (core {rig.cpu}): {self.blocks.get(name, 0)} blocks, CPU load {load:.1%} '
+                    f'(max {max_load:.1%}, headroom {1 - max_load:.1%}), p99 processing '
+                    f'{p99 * 1e3:.1f} ms of {block * 1e3:.0f} ms blocks')
+            if max_load > MAX_LOAD:
+                line += ' -- short of headroom'
+            lines.append(line)
+        heaviest = max(self.max_loads.values(), default=0.)
+        if heaviest > 0:
+            pinned = sum(r.cpu is not None for r in self.rigs)
+            lines.append(f'The busiest rig keeps {heaviest:.1%} of a core busy. {pinned} rigs pinned, '
+                         f'one per core, and {len(self.rigs) - pinned} unpinned; unpinned, a core '
+                         f'would take about {int(MAX_LOAD / heaviest)} rigs at these settings')
+        return '\n'.join(lines)
+
+    def close(self):
+        for host in self.hosts.values():
+            host.stop()
+        for rig in self.rigs:
+            if rig.photometry_controller is not None:
+                rig.photometry_controller.close()
@@ -0,0 +1,280 @@
+import time
+import h5py
+import numpy as np
+from photroller.writer import find_events
+
+# datasets holding (n_scans, n_columns) channels, in the order channels are looked up
+CHANNEL_DATASETS = ('raw_photometry', 'demodulated', 'digital_io')
+
+
+class Session:
+    '''
+    Lazy reader for a recorded session. Nothing is loaded when the file is opened; every
+    method reads only the rows it returns, so only the HDF5 chunks those rows touch are
+    decompressed.
+
+    Channels are addressed by name: raw_photometry and demodulated columns use the names
+    saved at record time (e.g. AIN2, AIN2_ref1; AIN0... and demod0... for older sessions)
+    and FIO_STATE is the digital_io dataset.
+
+    Rows are raw_photometry rows. Datasets saved at a lower rate (the decimated demodulated
+    channels, see its decimation attribute) are read at the matching rows, so a window returns
+    fewer samples for them; `rate` gives the sample rate of each channel. Decimated rows are
+    not shifted for the anti-aliasing filter: they lag the raw channels by the group delay of
+    `bmi_process.Decimator` (its `delay`, four decimated rows with the default filter), on top
+    of the lock-in's own.
+
+    Time is stream time in seconds, scan index / scan rate. Rows are mapped to scans through
+    the per-block `blocks` table written by the writer, so blocks lost to ring overruns do not
+    shift later rows. Sessions without that table are assumed to be gapless.
+
+    Edges on the digital inputs come from the `events` table the writer fills while recording,
+    so `events`, `edges` and the event-aligned reads (`align`, `event_average`) only read the
+    chunks around each event; older sessions are scanned once for their edges instead.
+
+        with Session('photometry_session.h5') as s:
+            lags, mean = s.event_average(s.edges(2), 1, 3, ['AIN2_ref1'])['AIN2_ref1']
+
+    With `live`, a session that is still being recorded is opened as an HDF5 SWMR reader:
+    `refresh` picks up the rows the writer flushed since, and `tail` follows them as they arrive,
+    straight from the file rather than through the GUI process.
+
+        with Session('photometry_session.h5') as s:
+            data = s.window(60, 65, ['AIN2_ref1', 'FIO_STATE'])
+            for t, data in s.iter_windows(10):
+                ...
+
+        with Session('photometry_session.h5', live=True) as s:
+            for row, data in s.tail(['AIN2_ref1', 'FIO_STATE'], timeout=5):
+                ...
+    '''
+    def __init__(self, path, live=False) -> None:
+        self.path = path
+        self.live = live
+        self.h5 = h5py.File(path, 'r', libver='latest', swmr=True) if live else h5py.File(path, 'r')
+        if 'metadata/writer/scan_rate' in self.h5:
+            self.scan_rate = float(self.h5['metadata/writer/scan_rate'][()])
+        else:
+            # still recording
+            self.scan_rate = float(self.h5['raw_photometry'].attrs['scan_rate'])
+        self.channels = {}
+        # rows of each dataset per raw_photometry row
+        self.decimation = {}
+        for name in CHANNEL_DATASETS:
+            if name not in self.h5:
+                continue
+            dset = self.h5[name]
+            self.decimation[name] = int(dset.attrs.get('decimation', 1))
+            if dset.ndim == 1:
+                self.channels['FIO_STATE'] = (name, None)
+                continue
+            default = 'AIN' if name == 'raw_photometry' else 'demod'
+            names = dset.attrs.get('channels', [f'{default}{i}' for i in range(dset.shape[1])])
+            for i, channel in enumerate(names):
+                self.channels[_str(channel)] = (name, i)
+        self._load_index()
+        self._events = None
+
+    def refresh(self):
+        '''Pick up rows flushed by the writer since the file was opened or last refreshed'''
+        for name in CHANNEL_DATASETS + ('blocks', 'events'):
+            if name in self.h5:
+                self.h5[name].refresh()
+        self._load_index()
+        self._events = None
+
+    def available(self, names=None):
+        '''Raw rows that every dataset in `names` (default: all) has data for'''
+        names = self.decimation if names is None else names
+        return min(len(self.h5[name]) * self.decimation[name] for name in names)
+
+    def tail(self, channels=None, poll_interval=0.1, timeout=None, start=None):
+        '''
+        Yield (first row, data) with the rows of a live session as they are flushed, starting
+        at row `start` (default: the current end). Stops after `timeout` seconds without new
+        rows, e.g. once the session has ended; runs until interrupted if timeout is None.
+        '''
+        channels = list(self.channels) if channels is None else list(channels)
+        names = {self.channels[channel][0] for channel in channels if channel in self.channels}
+        row = self.available(names) if start is None else start
+        last_data = time.monotonic()
+        while True:
+            self.refresh()
+            # datasets are flushed one after the other, so only take rows all of them have
+            n = self.available(names)
+            if n > row:
+                yield row, self.read(row, n, channels)
+                row = n
+                last_data = time.monotonic()
+            elif timeout is not None and time.monotonic() - last_data > timeout:
+                return
+            else:
+                time.sleep(poll_interval)
+
+    def _load_index(self):
+        # (first scan, first row) of every block that made it to disk
+        self.block_scans = self.block_rows = np.zeros(1, dtype=np.int64)
+        if 'blocks' in self.h5:
+            blocks = self.h5['blocks']
+            columns = [_str(c) for c in blocks.attrs['columns']]
+            table = blocks[:]
+            kept = table[:, columns.index('file_row')] >= 0
+            if kept.any():
+                self.block_scans = table[kept, columns.index('first_scan')].astype(np.int64)
+                self.block_rows = table[kept, columns.index('file_row')].astype(np.int64)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.h5.close()
+
+    def __len__(self):
+        return len(self.h5['raw_photometry'])
+
+    def rate(self, channel):
+        '''Sample rate of `channel` in Hz'''
+        return self.scan_rate / self.decimation[self.channels[channel][0]]
+
+    @property
+    def duration(self):
+        return len(self) / self.scan_rate
+
+    def time_to_row(self, t):
+        '''First row at or after stream time `t` (seconds); works on arrays'''
+        scan = np.ceil(np.asarray(t) * self.scan_rate).astype(np.int64)
+        i = np.maximum(np.searchsorted(self.block_scans, scan, side='right') - 1, 0)
+        row = self.block_rows[i] + scan - self.block_scans[i]
+        # scans lost before the next block map to its first row
+        following = np.minimum(i + 1, len(self.block_rows) - 1)
+        lost = (i + 1 < len(self.block_rows)) & (row > self.block_rows[following])
+        row = np.where(lost, self.block_rows[following], row)
+        return np.clip(row, 0, len(self))
+
+    def row_to_time(self, row):
+        '''Stream time (seconds) of each row'''
+        row = np.asarray(row)
+        i = np.maximum(np.searchsorted(self.block_rows, row, side='right') - 1, 0)
+        return (self.block_scans[i] + row - self.block_rows[i]) / self.scan_rate
+
+    def read(self, start=0, stop=None, channels=None):
+        '''
+        Rows [start, stop) of `channels` (default: all) as {name: array}. Each dataset is
+        read once, however many of its columns are requested.
+        '''
+        channels = list(self.channels) if channels is None else list(channels)
+        stop = len(self) if stop is None else min(stop, len(self))
+        start = max(start, 0)
+        out = {}
+        for name, columns in self._by_dataset(channels).items():
+            factor = self.decimation[name]
+            # a decimated row i holds raw row i * factor
+            rows = self.h5[name][-(-start // factor):-(-stop // factor)]
+            for channel, column in columns:
+                out[channel] = rows if column is None else rows[:, column]
+        return {channel: out[channel] for channel in channels}
+
+    def _by_dataset(self, channels):
+        '''{dataset: [(channel, column), ...]} for `channels`'''
+        by_dataset = {}
+        for channel in channels:
+            if channel not in self.channels:
+                raise KeyError(f'No channel {channel} in {self.path}; choose from {list(self.channels)}')
+            name, column = self.channels[channel]
+            by_dataset.setdefault(name, []).append((channel, column))
+        return by_dataset
+
+    def window(self, t0, t1, channels=None):
+        '''Channels between stream times t0 and t1 (seconds)'''
+        return self.read(int(self.time_to_row(t0)), int(self.time_to_row(t1)), channels)
+
+    def iter_windows(self, seconds, channels=None, step=None):
+        '''Yield (start time, data) for consecutive windows of `seconds`, `step` seconds apart'''
+        step = seconds if step is None else step
+        size = int(round(seconds * self.scan_rate))
+        stride = max(1, int(round(step * self.scan_rate)))
+        for start in range(0, len(self), stride):
+            yield float(self.row_to_time(start)), self.read(start, start + size, channels)
+
+    def events(self, bit=None, direction=None):
+        '''
+        Edges on the FIO lines as records of sample_index (the row), bit and direction (1
+        rising, -1 falling), optionally only those of line `bit` or in `direction`
+        '''
+        if self._events is None:
+            if 'events' in self.h5:
+                self._events = self.h5['events'][:]
+            else:
+                self._events = self._scan_events()
+        events = self._events
+        if bit is not None:
+            events = events[events['bit'] == bit]
+        if direction is not None:
+            events = events[events['direction'] == direction]
+        return events
+
+    def _scan_events(self, chunk_rows=1 << 20):
+        # sessions recorded without an events table
+        dset = self.h5['digital_io']
+        found = []
+        previous = None
+        for start in range(0, len(dset), chunk_rows):
+            states = dset[start:start + chunk_rows]
+            found.append(find_events(states, previous, start))
+            previous = states[-1]
+        return np.concatenate(found) if found else find_events([])
+
+    def edges(self, bit, rising=True):
+        '''Rows where FIO line `bit` turns on (or off)'''
+        return self.events(bit, 1 if rising else -1)['sample_index']
+
+    def align(self, rows, before, after, channels=None):
+        '''
+        `before` seconds before to `after` seconds after each event row (e.g. from `edges`) of
+        `channels`, as {channel: (n_events, n_samples) array}; samples outside the recording
+        are NaN. Windows of lower-rate channels start at their first row at or after the event
+        and have fewer samples (see `lags`). Each event is a read of only the rows around it.
+        '''
+        channels = list(self.channels) if channels is None else list(channels)
+        rows = np.asarray(rows, dtype=np.int64)
+        out = {}
+        for name, columns in self._by_dataset(channels).items():
+            factor = self.decimation[name]
+            n_before, n_after = self._window_size(name, before, after)
+            dset = self.h5[name]
+            n = len(dset)
+            width = len(columns) if dset.ndim > 1 else None
+            windows = np.full((len(rows), n_before + n_after) + ((width, ) if width else ()), np.nan)
+            index = [column for _, column in columns]
+            for i, row in enumerate(rows):
+                start = -(-int(row) // factor) - n_before
+                lo, hi = max(start, 0), min(start + n_before + n_after, n)
+                if lo < hi:
+                    data = dset[lo:hi]
+                    windows[i, lo - start:hi - start] = data if width is None else data[:, index]
+            for j, (channel, _) in enumerate(columns):
+                out[channel] = windows if width is None else windows[..., j]
+        return {channel: out[channel] for channel in channels}
+
+    def _window_size(self, name, before, after):
+        rate = self.scan_rate / self.decimation[name]
+        return int(round(before * rate)), int(round(after * rate))
+
+    def lags(self, channel, before, after):
+        '''Time of each sample of an `align` window of `channel`, relative to the event (seconds)'''
+        name = self.channels[channel][0]
+        n_before, n_after = self._window_size(name, before, after)
+        return np.arange(-n_before, n_after) / self.rate(channel)
+
+    def event_average(self, rows, before, after, channels=None):
+        '''{channel: (lags, mean over events)} of the `align` windows around event `rows`'''
+        windows = self.align(rows, before, after, channels)
+        return {channel: (self.lags(channel, before, after), np.nanmean(w, axis=0))
+                for channel, w in windows.items()}
+
+
+def _str(name):
+    return name.decode() if isinstance(name, bytes) else str(name)
@@ -0,0 +1,256 @@
+import os
+import time
+import queue
+import threading
+import numpy as np
+import multiprocess as mp
+from collections import deque
+from multiprocessing import shared_memory, resource_tracker
+
+POLICIES = ('block', 'drop_oldest', 'drop_newest', 'spill')
+# held while resource_tracker.register is swapped out, see _attach
+_tracker_lock = threading.Lock()
+
+
+class RingOverrun(Exception):
+    '''Raised when a block was overwritten before a consumer read it'''
+
+
+def _attach(name):
+    '''
+    Attach to an existing segment without tracking it: the creator registers it with the
+    resource tracker (shared with the processes it starts) and unlinks it, once.
+    '''
+    try:
+        # python >= 3.13
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    # older pythons register attached segments too; keep them from doing so, rather than
+    # unregistering afterwards what the creator registered. The swap is module-global, so
+    # segments created or attached by other threads meanwhile wait for it
+    with _tracker_lock:
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+class SharedRing:
+    '''
+    Fixed-size ring of float32 blocks in shared memory. The `Stream` process writes each
+    block once; consumers in any process attach by name and read blocks by sequence
+    number without pickling or copying. Only (seq, timestamp) pairs need to travel over
+    a control queue.
+
+    Shared memory layout:
+        header: int64[4] = n_blocks, n_channels, block_size, next sequence number
+        meta: float64[n_blocks, 3] = sequence number, n_scans, timestamp of each slot
+        data: float32[n_blocks, n_channels, block_size]
+    '''
+    header_size = 4
+
+    def __init__(self, n_channels=None, block_size=None, n_blocks=64, name=None) -> None:
+        create = name is None
+        if create:
+            nbytes = self._nbytes(n_blocks, n_channels, block_size)
+            with _tracker_lock:
+                self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        else:
+            self.shm = _attach(name)
+        # only the creating process unlinks the segment, not children forked with a copy of the ring
+        self.owner = os.getpid() if create else None
+        self.header = np.ndarray((self.header_size, ), dtype=np.int64, buffer=self.shm.buf)
+        if create:
+            self.header[:] = (n_blocks, n_channels, block_size, 0)
+        n_blocks, n_channels, block_size = (int(x) for x in self.header[:3])
+        self.n_blocks = n_blocks
+        self.n_channels = n_channels
+        self.block_size = block_size
+        offset = self.header.nbytes
+        self.meta = np.ndarray((n_blocks, 3), dtype=np.float64, buffer=self.shm.buf, offset=offset)
+        offset += self.meta.nbytes
+        self.data = np.ndarray((n_blocks, n_channels, block_size), dtype=np.float32,
+                               buffer=self.shm.buf, offset=offset)
+        if create:
+            self.meta[:, 0] = -1
+
+    @classmethod
+    def _nbytes(cls, n_blocks, n_channels, block_size):
+        return 8 * cls.header_size + 8 * 3 * n_blocks + 4 * n_blocks * n_channels * block_size
+
+    @classmethod
+    def attach(cls, name):
+        return cls(name=name)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def next_seq(self):
+        return int(self.header[3])
+
+    def __getstate__(self):
+        # other processes re-attach to the same segment by name
+        return {'name': self.name}
+
+    def __setstate__(self, state):
+        self.__init__(name=state['name'])
+
+    def write(self, block, timestamp) -> int:
+        '''Copy a (n_channels, n_scans) block into the next slot and publish it; returns its seq number'''
+        seq = self.next_seq
+        slot = seq % self.n_blocks
+        n_scans = block.shape[1]
+        if n_scans > self.block_size:
+            raise ValueError(f'Block of {n_scans} scans does not fit in ring slots of {self.block_size}')
+        # invalidate the slot while it is being rewritten
+        self.meta[slot, 0] = -1
+        self.data[slot, :, :n_scans] = block
+        self.meta[slot, 1:] = (n_scans, timestamp)
+        self.meta[slot, 0] = seq
+        self.header[3] = seq + 1
+        return seq
+
+    def read(self, seq, copy=False):
+        '''Return block `seq`. Without `copy`, the returned view is only valid until the ring wraps around'''
+        slot = seq % self.n_blocks
+        if seq >= self.next_seq or not self.valid(seq):
+            raise RingOverrun(f'Block {seq} is not available (next block is {self.next_seq})')
+        out = self.data[slot, :, :int(self.meta[slot, 1])]
+        if copy:
+            out = out.copy()
+            # make sure the writer did not lap us while copying
+            if not self.valid(seq):
+                raise RingOverrun(f'Block {seq} was overwritten while reading')
+        return out
+
+    def valid(self, seq):
+        '''Whether block `seq` is still held by the ring (check again after reading from a view)'''
+        return self.meta[seq % self.n_blocks, 0] == seq
+
+    def timestamp(self, seq):
+        return self.meta[seq % self.n_blocks, 2]
+
+    def close(self):
+        self.header = self.meta = self.data = None
+        self.shm.close()
+        if self.owner == os.getpid():
+            self.shm.unlink()
+
+
+class BoundedQueue:
+    '''
+    Process-safe queue holding at most `capacity` items, with an explicit `policy` for a
+    producer that finds it full:
+        block: wait for the consumer; lossless, the producer slows down instead
+        drop_oldest: discard the oldest queued item, for displays that only want recent blocks
+        drop_newest: discard the item being put
+        spill: `spill(item)` moves the item's payload to disk and returns a small stand-in;
+            stand-ins wait in the producer, in order, and are queued as the consumer catches up
+
+    Depth is shared between processes; the other counters (puts, drops, spills, high-water
+    mark, time spent blocked) are kept by the single producer, which reports them with `summary`.
+    '''
+    def __init__(self, capacity, policy='block', spill=None) -> None:
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown queue policy {policy}; choose one of {POLICIES}')
+        if policy == 'spill' and spill is None:
+            raise ValueError('The spill policy needs a spill function')
+        self.capacity = capacity
+        self.policy = policy
+        self.spill = spill
+        self.queue = mp.Queue(capacity)
+        self.depth = mp.Value('i', 0)
+        self.overflow = deque()
+        self.reset()
+
+    def __getstate__(self):
+        # the spill function and stand-ins stay with the producer
+        state = self.__dict__.copy()
+        state.update(spill=None, overflow=deque())
+        return state
+
+    def qsize(self):
+        return self.depth.value
+
+    def _offer(self, item, block=False, timeout=None) -> bool:
+        # counted before it can be taken, so the consumer never sees a negative depth
+        with self.depth.get_lock():
+            self.depth.value += 1
+        try:
+            self.queue.put(item, block, timeout)
+        except queue.Full:
+            with self.depth.get_lock():
+                self.depth.value -= 1
+            return False
+        # a consumer may take an item before it is counted out
+        self.high_water = max(self.high_water, min(self.depth.value, self.capacity))
+        return True
+
+    def _drain(self):
+        while self.overflow and self._offer(self.overflow[0]):
+            self.overflow.popleft()
+
+    def put(self, item, timeout=None) -> bool:
+        '''Queue `item` under the policy; returns whether it (or its stand-in) was queued'''
+        self.puts += 1
+        if self.policy == 'spill':
+            # stand-ins go first, to keep the order
+            self._drain()
+            if self.overflow or not self._offer(item):
+                self.overflow.append(self.spill(item))
+                self.spills += 1
+                self.max_overflow = max(self.max_overflow, len(self.overflow))
+            return True
+        if self._offer(item):
+            return True
+        if self.policy == 'block':
+            start = time.perf_counter()
+            queued = self._offer(item, block=True, timeout=timeout)
+            self.blocked_seconds += time.perf_counter() - start
+            if not queued:
+                self.drops += 1
+            return queued
+        self.drops += 1
+        if self.policy == 'drop_oldest':
+            try:
+                # a full queue holds items, but the last ones may still be on their way into its pipe
+                self.get(timeout=0.005)
+            except queue.Empty:
+                pass
+            return self._offer(item)
+        return False
+
+    def finish(self, item=None):
+        '''Queue any stand-ins, then `item` (the end-of-stream marker), waiting for room'''
+        while self.overflow:
+            self._offer(self.overflow.popleft(), block=True)
+        self._offer(item, block=True)
+
+    def clear(self):
+        '''Discard what is queued, e.g. announcements left over from an earlier session'''
+        while True:
+            try:
+                self.get(block=False)
+            except queue.Empty:
+                return
+
+    def reset(self):
+        '''Zero the producer's counters, for a queue reused by another session'''
+        self.puts = self.drops = self.spills = self.high_water = self.max_overflow = 0
+        self.blocked_seconds = 0.
+
+    def get(self, block=True, timeout=None):
+        item = self.queue.get(block, timeout)
+        with self.depth.get_lock():
+            self.depth.value -= 1
+        return item
+
+    def summary(self):
+        return dict(policy=self.policy, capacity=self.capacity, puts=self.puts, drops=self.drops,
+                    spills=self.spills, high_water=self.high_water, depth=self.qsize(),
+                    max_overflow=self.max_overflow, blocked_seconds=self.blocked_seconds)
@@ -1,11 +1,16 @@
-import h5py
+import math
+import time
 import click
 import serial
 import struct
-import time
-import numpy as np
+import binascii
+import threading
+from collections import namedtuple
 from serial.tools import list_ports
 
+# entries in SINE_TABLE of arduino/photroller/sinusoid.h (sine_resolution 6)
+SINE_TABLE_SIZE = 64
+
 
 def select_serial_port():
 
@@ -41,44 +46,206 @@ def init_serial_port(serial_port=None, baudrate=115200, parity=serial.PARITY_NON
     return serial_device
 
 
-class PhotometryController:
+def sample_hold_frequency(sample_hold, table_size=SINE_TABLE_SIZE):
+    '''
+    Modulation frequency the controller firmware produces holding each sine table entry for
+    `sample_hold` microseconds; it wraps its table index at table_size - 1.
+    '''
+    return 1e6 / ((table_size - 1) * sample_hold)
+
+
+def firmware_frequency(freq, table_size=SINE_TABLE_SIZE):
+    '''
+    Modulation frequency the controller firmware actually produces when asked for `freq`.
+    It holds each sine table entry for 1e6 / (table_size * freq) microseconds, truncated to
+    an integer.
+    '''
+    return sample_hold_frequency(int(1e6 / (table_size * freq)), table_size)
+
+
+# parameter packets: sync, protocol version, sequence number, payload length, payload
+# (PARAMETERS), then the CRC-16/CCITT of version..payload. The firmware confirms each one with
+# an ACK: reversed sync, version, sequence number, status, the sample holds (us) and its
+# micros() once applied, CRC. See arduino/photroller/photroller.ino
+SYNC = b'\xa5\x5a'
+ACK_SYNC = b'\x5a\xa5'
+PROTOCOL_VERSION = 1
+PARAMETERS = struct.Struct('<HHffff')
+HEADER = struct.Struct('<2sBBB')
+ACK = struct.Struct('<2sBBBIIIH')
+PACKET_SIZE = HEADER.size + PARAMETERS.size + 2
+STATUSES = ('ok', 'bad crc', 'bad version', 'bad length', 'bad value')
+WRITE_ORDER = ('freq1', 'freq2', 'amp1', 'amp2', 'offset1', 'offset2')
+
+
+class ProtocolError(ValueError):
+    '''A corrupt, unsupported or invalid parameter packet; `status` indexes STATUSES'''
+    def __init__(self, status) -> None:
+        super().__init__(STATUSES[status])
+        self.status = status
+
+
+def crc16(data):
+    return binascii.crc_hqx(data, 0xFFFF)
 
-    def __init__(self, photometry_parameters, serial_port=None, **kwargs):
-        # initialize serial port, write in the photometry parameters
-        if serial_port is not None:
-            self.serial_port = serial_port
 
+def pack_parameters(phot_params, seq):
+    '''The packet setting `phot_params` (freq1, freq2, amp1, ...), numbered `seq` (0-255)'''
+    payload = PARAMETERS.pack(*(phot_params[k] for k in WRITE_ORDER))
+    body = HEADER.pack(SYNC, PROTOCOL_VERSION, seq, len(payload)) + payload
+    return body + struct.pack('<H', crc16(body[2:]))
+
+
+def unpack_parameters(packet):
+    '''(seq, parameters) of a packet from `pack_parameters`; raises ProtocolError as the firmware would'''
+    _, version, seq, length = HEADER.unpack_from(packet)
+    if length != PARAMETERS.size or len(packet) != PACKET_SIZE:
+        raise ProtocolError(STATUSES.index('bad length'))
+    if struct.unpack_from('<H', packet, PACKET_SIZE - 2)[0] != crc16(packet[2:-2]):
+        raise ProtocolError(STATUSES.index('bad crc'))
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(STATUSES.index('bad version'))
+    params = dict(zip(WRITE_ORDER, PARAMETERS.unpack_from(packet, HEADER.size)))
+    if not params['freq1'] or not params['freq2']:
+        raise ProtocolError(STATUSES.index('bad value'))
+    return seq, params
+
+
+class Confirmation(namedtuple('Confirmation', 'seq status sample_hold1 sample_hold2 device_micros '
+                                              'sent confirmed parameters')):
+    '''
+    The firmware's answer to a parameter packet. `sent` and `confirmed` are the host's
+    time.time() at writing the packet and receiving the answer, `device_micros` the
+    controller's clock once it applied the parameters.
+    '''
+    @property
+    def ok(self):
+        return self.status == 0
+
+    @property
+    def frequencies(self):
+        '''Modulation frequencies now in effect'''
+        return sample_hold_frequency(self.sample_hold1), sample_hold_frequency(self.sample_hold2)
+
+
+class PhotometryController:
+    '''
+    Serial link to the Arduino generating the LED sinusoids (arduino/photroller). Each parameter
+    set goes out as one packet (`pack_parameters`) in a single write. The firmware applies it
+    and confirms with the sample holds now in effect; a reader thread collects confirmations,
+    so `write_parameters` returns at once unless asked to wait.
+    '''
+    def __init__(self, photometry_parameters, serial_port=None, timeout=2., **kwargs):
+        # initialize serial port, write in the photometry parameters
         self.device = init_serial_port(serial_port, **kwargs)
-        self.photometry_parameters = photometry_parameters
-        self.write_order = ('freq1', 'freq2', 'amp1', 'amp2', 'offset1', 'offset2')
-        time.sleep(0.4)
-        self.write_parameters(self.photometry_parameters)
+        self.serial_port = self.device.port
+        # lets the reader thread notice close()
+        self.device.timeout = 0.05
+        self.write_order = WRITE_ORDER
+        self.seq = 0
+        # seq -> (time sent, parameters) of the packets awaiting confirmation
+        self.pending = {}
+        # seq -> latest confirmation with that number
+        self.confirmations = {}
+        self.history = []
+        self.confirmed = threading.Condition()
+        self.closed = False
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+        # opening the port resets the board; resend until its firmware is up and answers
+        # (serial noise while it boots can come back as a rejected packet)
+        deadline = time.time() + timeout
+        while True:
+            try:
+                confirmation = self.write_parameters(photometry_parameters, wait=True, timeout=0.25)
+                break
+            except (TimeoutError, ProtocolError) as e:
+                if time.time() > deadline:
+                    self.close()
+                    if isinstance(e, ProtocolError):
+                        raise
+                    raise TimeoutError(f'No answer from the photometry controller on {self.serial_port}')
+        print(f'Controller modulating at {confirmation.frequencies[0]:.2f} and '
+              f'{confirmation.frequencies[1]:.2f} Hz')
 
-    def write_parameters(self, phot_params):
+    def write_parameters(self, phot_params, wait=False, timeout=1.):
+        '''
+        Send a parameter set; returns its sequence number, or its Confirmation when `wait`ing
+        (raises TimeoutError without one within `timeout` seconds, ProtocolError if rejected)
+        '''
         self.photometry_parameters = phot_params
+        with self.confirmed:
+            self.seq = (self.seq + 1) % 256
+            seq = self.seq
+            self.pending[seq] = (time.time(), dict(phot_params))
+            self.confirmations.pop(seq, None)
+        self.device.write(pack_parameters(phot_params, seq))
         for k in self.write_order:
-            v = self.photometry_parameters[k]
-            self.write(v)
-        for k in self.write_order:
-            v = self.photometry_parameters[k]
-            print(f'Writing {k}: {v}')
-        # self.device.flush()
+            print(f'Writing {k}: {phot_params[k]}')
+        if not wait:
+            return seq
+        return self.wait(seq, timeout)
 
-    def write(self, data):
+    def wait(self, seq, timeout=1.):
+        '''Confirmation of packet `seq`'''
+        with self.confirmed:
+            if not self.confirmed.wait_for(lambda: seq in self.confirmations, timeout):
+                raise TimeoutError(f'Parameter set {seq} was not confirmed within {timeout} s')
+            confirmation = self.confirmations[seq]
+        if not confirmation.ok:
+            raise ProtocolError(confirmation.status)
+        return confirmation
 
-        if isinstance(data, float):
-            write_data = struct.pack('<f', np.single(data))
-        elif isinstance(data, int):
-            write_data = struct.pack('<H', np.uint16(data))
-        elif data.dtype == np.uint16:
-            write_data = struct.pack('<H', data)
-        elif data.dtype == np.single:
-            write_data = struct.pack('<f', data)
+    def _read(self):
+        buffer = b''
+        while not self.closed:
+            try:
+                buffer += self.device.read(max(1, self.device.in_waiting))
+            except (serial.SerialException, OSError, TypeError):
+                # port closed
+                return
+            while True:
+                start = buffer.find(ACK_SYNC)
+                if start < 0:
+                    # the last byte may start a confirmation
+                    buffer = buffer[-1:]
+                    break
+                buffer = buffer[start:]
+                if len(buffer) < ACK.size:
+                    break
+                if self._confirm(buffer[:ACK.size]):
+                    buffer = buffer[ACK.size:]
+                else:
+                    # not a confirmation after all
+                    buffer = buffer[1:]
 
-        self.device.write(write_data)
+    def _confirm(self, ack) -> bool:
+        _, version, seq, status, hold1, hold2, micros, crc = ACK.unpack(ack)
+        if crc != crc16(ack[2:-2]) or version != PROTOCOL_VERSION:
+            return False
+        with self.confirmed:
+            sent, params = self.pending.pop(seq, (math.nan, None))
+            confirmation = Confirmation(seq, status, hold1, hold2, micros, sent, time.time(), params)
+            self.confirmations[seq] = confirmation
+            self.history.append(confirmation)
+            self.confirmed.notify_all()
+        return True
+
+    def updates(self, since=0.):
+        '''Confirmed parameter sets sent after `since` (time.time()), as arrays to save with a session'''
+        confirmed = [c for c in self.history if c.ok and c.sent >= since]
+        if not confirmed:
+            return {}
+        updates = {field: [getattr(c, field) for c in confirmed]
+                   for field in ('seq', 'sent', 'confirmed', 'sample_hold1', 'sample_hold2', 'device_micros')}
+        for k in self.write_order:
+            updates[k] = [c.parameters[k] for c in confirmed]
+        return updates
 
-    def read(self):
-        return self.device.readline()
+    def close(self):
+        self.closed = True
+        self.reader.join()
+        self.device.close()
 
 
 def dict_to_h5(h5, dic, root='/'):
@@ -94,6 +261,9 @@ def dict_to_h5(h5, dic, root='/'):
     -------
     None
     '''
+    # imported here, so the serial controller does not pay for them
+    import h5py
+    import numpy as np
 
     if not root.endswith('/'):
         root = root + '/'
@@ -0,0 +1,414 @@
+import os
+import time
+import queue
+import threading
+import h5py
+import numpy as np
+import multiprocess as mp
+from photroller.util import dict_to_h5
+from photroller.transport import RingOverrun
+from photroller.latency import LatencyHistogram
+
+try:
+    import hdf5plugin
+except ImportError:
+    # blosc and zstd codecs are only available when hdf5plugin is installed
+    hdf5plugin = None
+
+CODECS = ('none', 'lzf', 'gzip', 'blosc', 'zstd')
+# columns of the per-block `blocks` dataset; file_row is -1 for blocks lost to a ring overrun
+BLOCK_COLUMNS = ('first_scan', 'n_scans', 'host_time', 'device_backlog', 'ljm_backlog', 'n_dropped',
+                 'degrade_level', 'file_row')
+# records of the `events` dataset: row of the first scan at the new level, FIO line, and
+# direction (1 rising, -1 falling)
+EVENT_DTYPE = np.dtype([('sample_index', '<i8'), ('bit', 'u1'), ('direction', 'i1')])
+
+
+def compression_kwargs(codec='gzip', level=None):
+    '''h5py create_dataset keyword arguments for a codec name'''
+    if codec in (None, 'none'):
+        return {}
+    if codec == 'lzf':
+        return dict(compression='lzf', shuffle=True)
+    if codec == 'gzip':
+        return dict(compression='gzip', compression_opts=3 if level is None else level, shuffle=True)
+    if codec in ('blosc', 'zstd'):
+        if hdf5plugin is None:
+            raise ValueError(f'The {codec} codec requires hdf5plugin to be installed')
+        if codec == 'blosc':
+            return dict(hdf5plugin.Blosc(cname='lz4', clevel=5 if level is None else level,
+                                         shuffle=hdf5plugin.Blosc.SHUFFLE))
+        return dict(hdf5plugin.Zstd(clevel=3 if level is None else level))
+    raise ValueError(f'Unknown codec {codec}; choose one of {CODECS}')
+
+
+def chunk_rows(n_columns, itemsize=4, chunk_kb=256, min_rows=1):
+    # keep chunks below the default 1 MB HDF5 chunk cache so windowed reads stay cached
+    return max(min_rows, (chunk_kb * 1024) // (n_columns * itemsize))
+
+
+def find_events(states, previous=None, first_index=0):
+    '''
+    Edges on the digital inputs in `states` (FIO_STATE, one value per scan) as EVENT_DTYPE
+    records, ordered by row then line. `previous` is the state before the first scan (None to
+    only report changes within `states`), and rows are numbered from `first_index`.
+    '''
+    states = np.asarray(states).astype(np.uint16)
+    if previous is None:
+        previous = states[0] if len(states) else 0
+    changed = states ^ np.concatenate([[previous], states[:-1]]).astype(np.uint16)
+    rows = np.flatnonzero(changed)
+    # only the scans where something changed are split into lines
+    row, bit = np.nonzero((changed[rows, None] >> np.arange(16, dtype=np.uint16)) & 1)
+    rows = rows[row]
+    events = np.empty(len(rows), dtype=EVENT_DTYPE)
+    events['sample_index'] = rows + first_index
+    events['bit'] = bit
+    events['direction'] = np.where((states[rows] >> bit) & 1, 1, -1)
+    return events
+
+
+def spill_path(spill_dir, seq):
+    '''File holding block `seq` when the stream had to move it out of the ring'''
+    return os.path.join(spill_dir, f'{seq}.npz')
+
+
+class Spiller(threading.Thread):
+    '''
+    Saves blocks the stream moves out of its ring to `spill_dir` on a thread of their own, so
+    that a slow disk holds up neither the device reads nor the lock-in. `save` takes copies
+    of the arrays, which wait in memory until they are written; each file is written under a
+    temporary name and renamed to its `spill_path` once complete, and the writer waits for it.
+    '''
+    def __init__(self, spill_dir) -> None:
+        super().__init__(daemon=True)
+        self.spill_dir = spill_dir
+        self.queue = queue.Queue()
+        # blocks handed over but not on disk yet
+        self.pending = set()
+        os.makedirs(spill_dir, exist_ok=True)
+
+    def save(self, seq, **arrays):
+        '''Queue `arrays` (copied by the caller) for saving as block `seq`; returns the file's path'''
+        self.pending.add(seq)
+        self.queue.put((seq, arrays))
+        return spill_path(self.spill_dir, seq)
+
+    def saved(self, seq):
+        '''Whether block `seq` was handed over, whether or not it is on disk yet'''
+        return seq in self.pending or os.path.exists(spill_path(self.spill_dir, seq))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            seq, arrays = item
+            path = spill_path(self.spill_dir, seq)
+            with open(path + '.tmp', 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(path + '.tmp', path)
+            self.pending.discard(seq)
+
+    def close(self):
+        '''Write what is queued and stop'''
+        self.queue.put(None)
+        self.join()
+
+
+def wait_spilled(path, timeout=5.) -> bool:
+    '''Wait up to `timeout` seconds for a `Spiller` to finish the file at `path`'''
+    deadline = time.perf_counter() + timeout
+    while not os.path.exists(path):
+        if time.perf_counter() > deadline:
+            return False
+        time.sleep(0.001)
+    return True
+
+
+def open_finished(path):
+    '''
+    Open a session file in append mode to add metadata once its Writer has finished. File
+    locking is off, as live readers may still hold the file open; they only follow the datasets.
+    '''
+    return h5py.File(path, 'a', locking=False)
+
+
+class Writer(mp.Process):
+    '''
+    Writes stream blocks from a SharedRing to the session file in its own process.
+
+    Blocks are announced on `queue` as (sequence number, timestamp, block info) and a None
+    ends the session, where block info holds the first seven BLOCK_COLUMNS. The sequence number
+    of every block copied out is stored in `acked`, so the stream knows which ring slots it can
+    reuse. Blocks the stream spilled to disk instead carry the path of their .npz file (see
+    `spill_path`) as a fourth element, and blocks overwritten in the ring are looked up in
+    `spill_dir`, waiting for a `Spiller` still saving them; a spilled copy of a block read
+    from the ring is deleted. Blocks are staged
+    in memory and written in whole chunks, so compressed chunks are never rewritten. Datasets
+    are preallocated for `duration` seconds and trimmed to the recorded length when the
+    session ends.
+
+    With `swmr`, the file is in HDF5 single-writer/multiple-reader mode: every
+    `flush_interval` seconds the staged rows, partial chunks included, are written and flushed,
+    so `Session(path, live=True)` can follow the recording from other processes and a crash
+    loses at most one interval. Datasets then grow as they are written rather than being
+    preallocated, and the writer stats are added once the session ends. The file has to be
+    created with libver='latest' (or by the writer).
+
+    With a `decimated_ring`, the demodulated dataset holds the lock-in outputs `Stream` wrote
+    there, decimated by `decimation`, instead of the full-rate columns of `ring`; they are staged
+    and chunked separately from the full-rate datasets.
+
+    Datasets:
+        raw_photometry: (n_scans, n_raw) float32 analog inputs
+        demodulated: (n_scans / decimation, n_demod) float32 lock-in outputs; the decimation
+            and output_rate attributes give its row rate, row i being scan i * decimation
+        digital_io: (n_scans, ) uint16 FIO_STATE
+        blocks: (n_blocks, len(BLOCK_COLUMNS)) float64 stream scan counter, host timestamp,
+            backlogs, scans the device skipped and degradation level of every block, so gaps
+            and overflows are marked explicitly
+        events: (n_events, ) EVENT_DTYPE edges on every FIO line, found block by block as they
+            arrive (`find_events`), so aligning to events never scans digital_io
+    '''
+    def __init__(self, queue, ring, save_path, n_raw, scan_rate, duration=None, codec='gzip',
+                 codec_level=None, chunk_kb=256, report_interval=10, channel_names=None,
+                 decimated_ring=None, decimation=1, swmr=True, flush_interval=1., acked=None,
+                 spill_dir=None) -> None:
+        super().__init__()
+        self.queue = queue
+        self.ring = ring
+        self.save_path = save_path
+        self.n_raw = n_raw
+        # blocks hold raw channels, then demodulated channels, then FIO_STATE
+        self.n_demod = ring.n_channels - n_raw - 1
+        self.scan_rate = scan_rate
+        self.duration = duration
+        self.codec = codec
+        self.codec_level = codec_level
+        self.chunk_kb = chunk_kb
+        self.report_interval = report_interval
+        # optional {dataset: column names}, stored in the dataset's 'channels' attribute
+        self.channel_names = channel_names or {}
+        self.decimated_ring = decimated_ring
+        self.decimation = decimation if decimated_ring is not None else 1
+        self.swmr = swmr
+        self.flush_interval = flush_interval
+        self.acked = acked
+        self.spill_dir = spill_dir
+
+    def _create_datasets(self, h5f, rows):
+        # live readers take the dataset length as the number of rows written
+        n_prealloc = 0 if self.swmr else max(rows, int(self.scan_rate * (self.duration or 0)))
+        compression = compression_kwargs(self.codec, self.codec_level)
+        shapes = {
+            'raw_photometry': ((n_prealloc, self.n_raw), np.float32),
+            'demodulated': ((n_prealloc // self.decimation, self.n_demod), np.float32),
+            'digital_io': ((n_prealloc, ), np.uint16),
+        }
+        datasets = {}
+        for name, (shape, dtype) in shapes.items():
+            datasets[name] = h5f.create_dataset(name, shape=shape, maxshape=(None, ) + shape[1:],
+                                                dtype=dtype, chunks=(rows, ) + shape[1:],
+                                                **compression)
+            if name in self.channel_names:
+                datasets[name].attrs['channels'] = self.channel_names[name]
+        # read by live sessions before metadata/writer exists
+        datasets['raw_photometry'].attrs['scan_rate'] = self.scan_rate
+        datasets['demodulated'].attrs.update(decimation=self.decimation,
+                                             output_rate=self.scan_rate / self.decimation)
+        blocks = h5f.create_dataset('blocks', shape=(0, len(BLOCK_COLUMNS)), dtype=np.float64,
+                                    maxshape=(None, len(BLOCK_COLUMNS)), chunks=(256, len(BLOCK_COLUMNS)))
+        blocks.attrs['columns'] = BLOCK_COLUMNS
+        events = h5f.create_dataset('events', shape=(0, ), dtype=EVENT_DTYPE, maxshape=(None, ),
+                                    chunks=(4096, ))
+        return datasets, blocks, events
+
+    def _read(self, seq):
+        '''
+        Copies of block `seq` and its decimated block (None without a decimated ring) as
+        (n_scans, n_channels); raises RingOverrun if either was overwritten
+        '''
+        block = self.ring.read(seq, copy=True).T
+        decimated = None
+        if self.decimated_ring is not None:
+            decimated = self.decimated_ring.read(seq, copy=True).T
+        return block, decimated
+
+    def _load_spilled(self, path):
+        with np.load(path) as f:
+            block = f['block'].T
+            decimated = f['decimated'].T if 'decimated' in f else None
+        os.remove(path)
+        return block, decimated
+
+    def run(self):
+        rows = chunk_rows(max(self.n_raw, self.n_demod), chunk_kb=self.chunk_kb)
+        # full-rate datasets, and the decimated one when there is one, fill at different rates
+        groups = {'scans': ('raw_photometry', 'demodulated', 'digital_io')}
+        if self.decimated_ring is not None:
+            groups = {'scans': ('raw_photometry', 'digital_io'), 'decimated': ('demodulated', )}
+        # staged rows, large enough for one chunk plus a block
+        capacity = rows + self.ring.block_size
+        staging = {
+            'raw_photometry': np.empty((capacity, self.n_raw), dtype=np.float32),
+            'demodulated': np.empty((capacity, self.n_demod), dtype=np.float32),
+            'digital_io': np.empty((capacity, ), dtype=np.uint16),
+        }
+        n_staged = dict.fromkeys(groups, 0)
+        offset = dict.fromkeys(groups, 0)
+        stats = dict(codec=self.codec, scan_rate=self.scan_rate, chunk_rows=rows, n_blocks=0, overruns=0,
+                     bytes=0, write_seconds=0., max_queue_depth=0, dropped_scans=0, max_backlog=0,
+                     decimation=self.decimation, swmr=self.swmr, swmr_flushes=0, spilled=0, n_events=0)
+        block_rows = []
+        event_rows = []
+        # FIO_STATE at the end of the last block, to find edges across blocks
+        last_state = None
+        write_latency = LatencyHistogram()
+
+        with h5py.File(self.save_path, 'a', libver='latest') as h5f:
+            datasets, blocks, events = self._create_datasets(h5f, rows)
+            if self.swmr:
+                # no datasets or attributes can be added from here on
+                h5f.swmr_mode = True
+
+            def flush_blocks():
+                if block_rows:
+                    blocks.resize(len(blocks) + len(block_rows), axis=0)
+                    blocks[-len(block_rows):] = block_rows
+                    block_rows.clear()
+                if event_rows:
+                    new = np.concatenate(event_rows)
+                    events.resize(len(events) + len(new), axis=0)
+                    events[-len(new):] = new
+                    event_rows.clear()
+
+            def write(group, n):
+                o = offset[group]
+                for name in groups[group]:
+                    dset = datasets[name]
+                    if o + n > len(dset):
+                        # session ran longer than its planned duration, or a live dataset grows
+                        dset.resize(o + n if self.swmr else max(2 * len(dset), o + n), axis=0)
+                    dset[o:o + n] = staging[name][:n]
+
+            def flush(group, n):
+                start = time.perf_counter()
+                write(group, n)
+                staged = n_staged[group]
+                for name in groups[group]:
+                    # move whatever did not fill a chunk to the front
+                    staging[name][:staged - n] = staging[name][n:staged]
+                    stats['bytes'] += staging[name][:n].nbytes
+                elapsed = time.perf_counter() - start
+                write_latency.record(elapsed)
+                stats['write_seconds'] += elapsed
+                flush_blocks()
+                offset[group] += n
+                n_staged[group] -= n
+
+            def publish():
+                # the partial chunks written here are rewritten once they fill up
+                start = time.perf_counter()
+                for group in groups:
+                    write(group, n_staged[group])
+                flush_blocks()
+                h5f.flush()
+                stats['write_seconds'] += time.perf_counter() - start
+                stats['swmr_flushes'] += 1
+
+            def stage(group, columns):
+                n = len(next(iter(columns.values())))
+                for name, values in columns.items():
+                    staging[name][n_staged[group]:n_staged[group] + n] = values
+                n_staged[group] += n
+                if n_staged[group] >= rows:
+                    flush(group, n_staged[group] - n_staged[group] % rows)
+
+            session_start = last_report = last_publish = time.perf_counter()
+            while True:
+                item = self.queue.get(block=True, timeout=None)
+                if item is None:
+                    break
+                seq, _, info, *spilled = item
+                stats['dropped_scans'] += info[5]
+                stats['max_backlog'] = max(stats['max_backlog'], info[3] + info[4])
+                try:
+                    if spilled:
+                        if not wait_spilled(spilled[0]):
+                            raise RingOverrun(f'Block {seq} was spilled but never saved')
+                        block, decimated = self._load_spilled(spilled[0])
+                        stats['spilled'] += 1
+                    else:
+                        try:
+                            block, decimated = self._read(seq)
+                        except RingOverrun:
+                            # the stream saves it before reusing its slot
+                            if self.spill_dir is None or not wait_spilled(spill_path(self.spill_dir, seq)):
+                                raise
+                            block, decimated = self._load_spilled(spill_path(self.spill_dir, seq))
+                            stats['spilled'] += 1
+                    if self.acked is not None:
+                        self.acked.value = seq
+                    if not spilled and self.spill_dir is not None:
+                        # the stream may have saved the block while this copied it out of the ring
+                        path = spill_path(self.spill_dir, seq)
+                        if os.path.exists(path):
+                            os.remove(path)
+                except RingOverrun as e:
+                    stats['overruns'] += 1
+                    block_rows.append(info + (-1, ))
+                    print('Writer fell behind, data lost:', e)
+                    continue
+                file_row = offset['scans'] + n_staged['scans']
+                block_rows.append(info + (file_row, ))
+                columns = {'raw_photometry': block[:, :self.n_raw], 'digital_io': block[:, -1]}
+                found = find_events(block[:, -1], last_state, file_row)
+                last_state = block[-1, -1]
+                if len(found):
+                    event_rows.append(found)
+                    stats['n_events'] += len(found)
+                if self.decimated_ring is None:
+                    columns['demodulated'] = block[:, self.n_raw:-1]
+                else:
+                    stage('decimated', {'demodulated': decimated})
+                stage('scans', columns)
+                stats['n_blocks'] += 1
+                stats['max_queue_depth'] = max(stats['max_queue_depth'], _qsize(self.queue))
+
+                now = time.perf_counter()
+                if self.swmr and now - last_publish > self.flush_interval:
+                    last_publish = now
+                    publish()
+                if now - last_report > self.report_interval:
+                    last_report = now
+                    print(f"Writer: {stats['bytes'] / (now - session_start) / 1e6:.2f} MB/s sustained, "
+                          f"{_mb_per_s(stats):.1f} MB/s while writing, queue depth {_qsize(self.queue)}")
+            for group, names in groups.items():
+                if n_staged[group] > 0:
+                    flush(group, n_staged[group])
+                for name in names:
+                    datasets[name].resize(offset[group], axis=0)
+            flush_blocks()
+
+        stats['session_seconds'] = time.perf_counter() - session_start
+        stats['mb_per_s'] = _mb_per_s(stats)
+        stats['sustained_mb_per_s'] = stats['bytes'] / stats['session_seconds'] / 1e6
+        # reopened, as groups cannot be created in SWMR mode
+        with open_finished(self.save_path) as h5f:
+            dict_to_h5(h5f, stats, 'metadata/writer')
+            dict_to_h5(h5f, {'hdf5_write': write_latency.summary()}, 'metadata/latency')
+        print()
+        print('Stream over, closing h5 file')
+
+
+def _mb_per_s(stats):
+    return stats['bytes'] / max(stats['write_seconds'], 1e-9) / 1e6
+
+
+def _qsize(queue):
+    try:
+        return queue.qsize()
+    except NotImplementedError:
+        # not available on macOS
+        return -1
@@ -9,6 +9,8 @@ setup(
     install_requires=['h5py', 'scipy', 'numpy', 'click', 'pyserial',
                       'ruamel.yaml', 'PySide6', 'labjack-ljm',
                       'multiprocess', 'toolz'],
+    # compiled demodulation kernel, see photroller.kernels
+    extras_require={'fast': ['numba'], 'test': ['pytest']},
     python_requires='>=3.6',
     entry_points={'console_scripts': ['photroller = photroller.cli:cli']}
 )
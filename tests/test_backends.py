@@ -0,0 +1,48 @@
+import time
+import numpy as np
+from photroller.backends import DUMMY_SAMPLE, SimulatedT7
+from photroller.bmi_process import Backlog
+
+NAMES = [f'AIN{i}' for i in range(4)] + ['FIO_STATE']
+
+
+def started(scans_per_read=300, scan_rate=3000, **kwargs):
+    backend = SimulatedT7(seed=0, **kwargs)
+    backend.start(scans_per_read, backend.addresses(NAMES), scan_rate)
+    return backend
+
+
+def test_read_shape():
+    backend = started(realtime=False)
+    raw, device_backlog, ljm_backlog = backend.read()
+    assert np.shape(raw) == (300 * len(NAMES), )
+    assert (device_backlog, ljm_backlog) == (0, 0)
+
+
+def test_injected_backlog_drains():
+    backend = started(realtime=False)
+    backend.inject_backlog(1500)
+    backlogs = [backend.read()[1] for _ in range(6)]
+    assert backlogs == [1200, 900, 600, 300, 0, 0]
+
+
+def test_injected_backlog_drains_in_real_time():
+    backend = started(realtime=True)
+    backend.read()
+    backend.inject_backlog(900)
+    start = time.perf_counter()
+    backlogs = [backend.read()[1] for _ in range(3)]
+    # the stalled scans were already acquired, so reads return at once while catching up
+    assert time.perf_counter() - start < 0.1
+    assert backlogs[0] >= 600 and backlogs[-1] < 300
+    backlog = Backlog(300)
+    levels = [backlog.update(b, 0) for b in [900] + backlogs + [backend.read()[1] for _ in range(3)]]
+    assert levels[0] > 0 and levels[-1] == 0
+
+
+def test_dropped_scans_are_dummy_samples():
+    backend = started(realtime=False)
+    backend.inject_drop(100)
+    raw = np.reshape(backend.read()[0], (-1, len(NAMES)))
+    assert (raw[:100] == DUMMY_SAMPLE).all()
+    assert (raw[100:] != DUMMY_SAMPLE).all()
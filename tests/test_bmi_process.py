@@ -0,0 +1,189 @@
+import numpy as np
+import pytest
+from photroller.bmi_process import (Decimator, LockIn, ReferenceOscillator, RingBuffer, bandpass_sos,
+                                    demodulate_causal, demodulate_causal_batch, lowpass_sos)
+
+FS = 3000
+FREQS = (101, 237)
+
+
+def references(n, freqs=FREQS, fs=FS):
+    t = np.arange(n) / fs
+    return (np.stack([np.sin(2 * np.pi * f * t) for f in freqs]),
+            np.stack([np.cos(2 * np.pi * f * t) for f in freqs]))
+
+
+def amplitude_step(n, high=1., low=0.01, freq=FREQS[0], fs=FS):
+    '''A modulated signal whose amplitude drops from `high` to `low` halfway'''
+    t = np.arange(n) / fs
+    amplitude = np.where(np.arange(n) < n // 2, high, low)
+    return amplitude * np.sin(2 * np.pi * freq * t)
+
+
+def test_demodulate_causal_amplitude_step():
+    n, block = 6 * FS, 150
+    data = amplitude_step(n)
+    ref_x, ref_y = references(n)
+    # copies: the designs are cached read-only, and sosfilt wants writable coefficients
+    bp, lp = bandpass_sos(FREQS[0], FS, 60).copy(), lowpass_sos(15, FS).copy()
+    zi = None
+    out = []
+    for start in range(0, n, block):
+        sl = slice(start, start + block)
+        demod, zi = demodulate_causal(data[sl], ref_x[0, sl], ref_y[0, sl], bp, lp, zi)
+        out.append(demod)
+    out = np.concatenate(out)
+    assert not np.isnan(out).any()
+    assert (out >= 0).all()
+    # settled on the low amplitude by the end
+    assert out[-FS // 2:].max() < 0.05
+
+
+def test_demodulate_causal_batch_amplitude_step():
+    n, block = 6 * FS, 150
+    data = np.stack([amplitude_step(n), amplitude_step(n, low=0.001)])
+    ref_x, ref_y = references(n)
+    bp = [bandpass_sos(f, FS, 60).copy() for f in FREQS]
+    lp = lowpass_sos(15, FS).copy()
+    zi = None
+    out = []
+    for start in range(0, n, block):
+        sl = slice(start, start + block)
+        demod, zi = demodulate_causal_batch(data[:, sl], ref_x[:, sl], ref_y[:, sl], bp, lp, zi)
+        out.append(demod)
+    out = np.concatenate(out, axis=-1)
+    assert out.shape == (2, 2, n)
+    assert not np.isnan(out).any()
+
+
+def test_oscillator_tracks_a_drifting_reference():
+    n, block = 20 * FS, 150
+    # the Arduino clock drifts the reference from 101 to 101.3 Hz
+    freq = np.linspace(101, 101.3, n)
+    ref = 1.5 * np.cos(2 * np.pi * np.cumsum(freq) / FS) + 0.5
+    osc = ReferenceOscillator(101, FS)
+    ref_x = np.concatenate([osc(ref[s:s + block])[0] for s in range(0, n, block)])
+    assert osc.frequency == pytest.approx(freq[-1], abs=0.01)
+    assert osc.amp == pytest.approx(1.5, rel=0.01)
+    assert osc.offset == pytest.approx(0.5, abs=0.01)
+    # in phase with the measured reference
+    assert np.abs(ref_x - ref)[-FS:].max() < 0.05
+
+
+def test_stream_and_offline_lockin_agree_after_settling():
+    n, block = 6 * FS, 1500
+    t = np.arange(n) / FS
+    ref_x, _ = references(n)
+    signals = [0.8 * np.sin(2 * np.pi * FREQS[0] * t + 0.3) + 0.3 * np.sin(2 * np.pi * FREQS[1] * t + 1),
+               0.2 * np.sin(2 * np.pi * FREQS[0] * t) + 0.5 * np.sin(2 * np.pi * FREQS[1] * t + 2)]
+    blocks = np.stack([ref_x[0], ref_x[1], *signals])
+    stream = LockIn(FREQS, fs=FS, mode='stream', kernel='numpy')
+    streamed = np.concatenate([stream(blocks[:, s:s + block]) for s in range(0, n, block)], axis=-1)
+    offline = LockIn(FREQS, fs=FS, mode='offline', kernel='numpy')(blocks)
+    # past the stream filters' start-up and clear of the offline edge effects
+    settled = slice(2 * FS, 4 * FS)
+    np.testing.assert_allclose(streamed[:, settled], offline[:, settled], atol=0.01)
+    expected = np.array([0.8, 0.3, 0.2, 0.5]) / np.sqrt(2)
+    np.testing.assert_allclose(streamed[:, settled].mean(axis=1), expected, rtol=0.02)
+
+
+@pytest.mark.parametrize('mode', LockIn.modes)
+def test_lockin_amplitude_step_has_no_nans(mode):
+    n, block = 4 * FS, 1500
+    ref_x, _ = references(n)
+    signal = amplitude_step(n)
+    blocks = np.stack([ref_x[0], ref_x[1], signal, signal])
+    lockin = LockIn(FREQS, fs=FS, mode=mode, kernel='numpy')
+    if mode == 'stream':
+        out = np.concatenate([lockin(blocks[:, s:s + block]) for s in range(0, n, block)], axis=-1)
+    else:
+        out = lockin(blocks)
+    assert out.shape == (4, n)
+    assert not np.isnan(out).any()
+
+
+def test_fused_kernel_matches_numpy():
+    pytest.importorskip('numba')
+    n, block = 4 * FS, 1500
+    ref_x, _ = references(n)
+    # the amplitude drop makes the lowpass ring below zero, which both kernels clamp
+    signal = amplitude_step(n)
+    blocks = np.stack([ref_x[0], ref_x[1], signal, signal])
+    lockins = [LockIn(FREQS, fs=FS, mode='stream', kernel=kernel) for kernel in ('numpy', 'numba')]
+    for start in range(0, n, block):
+        expected, out = (lockin(blocks[:, start:start + block]) for lockin in lockins)
+        assert out.dtype == expected.dtype
+        assert not np.isnan(out).any()
+        np.testing.assert_allclose(out, expected, rtol=1e-9, atol=1e-12)
+
+
+def test_fused_kernel_reuses_its_buffers():
+    pytest.importorskip('numba')
+    n, block = 2 * FS, 150
+    ref_x, _ = references(n)
+    blocks = np.stack([ref_x[0], ref_x[1], amplitude_step(n), amplitude_step(n)]).astype(np.float32)
+    lockin = LockIn(FREQS, fs=FS, mode='stream', kernel='numba')
+    lockin(blocks[:, :block])
+    first = lockin(blocks[:, block:2 * block])
+    buffers = lockin.buffers
+    for start in range(2 * block, n, block):
+        assert lockin(blocks[:, start:start + block]) is first
+    assert all(a is b for a, b in zip(lockin.buffers, buffers))
+    assert first.dtype == np.float64
+
+
+def test_decimator_output_does_not_depend_on_the_block_size():
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((2, 3000))
+    whole = Decimator(15)(data)
+    assert whole.shape == (2, 200)
+    decimator = Decimator(15)
+    # blocks of any size, down to a single sample
+    edges = np.r_[0, 1, 2, np.sort(rng.choice(np.arange(3, 3000), 40, replace=False)), 3000]
+    pieces = [decimator(data[:, lo:hi]) for lo, hi in zip(edges[:-1], edges[1:])]
+    np.testing.assert_allclose(np.concatenate(pieces, axis=-1), whole, rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize('factor', [1, 4, 15])
+def test_decimator_dc_gain(factor):
+    out = Decimator(factor)(np.full((1, 20 * factor), 3.))
+    np.testing.assert_allclose(out, 3., rtol=1e-12)
+
+
+def test_decimator_delay():
+    factor, n = 15, 3 * FS
+    decimator = Decimator(factor)
+    assert decimator.delay == 4 * factor
+    t = np.arange(n) / FS
+    # well inside the passband
+    out = decimator(np.sin(2 * np.pi * 2 * t)[None])[0]
+    kept = np.arange(0, n, factor)
+    settled = kept > 2 * decimator.delay
+    lagged = np.sin(2 * np.pi * 2 * (kept - decimator.delay) / FS)
+    assert np.abs(out - lagged)[settled].max() < 1e-3
+    assert np.abs(out - np.sin(2 * np.pi * 2 * t[kept]))[settled].max() > 0.1
+
+
+def test_ring_buffer_wraps_around():
+    buff = RingBuffer(2, 100)
+    stream = np.stack([np.arange(1000), -np.arange(1000)]).astype(np.float32)
+    start = 0
+    # blocks that straddle the end of the storage, and one longer than the buffer
+    for n in (30, 50, 40, 99, 1, 150, 70):
+        buff.append(stream[:, start:start + n])
+        start += n
+        # starting from zeros
+        np.testing.assert_array_equal(buff.view(), np.c_[np.zeros((2, 100)), stream[:, :start]][:, -100:])
+        np.testing.assert_array_equal(buff.view(20), stream[:, start - 20:start])
+        # views are contiguous slices of the storage, not copies
+        assert np.shares_memory(buff.view(), buff.data)
+    assert buff.n_written == start
+    assert buff.view(1000).shape == (2, 100)
+
+
+def test_ring_buffer_append_interleaved():
+    buff = RingBuffer(3, 10)
+    scans = np.arange(12, dtype=np.float32)
+    block = buff.append_interleaved(scans)
+    np.testing.assert_array_equal(block, scans.reshape(4, 3).T)
+    np.testing.assert_array_equal(buff.view(4), block)
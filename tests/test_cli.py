@@ -0,0 +1,10 @@
+import pytest
+from click.testing import CliRunner
+from photroller.cli import cli
+
+
+@pytest.mark.parametrize('option', ['--freq1', '--freq2'])
+def test_start_controller_rejects_frequencies_the_firmware_would(option):
+    result = CliRunner().invoke(cli, ['start-controller', option, '0'])
+    assert result.exit_code == 2
+    assert 'not in the range 1<=x<=65535' in result.output
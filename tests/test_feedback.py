@@ -0,0 +1,73 @@
+import time
+import h5py
+import numpy as np
+from photroller.feedback import Feedback, ThresholdDecoder
+from photroller.util import dict_to_h5
+
+
+class Outputs:
+    '''Stands in for a backend, keeping what is written to each output'''
+    def __init__(self) -> None:
+        self.written = []
+
+    def write(self, name, value):
+        self.written.append((name, value))
+
+
+class SlowDecoder(ThresholdDecoder):
+    def __call__(self, data):
+        time.sleep(0.002)
+        return super().__call__(data)
+
+
+def steps(*levels, n=50):
+    '''A one-channel block holding each of `levels` for `n` columns'''
+    return np.repeat(np.array(levels, dtype=float), n)[None]
+
+
+def test_threshold_decoder_hysteresis():
+    decoder = ThresholdDecoder(0.5, hysteresis=0.2)
+    assert [decoder(np.full((1, 5), v)) for v in (0.55, 0.61, 0.45, 0.39, 0.5)] == [0, 1, 1, 0, 0]
+    decoder.reset()
+    assert decoder.state == 0
+
+
+def test_feedback_writes_decision_changes():
+    backend = Outputs()
+    feedback = Feedback(ThresholdDecoder(0.5), output='DAC0', levels=(0., 3.3), interval=50)
+    read_end = time.perf_counter()
+    feedback(backend, steps(0, 1, 1, 0), first_scan=1000, read_end=read_end)
+    # every 15th scan, as after decimation
+    feedback(backend, steps(0, 1), first_scan=2000, read_end=read_end, step=15)
+    assert backend.written == [('DAC0', 0.), ('DAC0', 3.3), ('DAC0', 0.), ('DAC0', 3.3)]
+    assert [entry[:2] for entry in feedback.log] == [(1049, 0), (1099, 1), (1199, 0), (2000 + 99 * 15, 1)]
+    assert feedback.overruns == 0
+
+
+def test_feedback_budget():
+    backend = Outputs()
+    feedback = Feedback(SlowDecoder(0.5), interval=10, budget=0.001)
+    feedback(backend, steps(1, 0, 1, 0, n=10), first_scan=0, read_end=time.perf_counter())
+    # the first sub-block used up the budget and the rest were skipped
+    assert backend.written == [('FIO4', 1)]
+    assert feedback.overruns == 1
+    feedback.reset()
+    assert (feedback.log, feedback.overruns, feedback.decision) == ([], 0, None)
+
+
+def test_feedback_log_saved(tmp_path):
+    feedback = Feedback(ThresholdDecoder(0.5), interval=50)
+    before = time.time()
+    feedback(Outputs(), steps(1, 0, 1), first_scan=0, read_end=time.perf_counter() - 0.01)
+    path = tmp_path / 'session.h5'
+    with h5py.File(path, 'w') as h5f:
+        dict_to_h5(h5f, feedback.summary(), 'feedback')
+    with h5py.File(path, 'r') as h5f:
+        log = h5f['feedback']
+        assert log['sample_index'][:].tolist() == [49, 99, 149]
+        assert log['decision'][:].tolist() == [1, 0, 1]
+        # wall-clock times, comparable with the blocks table's host_time
+        assert before <= log['time'][0] <= log['time'][-1] <= time.time()
+        assert (log['latency_s'][:] >= 0.01).all()
+        assert log['output'][()] == b'FIO4'
+        assert log['overruns'][()] == 0
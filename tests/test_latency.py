@@ -0,0 +1,46 @@
+import math
+import numpy as np
+import pytest
+from photroller.latency import LatencyHistogram
+
+# width of a bucket with the default 20 per decade
+BUCKET = 10 ** (1 / 20)
+
+
+def test_percentiles_match_numpy():
+    samples = np.random.default_rng(0).lognormal(np.log(1e-3), 1., 10000)
+    hist = LatencyHistogram()
+    for s in samples:
+        hist.record(s)
+    for q in (1, 50, 90, 99, 99.9):
+        # the upper edge of the bucket holding the percentile, at most a bucket above it
+        assert np.percentile(samples, q, method='lower') <= hist.percentile(q) * (1 + 1e-9)
+        assert hist.percentile(q) <= np.percentile(samples, q, method='higher') * BUCKET
+    assert hist.percentile(100) == hist.max == samples.max()
+    assert hist.min == samples.min()
+    assert hist.mean == pytest.approx(samples.mean())
+    summary = hist.summary()
+    assert summary['count'] == sum(summary['bucket_counts']) == len(samples)
+    assert len(summary['bucket_edges_s']) == len(summary['bucket_counts']) - 1
+
+
+def test_percentiles_of_known_samples():
+    hist = LatencyHistogram()
+    for ms in range(1, 101):
+        hist.record(ms * 1e-3)
+    assert 50e-3 <= hist.percentile(50) <= 50e-3 * BUCKET
+    assert 90e-3 <= hist.percentile(90) <= 90e-3 * BUCKET
+    # never above the largest sample
+    assert hist.percentile(99.9) == 0.1
+
+
+def test_out_of_range_samples():
+    hist = LatencyHistogram(low=1e-6, high=10)
+    assert math.isnan(hist.percentile(50))
+    assert math.isnan(hist.summary()['min_s'])
+    for s in (0., 1e-9, 100.):
+        hist.record(s)
+    assert hist.counts[0] == 2 and hist.counts[-1] == 1
+    assert hist.percentile(10) == hist.edges[0]
+    assert hist.percentile(100) == 100.
+    assert hist.last == 100.
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pyqtgraph')
+from photroller.gui.plots import minmax_decimate  # noqa: E402
+
+
+def test_minmax_decimate_keeps_the_extremes():
+    rng = np.random.default_rng(0)
+    y = rng.standard_normal((2, 10003)).astype(np.float32)
+    # spikes a plain subsampling would miss
+    y[0, 5001] = 50
+    y[1, 7777] = -50
+    x = np.arange(y.shape[1]) / 3000
+    xd, yd = minmax_decimate(x, y, 100)
+    assert yd.shape == (2, 200)
+    assert xd.shape == (200, )
+    assert yd.dtype == y.dtype
+    assert yd[0].max() == 50 and yd[1].min() == -50
+    # the three samples that do not fill a bin at the start are dropped
+    bins = y[:, 3:].reshape(2, 100, 100)
+    np.testing.assert_array_equal(yd[:, 0::2], bins.min(axis=-1))
+    np.testing.assert_array_equal(yd[:, 1::2], bins.max(axis=-1))
+    # each bin's pair sits at its first sample
+    np.testing.assert_array_equal(xd, np.repeat(x[3::100], 2))
+
+
+@pytest.mark.parametrize('n, n_bins', [(200, 100), (150, 100), (1000, 0)])
+def test_minmax_decimate_leaves_short_traces(n, n_bins):
+    x, y = np.arange(n), np.ones((3, n))
+    xd, yd = minmax_decimate(x, y, n_bins)
+    assert xd is x and yd is y
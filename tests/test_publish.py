@@ -0,0 +1,97 @@
+import time
+import threading
+import numpy as np
+import pytest
+from photroller.publish import Publisher, Subscriber
+
+CHANNELS = ['AIN2_ref1', 'AIN2_ref2', 'AIN3_ref1', 'AIN3_ref2']
+
+
+def make_block(seq, n=1000):
+    return (seq + np.arange(len(CHANNELS) * n).reshape(len(CHANNELS), n) / n).astype(np.float32)
+
+
+@pytest.fixture
+def make_publisher(tmp_path):
+    publishers = []
+
+    def make(max_blocks):
+        publishers.append(Publisher(str(tmp_path / f'stream{len(publishers)}.sock'), max_blocks=max_blocks,
+                                    channels=CHANNELS, rate=200.).start())
+        return publishers[-1]
+    yield make
+    for publisher in publishers:
+        publisher.close()
+
+
+def subscribe(publisher, n=1):
+    '''`n` subscribers, once the publisher has queued them'''
+    subscribers = [Subscriber(publisher.address, timeout=5) for _ in range(n)]
+    deadline = time.time() + 5
+    while publisher.n_connections < n and time.time() < deadline:
+        time.sleep(0.001)
+    return subscribers
+
+
+def read_all(sub, blocks):
+    # until the publisher closes the stream
+    blocks.extend(sub)
+
+
+def test_round_trip(make_publisher):
+    # room for every block, however far the sender thread lags
+    publisher = make_publisher(max_blocks=64)
+    sub, = subscribe(publisher)
+    assert sub.metadata == dict(channels=CHANNELS, rate=200.)
+    blocks = []
+    reader = threading.Thread(target=read_all, args=(sub, blocks))
+    reader.start()
+    for seq in range(50):
+        publisher.publish(seq, 1000 * seq, time.time(), make_block(seq))
+    publisher.close()
+    reader.join(5)
+    assert [b.seq for b in blocks] == list(range(50))
+    assert [b.first_scan for b in blocks] == [1000 * seq for seq in range(50)]
+    for block in blocks:
+        np.testing.assert_array_equal(block.data, make_block(block.seq))
+        assert 0 <= block.latency < 1
+    assert sub.summary()['received'] == 50
+    assert sub.summary()['dropped'] == 0
+    assert sub.summary()['latency']['count'] == 50
+    assert publisher.summary() == dict(address=publisher.address, max_blocks=64, n_blocks=50,
+                                       n_connections=1, dropped_blocks=0)
+    sub.close()
+
+
+def test_slow_subscriber_drops_without_blocking(make_publisher):
+    publisher = make_publisher(max_blocks=4)
+    fast, slow = subscribe(publisher, 2)
+    fast_blocks, slow_blocks = [], []
+    reader = threading.Thread(target=read_all, args=(fast, fast_blocks))
+    reader.start()
+    n = 200
+    start = time.perf_counter()
+    for seq in range(n):
+        publisher.publish(seq, seq, time.time(), make_block(seq))
+        # paced for the fast subscriber, which keeps up
+        time.sleep(0.002)
+    # the slow subscriber reads nothing meanwhile, and the socket buffer fills long before
+    # 200 blocks of 16 kB
+    assert time.perf_counter() - start < 0.002 * n + 1
+    slow_reader = threading.Thread(target=read_all, args=(slow, slow_blocks))
+    slow_reader.start()
+    publisher.close()
+    reader.join(5)
+    slow_reader.join(5)
+    assert [b.seq for b in fast_blocks] == list(range(n))
+    seqs = [b.seq for b in slow_blocks]
+    assert seqs == sorted(seqs) and seqs[0] == 0 and seqs[-1] == n - 1
+    assert slow.dropped > 0
+    assert slow.received + slow.dropped == n
+    assert fast.dropped == 0
+    summary = publisher.summary()
+    assert summary['n_connections'] == 2
+    assert summary['n_blocks'] == n
+    assert summary['dropped_blocks'] == slow.dropped
+    fast.close()
+    slow.close()
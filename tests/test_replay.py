@@ -0,0 +1,64 @@
+import os
+import tempfile
+import h5py
+import numpy as np
+from photroller.backends import SimulatedT7
+from photroller.replay import replay, summarize
+from photroller.writer import BLOCK_COLUMNS
+
+FS = 3000
+PARAMS = dict(freq1=101, freq2=237, amp1=3, amp2=1, offset1=0.1, offset2=0.1)
+NAMES = ['AIN0', 'AIN1', 'AIN2', 'AIN3']
+
+
+def make_session(path, reads=8, scans_per_read=1500):
+    '''A session of `reads` simulated reads, measured references included'''
+    backend = SimulatedT7.from_parameters(PARAMS, realtime=False, seed=0)
+    backend.start(scans_per_read, backend.addresses(NAMES + ['FIO_STATE']), FS)
+    raw = np.concatenate([np.reshape(backend.read()[0], (-1, len(NAMES) + 1)) for _ in range(reads)])
+    with h5py.File(path, 'w') as h5f:
+        h5f['raw_photometry'] = raw[:, :-1].astype(np.float32)
+        h5f['raw_photometry'].attrs['channels'] = NAMES
+        h5f['digital_io'] = raw[:, -1].astype(np.uint16)
+        h5f['metadata/writer/scan_rate'] = float(FS)
+        for k, v in PARAMS.items():
+            h5f[f'metadata/photometry/{k}'] = v
+    return raw
+
+
+def test_unpaced_replay(tmp_path, monkeypatch):
+    source, out = str(tmp_path / 'session.h5'), str(tmp_path / 'replay.h5')
+    raw = make_session(source)
+    result = replay(source, speed=None, save_path=out, report_interval=1e9)
+    assert result['speed'] is None
+    assert result['n_blocks'] == 8
+    assert result['seconds'] == len(raw) / FS == 4.
+    assert result['lost_blocks'] == 0
+    assert result['keeps_up'] == (result['achieved_speed'] >= 1)
+    with h5py.File(out, 'r') as h5f:
+        np.testing.assert_array_equal(h5f['raw_photometry'][:], raw[:, :-1].astype(np.float32))
+        np.testing.assert_array_equal(h5f['digital_io'][:], raw[:, -1])
+    # without a save_path the replayed session goes to a temporary file, which is not kept
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    assert replay(source, speed=None, duration=1, report_interval=1e9)['path'] is None
+    assert not [f for f in os.listdir(tmp_path) if f.startswith('replay_')]
+
+
+def test_summarize_verdict(tmp_path):
+    source, out = str(tmp_path / 'session.h5'), str(tmp_path / 'replay.h5')
+    make_session(source)
+    replay(source, speed=None, save_path=out, report_interval=1e9)
+    with h5py.File(out, 'a') as h5f:
+        # as if it had been paced, and the device backlog had grown in the second half
+        del h5f['metadata/replay/speed']
+        h5f['metadata/replay/speed'] = 1.
+        backlog = h5f['blocks'][:, BLOCK_COLUMNS.index('device_backlog')]
+        assert (backlog == 0).all()
+        h5f['blocks'][4:, BLOCK_COLUMNS.index('device_backlog')] = 3000
+    result = summarize(out)
+    assert result['speed'] == 1.
+    assert result['max_backlog_s'] == 1.
+    assert not result['keeps_up']
+    with h5py.File(out, 'a') as h5f:
+        h5f['blocks'][4:, BLOCK_COLUMNS.index('device_backlog')] = 0
+    assert summarize(out)['keeps_up']
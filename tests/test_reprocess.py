@@ -0,0 +1,95 @@
+import h5py
+import numpy as np
+import pytest
+from click.testing import CliRunner
+from photroller.backends import SimulatedT7
+from photroller.cli import cli
+from photroller.reprocess import reprocess, saved_references
+
+FS = 3000
+PARAMS = dict(freq1=101, freq2=237, amp1=3, amp2=1, offset1=0.1, offset2=0.1)
+
+
+def make_session(path, names, seconds=4, demodulated=None):
+    '''
+    A session file holding `seconds` of simulated `names` in raw_photometry, and the
+    `demodulated` channel names the recording saved (None for a legacy session)
+    '''
+    backend = SimulatedT7.from_parameters(PARAMS, realtime=False, seed=0)
+    backend.start(FS, backend.addresses(names), FS)
+    raw = np.concatenate([np.reshape(backend.read()[0], (-1, len(names))) for _ in range(seconds)])
+    with h5py.File(path, 'w') as h5f:
+        h5f['raw_photometry'] = raw.astype(np.float32)
+        if demodulated is not None:
+            h5f['raw_photometry'].attrs['channels'] = names
+            h5f.create_dataset('demodulated', (0, len(demodulated)), np.float32)
+            h5f['demodulated'].attrs['channels'] = demodulated
+        h5f['metadata/writer/scan_rate'] = float(FS)
+        for k, v in PARAMS.items():
+            h5f[f'metadata/photometry/{k}'] = v
+    return path
+
+
+@pytest.mark.parametrize('names, demodulated, expected', [
+    (['AIN0', 'AIN1', 'AIN2', 'AIN3'], ['AIN2_ref1', 'AIN2_ref2', 'AIN3_ref1', 'AIN3_ref2'], (0, 1)),
+    (['AIN2', 'AIN3'], ['AIN2_ref1', 'AIN2_ref2', 'AIN3_ref1', 'AIN3_ref2'], None),
+    (['AIN2', 'AIN0', 'AIN3'], ['AIN2_ref1', 'AIN3_ref1'], (1, )),
+    (['AIN2', 'AIN3'], None, (0, 1)),
+])
+def test_saved_references(tmp_path, names, demodulated, expected):
+    path = make_session(tmp_path / 'session.h5', names, seconds=1, demodulated=demodulated)
+    assert saved_references(path) == expected
+
+
+def test_demodulate_detects_synthesized_references(tmp_path):
+    names = ['AIN2', 'AIN3']
+    path = make_session(tmp_path / 'session.h5', names,
+                        demodulated=[f'{n}_ref{r}' for n in names for r in (1, 2)])
+    result = CliRunner().invoke(cli, ['demodulate', str(path), '--chunk', '1', '-j', '1'])
+    assert result.exit_code == 0, result.output
+    with h5py.File(path, 'r') as h5f:
+        out = h5f['reprocessed/demodulated']
+        assert list(out.attrs['signals']) == [0, 1]
+        assert len(out.attrs['references']) == 0
+
+
+def test_reprocess_synthesized_session_defaults_to_every_column(tmp_path):
+    path = make_session(tmp_path / 'session.h5', ['AIN2', 'AIN3'])
+    n = reprocess(path, references=None, chunk_seconds=1, n_workers=1)
+    with h5py.File(path, 'r') as h5f:
+        out = h5f['reprocessed/demodulated']
+        assert out.shape == (n, 4)
+        assert list(out.attrs['signals']) == [0, 1]
+        assert not np.isnan(out[:]).any()
+
+
+def test_reprocess_measured_session_defaults_to_the_pmts(tmp_path):
+    path = make_session(tmp_path / 'session.h5', ['AIN0', 'AIN1', 'AIN2', 'AIN3'])
+    reprocess(path, chunk_seconds=1, n_workers=1)
+    with h5py.File(path, 'r') as h5f:
+        assert list(h5f['reprocessed/demodulated'].attrs['signals']) == [2, 3]
+
+
+@pytest.mark.parametrize('signals, references', [((2, 3), None), ((0, ), (0, 5))])
+def test_reprocess_rejects_missing_columns(tmp_path, signals, references):
+    path = make_session(tmp_path / 'session.h5', ['AIN2', 'AIN3'])
+    with pytest.raises(ValueError, match='raw_photometry has 2 columns'):
+        reprocess(path, signals=signals, references=references, n_workers=1)
+
+
+def test_failed_reprocess_leaves_no_dataset(tmp_path, monkeypatch):
+    path = make_session(tmp_path / 'session.h5', ['AIN0', 'AIN1', 'AIN2', 'AIN3'])
+
+    def fail(*args):
+        raise RuntimeError('interrupted')
+
+    monkeypatch.setattr('photroller.reprocess._demodulate_chunk', fail)
+    with pytest.raises(RuntimeError, match='interrupted'):
+        reprocess(path, chunk_seconds=1, n_workers=1)
+    monkeypatch.undo()
+    with h5py.File(path, 'r') as h5f:
+        assert 'reprocessed' not in h5f or len(h5f['reprocessed']) == 0
+    # and the rerun does not need overwrite
+    reprocess(path, chunk_seconds=1, n_workers=1)
+    with h5py.File(path, 'r') as h5f:
+        assert list(h5f['reprocessed']) == ['demodulated']
@@ -0,0 +1,83 @@
+import os
+import pytest
+import multiprocess as mp
+from photroller.rigs import Rig, Supervisor, assign_cores, load_rigs
+
+CONFIG = '''
+defaults:
+  scan_rate: 2000
+  saving_parameters: {duration: 5}
+  photometry_parameters: {amp1: 2}
+rigs:
+  - name: rig1
+    labjack: 470012345
+    arduino: /dev/ttyACM0
+    cpu: 3
+  - name: rig2
+    labjack: 470012346
+    scan_rate: 3000
+    photometry_parameters: {freq1: 131}
+'''
+
+
+@pytest.fixture
+def cores(monkeypatch):
+    '''Pretend this process may run on `n` cores'''
+    def set_cores(n):
+        monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: set(range(n)), raising=False)
+    return set_cores
+
+
+def write_config(tmp_path, text=CONFIG):
+    path = tmp_path / 'rigs.yaml'
+    path.write_text(text)
+    return path
+
+
+def test_load_rigs_merges_the_defaults(tmp_path):
+    rig1, rig2 = load_rigs(write_config(tmp_path))
+    assert (rig1.name, rig1.labjack, rig1.arduino, rig1.cpu) == ('rig1', 470012345, '/dev/ttyACM0', 3)
+    assert (rig1.scan_rate, rig2.scan_rate) == (2000, 3000)
+    assert rig2.arduino is None and rig2.cpu is None
+    # dict settings are merged key by key
+    defaults = Rig(name='').saving_parameters
+    assert rig1.saving_parameters == dict(defaults, duration=5)
+    assert rig2.photometry_parameters == dict(Rig(name='').photometry_parameters, amp1=2, freq1=131)
+    assert rig1.photometry_parameters['freq1'] == 101
+
+
+@pytest.mark.parametrize('change, message', [
+    (('cpu: 3', 'cpuu: 3'), 'Unknown settings'),
+    (('470012346', '470012345'), 'share a labjack'),
+    (('scan_rate: 3000', 'cpu: 3'), 'share a cpu'),
+])
+def test_load_rigs_rejects_bad_configurations(tmp_path, change, message):
+    with pytest.raises(ValueError, match=message):
+        load_rigs(write_config(tmp_path, CONFIG.replace(*change)))
+
+
+def test_assign_cores_from_the_last_down(cores):
+    cores(4)
+    rigs = assign_cores([Rig(name='a'), Rig(name='b', cpu=3), Rig(name='c')])
+    assert [r.cpu for r in rigs] == [2, 3, 1]
+
+
+def test_assign_cores_leaves_the_rest_unpinned(cores, capsys):
+    cores(2)
+    rigs = assign_cores([Rig(name='a'), Rig(name='b'), Rig(name='c')])
+    assert [r.cpu for r in rigs] == [1, None, None]
+    assert 'leaving b, c unpinned' in capsys.readouterr().out
+    cores(1)
+    assert [r.cpu for r in assign_cores([Rig(name='a'), Rig(name='b')])] == [None, None]
+
+
+def test_report_counts_pinned_and_unpinned_rigs(cores):
+    cores(2)
+    supervisor = Supervisor([Rig(name='a', labjack='simulated'), Rig(name='b', labjack='simulated')])
+    for rig in supervisor.rigs:
+        supervisor.loads[rig.name] = mp.Value('d', 0.1)
+        supervisor.max_loads[rig.name] = 0.2
+    report = supervisor.format_report()
+    assert 'a (core 1)' in report and 'b (core None)' in report
+    assert '1 rigs pinned, one per core, and 1 unpinned' in report
+    assert 'about 4 rigs' in report
@@ -0,0 +1,114 @@
+import time
+import threading
+import h5py
+import numpy as np
+import pytest
+import multiprocess as mp
+from photroller.session import Session
+from photroller.transport import SharedRing
+from photroller.writer import BLOCK_COLUMNS, Writer
+
+FS = 3000
+BLOCK = 300
+# (first scan, file row) of each block; the third, scans 600-899, was lost to a ring overrun
+BLOCKS = [(0, 0), (300, 300), (600, -1), (900, 600), (1200, 900)]
+
+
+def make_session(path):
+    '''A session whose AIN0 column holds the scan index of each row'''
+    scans = np.concatenate([np.arange(scan, scan + BLOCK) for scan, row in BLOCKS if row >= 0])
+    table = np.zeros((len(BLOCKS), len(BLOCK_COLUMNS)))
+    for i, (scan, row) in enumerate(BLOCKS):
+        table[i, [BLOCK_COLUMNS.index(c) for c in ('first_scan', 'n_scans', 'file_row')]] = scan, BLOCK, row
+    with h5py.File(path, 'w') as h5f:
+        h5f['raw_photometry'] = np.stack([scans, -scans], axis=1).astype(np.float32)
+        h5f['raw_photometry'].attrs['channels'] = ['AIN0', 'AIN1']
+        h5f['digital_io'] = (scans >= 1000).astype(np.uint16)
+        h5f['blocks'] = table
+        h5f['blocks'].attrs['columns'] = BLOCK_COLUMNS
+        h5f['metadata/writer/scan_rate'] = float(FS)
+    return path
+
+
+@pytest.fixture
+def session(tmp_path):
+    with Session(make_session(tmp_path / 'session.h5')) as s:
+        yield s
+
+
+def test_time_to_row_skips_lost_blocks(session):
+    assert len(session) == 4 * BLOCK
+    scans = np.array([0, 299, 300, 599, 900, 950, 1499])
+    rows = session.time_to_row(scans / FS)
+    np.testing.assert_array_equal(rows, [0, 299, 300, 599, 600, 650, 1199])
+    np.testing.assert_allclose(session.row_to_time(rows), scans / FS)
+    # scans that never reached the file map to the first row after them
+    np.testing.assert_array_equal(session.time_to_row(np.array([600, 750, 899]) / FS), 600)
+    assert session.time_to_row(2.) == len(session)
+
+
+def test_window_reads_the_rows_of_stream_times(session):
+    data = session.window(0.3, 0.4, ['AIN0'])['AIN0']
+    np.testing.assert_array_equal(data, np.arange(900, 1200))
+    # a window over the gap holds what was recorded on either side of it
+    data = session.window(0.15, 0.35, ['AIN0'])['AIN0']
+    np.testing.assert_array_equal(data, np.r_[450:600, 900:1050])
+
+
+def test_align_on_edges_after_a_lost_block(session):
+    edges = session.edges(0)
+    np.testing.assert_array_equal(edges, [700])
+    assert session.row_to_time(edges[0]) == pytest.approx(1000 / FS)
+    windows = session.align(edges, 0.01, 0.01, ['AIN0', 'FIO_STATE'])
+    np.testing.assert_array_equal(windows['AIN0'][0], np.arange(970, 1030))
+    np.testing.assert_array_equal(windows['FIO_STATE'][0], np.repeat([0, 1], 30))
+
+
+def record(path, ring, n_blocks, interval=0.02):
+    '''Record `n_blocks` blocks through a Writer process, one every `interval` seconds'''
+    q = mp.Queue()
+    writer = Writer(q, ring, path, 2, scan_rate=FS, flush_interval=0.05, report_interval=1e9)
+    writer.start()
+    for seq in range(n_blocks):
+        scans = seq * BLOCK + np.arange(BLOCK)
+        ring.write(np.stack([scans, -scans, scans / 2, scans % 2]), time.time())
+        q.put((seq, time.time(), (seq * BLOCK, BLOCK, time.time(), 0, 0, 0, 0)))
+        time.sleep(interval)
+    q.put(None)
+    writer.join()
+
+
+def test_tail_follows_a_live_recording(tmp_path):
+    path = str(tmp_path / 'live.h5')
+    n_blocks = 50
+    ring = SharedRing(4, BLOCK, n_blocks=64)
+    recorder = threading.Thread(target=record, args=(path, ring, n_blocks))
+    recorder.start()
+    try:
+        # the writer creates the file locked, and unlocks it for readers in SWMR mode once it
+        # has created the datasets
+        deadline = time.time() + 10
+        while True:
+            try:
+                session = Session(path, live=True)
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.01)
+        with session:
+            end = 0
+            chunks = []
+            for row, data in session.tail(['AIN0', 'FIO_STATE'], poll_interval=0.01, timeout=1, start=0):
+                assert row == end
+                end = row + len(data['AIN0'])
+                assert len(data['FIO_STATE']) == len(data['AIN0'])
+                chunks.append(data['AIN0'])
+    finally:
+        recorder.join()
+        ring.close()
+    # followed as it grew, not read once at the end
+    assert len(chunks) > 3
+    np.testing.assert_array_equal(np.concatenate(chunks), np.arange(n_blocks * BLOCK))
+    with Session(path) as s:
+        assert len(s) == end == n_blocks * BLOCK
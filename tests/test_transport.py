@@ -0,0 +1,140 @@
+import threading
+import time
+import numpy as np
+import pytest
+import multiprocess as mp
+from photroller.transport import BoundedQueue, RingOverrun, SharedRing
+
+
+@pytest.fixture
+def ring():
+    ring = SharedRing(n_channels=3, block_size=100, n_blocks=4)
+    yield ring
+    ring.close()
+
+
+def block(seq, n=100):
+    return np.full((3, n), seq, dtype=np.float32)
+
+
+def test_ring_round_trip(ring):
+    for seq in range(3):
+        assert ring.write(block(seq, n=50 + seq), timestamp=seq / 10) == seq
+    assert ring.next_seq == 3
+    view = ring.read(1)
+    assert view.shape == (3, 51)
+    assert (view == 1).all()
+    assert ring.timestamp(2) == pytest.approx(0.2)
+    with pytest.raises(ValueError, match='does not fit'):
+        ring.write(block(3, n=101), 0.)
+
+
+def test_ring_overrun(ring):
+    with pytest.raises(RingOverrun, match='not available'):
+        ring.read(0)
+    for seq in range(6):
+        ring.write(block(seq), 0.)
+    # seqs 0 and 1 were overwritten by 4 and 5
+    for seq in (0, 1):
+        assert not ring.valid(seq)
+        with pytest.raises(RingOverrun):
+            ring.read(seq, copy=True)
+    assert (ring.read(2, copy=True) == 2).all()
+    # a view outlives its block: check again after using it
+    view = ring.read(2)
+    ring.write(block(6), 0.)
+    assert not ring.valid(2)
+    assert (view == 6).all()
+
+
+def read_blocks(ring, seqs, results):
+    # the ring arrives pickled by name and attaches to the same segment
+    results.put([float(ring.read(seq, copy=True).mean()) for seq in seqs])
+    ring.write(block(-1), 0.)
+    ring.close()
+
+
+def test_ring_attached_from_a_child_process(ring):
+    for seq in range(3):
+        ring.write(block(seq), 0.)
+    results = mp.Queue()
+    p = mp.Process(target=read_blocks, args=(ring, [0, 1, 2], results))
+    p.start()
+    assert results.get(timeout=10) == [0., 1., 2.]
+    p.join()
+    assert p.exitcode == 0
+    # the child's close did not unlink the segment, and its write is visible here
+    assert ring.next_seq == 4
+    assert (ring.read(3) == -1).all()
+    attached = SharedRing.attach(ring.name)
+    assert (attached.n_blocks, attached.n_channels, attached.block_size) == (4, 3, 100)
+    attached.close()
+
+
+def drain(q):
+    '''Finish the queue from a thread and return everything queued up to the end-of-stream None'''
+    finisher = threading.Thread(target=q.finish)
+    finisher.start()
+    items = []
+    while (item := q.get(timeout=1)) is not None:
+        items.append(item)
+    finisher.join()
+    return items
+
+
+def test_block_waits_for_the_consumer():
+    q = BoundedQueue(2, 'block')
+    assert q.put(0) and q.put(1)
+    # no consumer: gives up after the timeout
+    assert not q.put(2, timeout=0.1)
+    assert q.drops == 1
+    assert q.blocked_seconds >= 0.1
+    threading.Timer(0.1, q.get).start()
+    assert q.put(3)
+    assert drain(q) == [1, 3]
+    assert q.summary()['high_water'] == 2
+
+
+@pytest.mark.parametrize('policy, kept', [('drop_oldest', [2, 3]), ('drop_newest', [0, 1])])
+def test_drop_policies(policy, kept):
+    q = BoundedQueue(2, policy)
+    queued = [q.put(i) for i in range(4)]
+    assert queued == [True, True, policy == 'drop_oldest', policy == 'drop_oldest']
+    assert drain(q) == kept
+    assert q.summary()['drops'] == 2
+    assert q.qsize() == 0
+
+
+def test_spill_keeps_the_order():
+    q = BoundedQueue(2, 'spill', spill=lambda item: item + ('spilled', ))
+    for i in range(6):
+        assert q.put((i, ))
+    assert q.spills == 4
+    assert len(q.overflow) == 4
+    # stand-ins are queued as room frees up, ahead of newer items
+    assert q.get(timeout=1) == (0, )
+    q.put((6, ))
+    assert q.get(timeout=1) == (1, )
+    assert drain(q) == [(2, 'spilled'), (3, 'spilled'), (4, 'spilled'), (5, 'spilled'), (6, 'spilled')]
+    assert q.summary()['max_overflow'] == 4
+
+
+def produce(q, n):
+    for i in range(n):
+        q.put(i)
+    q.put(None)
+
+
+def test_block_across_processes():
+    q = BoundedQueue(4, 'block')
+    p = mp.Process(target=produce, args=(q, 10))
+    p.start()
+    time.sleep(0.1)
+    # the producer waits with the queue full, its next item counted in
+    assert 4 <= q.qsize() <= 5
+    items = []
+    while (item := q.get(timeout=1)) is not None:
+        items.append(item)
+    p.join()
+    assert items == list(range(10))
+    assert q.qsize() == 0
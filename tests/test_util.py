@@ -0,0 +1,206 @@
+import os
+import sys
+import time
+import struct
+import threading
+import pytest
+from photroller.util import (ACK_SYNC, HEADER, PACKET_SIZE, PROTOCOL_VERSION, SINE_TABLE_SIZE, STATUSES,
+                             SYNC, WRITE_ORDER, PhotometryController, ProtocolError, crc16,
+                             firmware_frequency, pack_parameters, unpack_parameters)
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason='the simulated controller needs a pty')
+
+PARAMS = dict(freq1=101, freq2=237, amp1=3., amp2=1., offset1=.1, offset2=.1)
+
+
+class SimulatedController:
+    '''
+    Hardware-free stand-in for the controller firmware on a pseudo-terminal: pass `port` to
+    PhotometryController. Parameter packets are answered like arduino/photroller does, and
+    the first `ignore` packets are not, as if the board were still booting. The `corrupt`
+    packets after those arrive damaged, as by serial noise while it boots, and are rejected.
+    '''
+    def __init__(self, ignore=0, table_size=SINE_TABLE_SIZE, corrupt=0) -> None:
+        import pty
+        import tty
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.ignore = ignore
+        self.corrupt = corrupt
+        self.table_size = table_size
+        self.parameters = None
+        self.sample_holds = (0, 0)
+        self.received = 0
+        self.rejected = 0
+        self.start = time.perf_counter()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        buffer = b''
+        while True:
+            try:
+                buffer += os.read(self.master, 256)
+            except OSError:
+                # closed
+                return
+            while True:
+                start = buffer.find(SYNC)
+                if start < 0 or len(buffer) - start < PACKET_SIZE:
+                    buffer = buffer[start:] if start >= 0 else buffer[-1:]
+                    break
+                packet, buffer = buffer[start:start + PACKET_SIZE], buffer[start + PACKET_SIZE:]
+                self._handle(packet)
+
+    def _handle(self, packet):
+        self.received += 1
+        if self.received <= self.ignore:
+            return
+        if self.received <= self.ignore + self.corrupt:
+            packet = packet[:-1] + bytes([packet[-1] ^ 0xFF])
+        seq = packet[3]
+        try:
+            seq, params = unpack_parameters(packet)
+        except ProtocolError as e:
+            self.rejected += 1
+            status = e.status
+        else:
+            status = 0
+            self.parameters = params
+            self.sample_holds = tuple(int(1e6 / (self.table_size * params[k])) for k in ('freq1', 'freq2'))
+        micros = int((time.perf_counter() - self.start) * 1e6) % 2 ** 32
+        body = struct.pack('<2sBBBIII', ACK_SYNC, PROTOCOL_VERSION, seq, status, *self.sample_holds, micros)
+        os.write(self.master, body + struct.pack('<H', crc16(body[2:])))
+
+    def close(self):
+        os.close(self.slave)
+        os.close(self.master)
+
+
+@pytest.fixture
+def simulator():
+    sim = SimulatedController()
+    yield sim
+    sim.close()
+
+
+@pytest.fixture
+def controller(simulator):
+    c = PhotometryController(PARAMS, simulator.port)
+    yield c
+    c.close()
+
+
+def with_crc(body):
+    return body + struct.pack('<H', crc16(body[2:]))
+
+
+def test_pack_round_trip():
+    packet = pack_parameters(PARAMS, 7)
+    assert len(packet) == PACKET_SIZE
+    seq, params = unpack_parameters(packet)
+    assert seq == 7
+    assert params == pytest.approx(PARAMS)
+
+
+def test_resends_until_the_board_answers():
+    sim = SimulatedController(ignore=2)
+    try:
+        c = PhotometryController(PARAMS, sim.port)
+        try:
+            # two packets went unanswered while the board was "booting"
+            assert sim.received == 3
+            assert sim.parameters == pytest.approx(PARAMS)
+            assert len(c.history) == 1
+        finally:
+            c.close()
+    finally:
+        sim.close()
+
+
+def test_resends_after_boot_noise():
+    sim = SimulatedController(ignore=1, corrupt=2)
+    try:
+        c = PhotometryController(PARAMS, sim.port)
+        try:
+            assert sim.rejected == 2
+            assert sim.parameters == pytest.approx(PARAMS)
+        finally:
+            c.close()
+    finally:
+        sim.close()
+
+
+def test_no_answer_times_out(simulator):
+    simulator.ignore = 1000
+    with pytest.raises(TimeoutError):
+        PhotometryController(PARAMS, simulator.port, timeout=0.5)
+
+
+def test_confirmation_reports_the_frequencies_in_effect(controller, simulator):
+    confirmation = controller.write_parameters(dict(PARAMS, freq1=131), wait=True)
+    assert confirmation.ok
+    assert confirmation.frequencies[0] == pytest.approx(firmware_frequency(131))
+    assert simulator.parameters['freq1'] == 131
+
+
+def test_bad_value(controller, simulator):
+    with pytest.raises(ProtocolError) as e:
+        controller.write_parameters(dict(PARAMS, freq2=0), wait=True)
+    assert STATUSES[e.value.status] == 'bad value'
+    # the previous parameters stay in effect
+    assert simulator.parameters['freq2'] == PARAMS['freq2']
+
+
+def test_bad_crc(controller):
+    packet = bytearray(pack_parameters(PARAMS, 200))
+    packet[-1] ^= 0xFF
+    controller.device.write(bytes(packet))
+    with pytest.raises(ProtocolError) as e:
+        controller.wait(200)
+    assert STATUSES[e.value.status] == 'bad crc'
+
+
+def test_bad_length(controller):
+    payload = pack_parameters(PARAMS, 201)[HEADER.size:-2]
+    body = HEADER.pack(SYNC, PROTOCOL_VERSION, 201, len(payload) - 1) + payload
+    controller.device.write(with_crc(body))
+    with pytest.raises(ProtocolError) as e:
+        controller.wait(201)
+    assert STATUSES[e.value.status] == 'bad length'
+
+
+def test_bad_version(controller):
+    packet = pack_parameters(PARAMS, 202)
+    controller.device.write(with_crc(packet[:2] + bytes([PROTOCOL_VERSION + 1]) + packet[3:-2]))
+    with pytest.raises(ProtocolError) as e:
+        controller.wait(202)
+    assert STATUSES[e.value.status] == 'bad version'
+
+
+def test_resyncs_after_garbage(controller, simulator):
+    # stray bytes, ending in half a sync word, towards the board
+    controller.device.write(b'\x01\x02\xff\xa5')
+    assert controller.write_parameters(dict(PARAMS, freq1=120), wait=True).ok
+    # and towards the host, with half an ACK sync word and a false one
+    os.write(simulator.master, b'\x5a\x00\x5a\xa5' + bytes(30))
+    assert controller.write_parameters(dict(PARAMS, freq1=121), wait=True).ok
+    assert simulator.parameters['freq1'] == 121
+
+
+def test_updates(controller):
+    assert set(controller.updates()) == {'seq', 'sent', 'confirmed', 'sample_hold1', 'sample_hold2',
+                                         'device_micros', *WRITE_ORDER}
+    since = time.time()
+    seqs = [controller.write_parameters(dict(PARAMS, freq1=100 + i)) for i in range(5)]
+    controller.wait(seqs[-1])
+    # rejected sets are left out
+    with pytest.raises(ProtocolError):
+        controller.write_parameters(dict(PARAMS, freq1=0), wait=True)
+    updates = controller.updates(since)
+    assert updates['seq'] == seqs
+    assert updates['freq1'] == [100 + i for i in range(5)]
+    assert all(s <= c for s, c in zip(updates['sent'], updates['confirmed']))
+    assert updates['sample_hold1'][-1] == controller.history[-2].sample_hold1
+    assert controller.updates(time.time() + 1) == {}
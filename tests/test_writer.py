@@ -0,0 +1,154 @@
+import os
+import queue
+import threading
+import h5py
+import numpy as np
+import pytest
+from photroller.transport import SharedRing
+from photroller.writer import (CODECS, EVENT_DTYPE, Spiller, Writer, chunk_rows, compression_kwargs,
+                               find_events, hdf5plugin, spill_path)
+
+N_RAW = 2
+BLOCK = 300
+
+
+def make_block(first_scan, fio=None):
+    '''(N_RAW raw, one demodulated, FIO_STATE) channels of a block starting at `first_scan`'''
+    scans = first_scan + np.arange(BLOCK)
+    fio = np.zeros(BLOCK) if fio is None else fio
+    return np.stack([scans, -scans, scans / 2, fio]).astype(np.float64)
+
+
+def record(tmp_path, blocks, spilled=(), **kwargs):
+    '''
+    Run a Writer over `blocks` written to a ring, the ones in `spilled` also saved to the
+    spill directory as the stream does when it cannot wait for the writer
+    '''
+    ring = SharedRing(N_RAW + 2, BLOCK, n_blocks=8)
+    spill_dir = str(tmp_path / 'session.h5.spill')
+    os.makedirs(spill_dir)
+    q = queue.Queue()
+    try:
+        for i, block in enumerate(blocks):
+            seq = ring.write(block, 0.)
+            if seq in spilled:
+                np.savez(spill_path(spill_dir, seq), block=block)
+            q.put((seq, 0., (i * BLOCK, BLOCK, 0., 0, 0, 0, 0)))
+        q.put(None)
+        path = str(tmp_path / 'session.h5')
+        Writer(q, ring, path, N_RAW, scan_rate=3000, report_interval=1e9, spill_dir=spill_dir,
+               **kwargs).run()
+    finally:
+        ring.close()
+    return path, spill_dir
+
+
+@pytest.mark.parametrize('swmr', [False, True])
+@pytest.mark.parametrize('codec', CODECS)
+def test_codecs_round_trip(tmp_path, codec, swmr):
+    if codec in ('blosc', 'zstd') and hdf5plugin is None:
+        with pytest.raises(ValueError, match='requires hdf5plugin'):
+            compression_kwargs(codec)
+        pytest.skip(f'{codec} needs hdf5plugin')
+    blocks = [make_block(i * BLOCK) for i in range(4)]
+    # 128-row chunks, so the session ends on a partial one; a minute is preallocated without swmr
+    path, _ = record(tmp_path, blocks, codec=codec, chunk_kb=1, duration=60, swmr=swmr)
+    expected = np.concatenate(blocks, axis=1).T
+    with h5py.File(path, 'r') as h5f:
+        raw, demodulated, digital = h5f['raw_photometry'], h5f['demodulated'], h5f['digital_io']
+        # trimmed to the rows written
+        assert raw.shape == (4 * BLOCK, N_RAW)
+        assert demodulated.shape == (4 * BLOCK, 1)
+        assert digital.shape == (4 * BLOCK, )
+        np.testing.assert_array_equal(raw[:], expected[:, :N_RAW])
+        np.testing.assert_array_equal(demodulated[:, 0], expected[:, N_RAW])
+        assert raw.chunks == (chunk_rows(N_RAW, chunk_kb=1), N_RAW) == (128, N_RAW)
+        plist = raw.id.get_create_plist()
+        filters = {plist.get_filter(i)[0] for i in range(plist.get_nfilters())}
+        if codec == 'none':
+            assert raw.compression is None and not filters
+        elif codec in ('lzf', 'gzip'):
+            assert raw.compression == codec
+            assert raw.shuffle
+        else:
+            plugin = hdf5plugin.BLOSC_ID if codec == 'blosc' else hdf5plugin.ZSTD_ID
+            assert plugin in filters
+
+
+def test_compression_settings():
+    assert compression_kwargs('gzip', 7)['compression_opts'] == 7
+    assert compression_kwargs('gzip')['compression_opts'] == 3
+    assert compression_kwargs(None) == compression_kwargs('none') == {}
+    with pytest.raises(ValueError, match='Unknown codec'):
+        compression_kwargs('bzip2')
+    # chunks of up to chunk_kb, whatever the width
+    assert chunk_rows(4) == 256 * 1024 // 16
+    assert chunk_rows(100000, min_rows=8) == 8
+
+
+def test_spilled_copies_of_blocks_read_from_the_ring_are_deleted(tmp_path):
+    path, spill_dir = record(tmp_path, [make_block(i * BLOCK) for i in range(4)], spilled=(1, 2))
+    assert os.listdir(spill_dir) == []
+    with h5py.File(path, 'r') as h5f:
+        np.testing.assert_array_equal(h5f['raw_photometry'][:, 0], np.arange(4 * BLOCK))
+        assert h5f['metadata/writer/spilled'][()] == 0
+
+
+def test_writer_waits_for_blocks_still_being_spilled(tmp_path):
+    ring = SharedRing(N_RAW + 2, BLOCK, n_blocks=8)
+    spill_dir = str(tmp_path / 'session.h5.spill')
+    spiller = Spiller(spill_dir)
+    q = queue.Queue()
+    try:
+        # twice round the ring before the writer runs: the first eight blocks are spilled
+        # before their slots are reused, as the stream does
+        for seq in range(16):
+            if seq >= 8:
+                spiller.save(seq - 8, block=ring.read(seq - 8, copy=True))
+                assert spiller.saved(seq - 8)
+            ring.write(make_block(seq * BLOCK), 0.)
+            item = (seq, 0., (seq * BLOCK, BLOCK, 0., 0, 0, 0, 0))
+            # blocks the queue had no room for go as stand-ins, the others are looked up
+            q.put(item + (spill_path(spill_dir, seq), ) if seq < 8 and seq % 2 else item)
+        q.put(None)
+        # a slow disk: none of them is saved when the writer gets to them
+        threading.Timer(0.3, spiller.start).start()
+        path = str(tmp_path / 'session.h5')
+        Writer(q, ring, path, N_RAW, scan_rate=3000, report_interval=1e9, spill_dir=spill_dir).run()
+        spiller.close()
+    finally:
+        ring.close()
+    assert os.listdir(spill_dir) == []
+    with h5py.File(path, 'r') as h5f:
+        np.testing.assert_array_equal(h5f['raw_photometry'][:, 0], np.arange(16 * BLOCK))
+        assert h5f['metadata/writer/spilled'][()] == 8
+        assert h5f['metadata/writer/overruns'][()] == 0
+
+
+def test_find_events():
+    states = np.array([0, 1, 1, 5, 4, 4, 0])
+    events = find_events(states, previous=0, first_index=10)
+    assert events.dtype == EVENT_DTYPE
+    assert events.tolist() == [(11, 0, 1), (13, 2, 1), (14, 0, -1), (16, 2, -1)]
+    # a change from the previous block's last state is an edge on the first row
+    assert find_events(states, previous=2).tolist()[:2] == [(0, 1, -1), (1, 0, 1)]
+    assert len(find_events([])) == 0
+
+
+def test_events_table(tmp_path):
+    fio = np.zeros((3, BLOCK))
+    fio[0, 100:] = 0b0001  # FIO0 rises
+    fio[0, 250:] = 0b0101  # then FIO2
+    fio[1, :] = 0b0100  # FIO0 falls on the first scan of the second block
+    fio[1, 299] = 0b1100  # FIO3 rises on the last scan of the second block...
+    fio[2, :] = 0b0100  # ...and falls on the first of the third
+    path, _ = record(tmp_path, [make_block(i * BLOCK, fio[i]) for i in range(3)])
+    with h5py.File(path, 'r') as h5f:
+        events = h5f['events'][:]
+        assert events.tolist() == [(100, 0, 1), (250, 2, 1), (300, 0, -1), (599, 3, 1), (600, 3, -1)]
+        assert h5f['metadata/writer/n_events'][()] == 5
+        # the rows index digital_io
+        digital = h5f['digital_io'][:]
+        for row, bit, direction in events.tolist():
+            assert (digital[row] >> bit) & 1 == (direction > 0)
+            assert (digital[row - 1] >> bit) & 1 == (direction < 0)